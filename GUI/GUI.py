@@ -8,6 +8,7 @@ Other logic unchanged.
 
 import sys
 import os
+import time
 import threading
 from pathlib import Path
 from typing import Iterable
@@ -23,10 +24,11 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
 
-from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING
+from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, SUPPORTED_EXTENSIONS
 from data_generation import ANONYMIZATION_LABELS
-from utils.anonymization_utils import read_file, anonymize_doc, save_many_texts
+from utils.anonymization_utils import read_file, anonymize_doc, save_many_texts, iter_input_files
 from rules.rules import apply_rules
+from utils.warmup_utils import ModelWarmup
 
 # ----------------------------
 #   Anonymization function
@@ -217,6 +219,15 @@ class AnonymizerApp:
         self.status_box = tk.Text(right_frame, height=20, bg="#f7f7f7")
         self.status_box.pack(fill="both", expand=True, padx=10, pady=10)
 
+        self.model_label = ttk.Label(right_frame, text="Modello: caricamento in corso...", foreground="gray")
+        self.model_label.pack(anchor="w", padx=10, pady=(0, 10))
+
+        # --- MODEL LOADING AND WARM-UP (background) ---
+        self.nlp = None
+        self.warmup = None
+        self.model_thread = threading.Thread(target=self._load_model, daemon=True)
+        self.model_thread.start()
+
 
     # --------------------------------------------------------------------
     # Utility methods
@@ -225,6 +236,22 @@ class AnonymizerApp:
         self.status_box.insert("end", message + "\n")
         self.status_box.see("end")
 
+    def _load_model(self):
+        """Loads the model once and warms it up with synthetic documents, so that the first documents are not slowed down."""
+        try:
+            self.nlp = spacy.load(DEFAULT_NER_MODEL)
+        except Exception as e:
+            self.root.after(0, lambda e=e: self.model_label.config(text=f"Modello: errore di caricamento ({e})", foreground="red"))
+            return
+        warmup = ModelWarmup(self.nlp, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING).run()
+        metrics = warmup.metrics()
+        self.root.after(0, lambda: self.model_label.config(text="Modello: pronto", foreground="green"))
+        if metrics["error"] is not None:  # the model still works, but its latencies are not recorded
+            self.root.after(0, lambda: self.log(f"Modello pronto (riscaldamento non riuscito: {metrics['error']})."))
+            return
+        self.warmup = warmup
+        self.root.after(0, lambda: self.log(f"Modello pronto (riscaldamento in {metrics['warmup_seconds']}s)."))
+
     def _resize_banner(self, event):
         """Resize banner image proportionally when frame size changes."""
         if not hasattr(self, "banner_original"):
@@ -242,7 +269,7 @@ class AnonymizerApp:
         self.banner_label.config(image=self.banner_photo)
 
     def select_files(self):
-        files = filedialog.askopenfilenames(title="Seleziona File", filetypes=[("Documenti", "*.pdf *.docx *.json *.txt")])
+        files = filedialog.askopenfilenames(title="Seleziona File", filetypes=[("Documenti", " ".join(f"*{ext}" for ext in SUPPORTED_EXTENSIONS))])
         if files:
             self.selected_files = list(files)
             self.file_listbox.delete(0, "end")
@@ -253,8 +280,7 @@ class AnonymizerApp:
     def select_folder(self):
         folder = filedialog.askdirectory(title="Seleziona Cartella")
         if folder:
-            self.selected_files = [os.path.join(folder, f) for f in os.listdir(folder)
-                                   if f.lower().endswith((".pdf", ".docx", ".json", ".txt"))]
+            self.selected_files = [entry.path for entry in iter_input_files(folder)]
             self.file_listbox.delete(0, "end")
             for f in self.selected_files:
                 self.file_listbox.insert("end", f)
@@ -291,6 +317,13 @@ class AnonymizerApp:
                             lambda: messagebox.showwarning("Attenzione", "Seleziona almeno una categoria di entità."))
             return
 
+        if self.model_thread.is_alive():
+            self.root.after(0, lambda: self.log("In attesa del caricamento del modello..."))
+            self.model_thread.join()
+        if self.nlp is None:
+            self.root.after(0, lambda: messagebox.showerror("Errore", f"Impossibile caricare il modello {DEFAULT_NER_MODEL}."))
+            return
+
         for file_path in self.selected_files:
             try:
                 texts, dict = read_file(file_path)
@@ -302,8 +335,13 @@ class AnonymizerApp:
                 self.root.after(0, lambda f=file_path: self.log(f"Saltato (vuoto): {f}"))
                 continue
 
-            anonymized = [anonymize(text, entities=selected_entities, per_matching=self.use_name_dictionary.get(), personal_data=dict)
-                          for text in texts]
+            anonymized = []
+            for text in texts:
+                start = time.perf_counter()
+                anonymized.append(anonymize(text, nlp=self.nlp, entities=selected_entities,
+                                            per_matching=self.use_name_dictionary.get(), personal_data=dict))
+                if self.warmup is not None:
+                    self.warmup.observe(len(text), time.perf_counter() - start)
             out_path = save_many_texts(
                 anonymized,
                 output_dir=self.output_dir,
@@ -314,6 +352,9 @@ class AnonymizerApp:
 
         self.root.after(0, lambda: messagebox.showinfo("Fatto", "Anonimizzazione completata con successo!"))
         self.root.after(0, lambda: self.log("Tutti i file sono stati processati con successo."))
+        if self.warmup is not None:
+            warm = self.warmup.metrics()["latencies"]["warm"]
+            self.root.after(0, lambda: self.log(f"Latenza media per testo: {warm['mean_seconds']}s (massima {warm['max_seconds']}s)."))
 
 
 # Entry point
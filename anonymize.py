@@ -1,18 +1,43 @@
 #!/usr/bin/env python3
 
+import io
 import os
+import time
 import warnings
 import argparse
 import sys
 import json
-from typing import Iterable
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer
+from typing import BinaryIO, Iterable, Iterator, TextIO
 
 import spacy
 from spacy import Language
 
-from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, PERSONAL_DATA_FORMAT
+from config import (DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS, DEFAULT_PDF_WORKERS,
+                    DEFAULT_MAX_TASKS_PER_WORKER, DEFAULT_MAX_WORKER_RSS_MB,
+                    DEFAULT_READER_THREADS, DEFAULT_READ_QUEUE_SIZE, DEFAULT_WRITE_QUEUE_SIZE, DEFAULT_LEASE_SECONDS,
+                    DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, PERSONAL_DATA_FORMAT, DEFAULT_CACHE_MAX_MB,
+                    DEADLINE_INITIAL_CHARS_PER_SECOND)
 from rules.rules import apply_rules
-from utils.anonymization_utils import anonymize_doc, save_anonymized_text, read_file, save_many_texts
+from rules.patient_registry import load_patient_registry
+from utils.anonymization_utils import (anonymize_doc, save_anonymized_text, read_file, save_many_texts, save_spans,
+                                       anonymized_text_path)
+from utils.reader_utils import iter_text_chunks, iter_prefetched
+from utils.compression_utils import compression_of, strip_compression_suffix
+from utils.sink_utils import open_sink
+from utils.batch_utils import (anonymize_texts, anonymize_jsonl, anonymize_patients, extract_spans, run_pipeline,
+                               label_chunks, write_anonymized_chunks, join_chunk_spans)
+from utils.directory_utils import anonymize_directory
+from utils.queue_batch_utils import anonymize_queue
+from utils.reapply_utils import reapply_rules_directory
+from utils.json_utils import is_multi_record_json, iter_json_records
+from utils.profiling_utils import Profiler, set_profiler, profile_stage
+from utils.cache_utils import ResultCache, ParagraphMemo
+from utils.span_utils import StandoffSpan, doc_to_spans
+from utils.deadline_utils import DeadlineLabeller
+from utils.warmup_utils import ModelWarmup, serve_readiness
 from GUI.GUI import main as gui_main
 
 warnings.filterwarnings("ignore", message=r".*\[W095\].*")
@@ -39,7 +64,22 @@ def anonymize(text: str,
     if entities is None: entities = DEFAULT_ENTITIES
     if per_matching is None: per_matching = DEFAULT_EXTRA_PER_MATCHING
 
-    return anonymize_doc(apply_rules(nlp(text), per_matching, personal_data), entities)
+    return anonymize_doc(apply_rules(run_pipeline(nlp, [text])[0], per_matching, personal_data), entities)
+
+def anonymize_spans(text: str,
+                    nlp:Language = None,
+                    entities:Iterable[str]=None,
+                    per_matching:bool=None,
+                    personal_data:dict[str, str]=None) -> list[StandoffSpan]:
+    """
+    Same as anonymize, but returns the (start, end, label, source) character offsets of the entities to anonymize
+    instead of the rewritten text. The source is 'NER', the name of the matching rule or 'personal_data'.
+    """
+    if nlp is None: nlp = spacy.load(DEFAULT_NER_MODEL)
+    if entities is None: entities = DEFAULT_ENTITIES
+    if per_matching is None: per_matching = DEFAULT_EXTRA_PER_MATCHING
+
+    return doc_to_spans(apply_rules(run_pipeline(nlp, [text])[0], per_matching, personal_data), entities)
 
 def get_full_labeller(path: str = DEFAULT_NER_MODEL, per_matching:bool=DEFAULT_EXTRA_PER_MATCHING):
     """Returns a full anonymization function using the specified spaCy model path."""
@@ -50,16 +90,444 @@ def get_full_labeller(path: str = DEFAULT_NER_MODEL, per_matching:bool=DEFAULT_E
 #   CLI logic
 # ----------------------------
 
+def load_model(path: str = DEFAULT_NER_MODEL) -> Language:
+    """Loads the spaCy model, exiting with an error message on failure."""
+    try:
+        with profile_stage("load_model"):
+            return spacy.load(path)
+    except Exception as e:
+        print(f"Error loading spaCy model '{path}': {e}", file=sys.stderr)
+        sys.exit(1)
+
+def warm_up_model(args, nlp: Language, entities: list[str]) -> tuple[ModelWarmup | None, ThreadingHTTPServer | None]:
+    """
+    With --warmup or --readiness-port, runs synthetic documents through the pipeline before the first input is read,
+    serving the readiness probe on --readiness-port meanwhile, and prints their cold and warm latencies.
+    Returns the warm-up, recording the latencies of the served inputs, and the readiness probe server.
+    """
+    if not args.warmup and not args.readiness_port:
+        return None, None
+    warmup, server = ModelWarmup(nlp, entities, args.per_matching), None
+    if args.readiness_port:
+        try:
+            server = serve_readiness(warmup, args.readiness_port)
+        except OSError as e:
+            print(f"Error serving the readiness probe on port {args.readiness_port}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Readiness probe on http://127.0.0.1:{args.readiness_port}/ready (metrics on /metrics).", file=sys.stderr)
+    metrics = warmup.run().metrics()
+    if metrics["error"] is not None:
+        print(f"Error warming up the model: {metrics['error']}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Model warmed up in {metrics['warmup_seconds']}s: "
+          + ", ".join(f"{run['chars']} chars {run['cold_seconds']}s cold, {run['warm_seconds']}s warm" for run in metrics["warmup"])
+          + ".", file=sys.stderr)
+    return warmup, server
+
+def report_latencies(warmup: ModelWarmup | None, server: ThreadingHTTPServer | None):
+    """Prints the cold and warm latencies recorded by the warm-up, if any, and stops the readiness probe."""
+    if server is not None:
+        server.shutdown()
+    if warmup is None:
+        return
+    for kind, stats in warmup.metrics()["latencies"].items():
+        print(f"{kind.capitalize()} latency: {stats['mean_seconds']}s mean, {stats['max_seconds']}s max over "
+              f"{stats['documents']} inputs ({stats['chars']} chars).", file=sys.stderr)
+
+def load_personal_data(path: str) -> dict[str, str]:
+    """Loads a personal data dictionary from a json file, exiting with an error message on failure."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading personal data file '{path}': {e}", file=sys.stderr)
+        sys.exit(1)
+
+def open_cache(args) -> ResultCache | None:
+    """Opens the result cache given with --cache, exiting with an error message on failure."""
+    if not args.cache:
+        return None
+    try:
+        return ResultCache(args.cache, args.cache_max_mb)
+    except Exception as e:
+        print(f"Error opening result cache '{args.cache}': {e}", file=sys.stderr)
+        sys.exit(1)
+
+def report_cache(cache: ResultCache | None):
+    """Prints the hit rate of the result cache, if any, and closes it."""
+    if cache is None:
+        return
+    stats = cache.stats()
+    cache.close()
+    hit_rate = "n/a" if stats["hit_rate"] is None else f"{stats['hit_rate']:.1%}"
+    print(f"Result cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {hit_rate}), "
+          f"{stats['entries']} entries, {stats['size_bytes'] / 1024 / 1024:.1f}/{stats['max_bytes'] / 1024 / 1024:.0f} MB, "
+          f"{stats['evictions']} evicted.", file=sys.stderr)
+
+def report_rule_timeouts(rule_timeouts: list[str]):
+    """Prints the rules that exceeded their timeout on the input, if any, since their matches may be incomplete."""
+    if rule_timeouts:
+        print(f"Warning: rules {', '.join(rule_timeouts)} exceeded their timeout: only the matches found so far are "
+              f"masked in the output.", file=sys.stderr)
+
+_RECORDS_OUTPUT_SUFFIXES = {"text": "_anonymized.jsonl", "standoff": "_spans.jsonl", "standoff-binary": "_spans.bin"}
+
+def records_output_name(args) -> str:
+    """Returns the name of the JSON Lines (or binary spans) output of the records read from --input-file or stdin."""
+    base_name = os.path.splitext(os.path.basename(strip_compression_suffix(args.input_file or "stdin")))[0]
+    return base_name + _RECORDS_OUTPUT_SUFFIXES[args.output_format]
+
+@contextmanager
+def open_output(args, out_path: str | None, binary: bool) -> Iterator[TextIO | BinaryIO]:
+    """
+    Opens the output stream of the streaming modes: with --output-sink, an in-memory buffer added to the sink as an
+    entry named after out_path once written; otherwise the file at out_path, or stdout without one.
+    """
+    if args.output_sink:
+        with open_sink(args.output_sink) as sink:
+            buffer = io.BytesIO() if binary else io.StringIO()
+            yield buffer
+            sink.write(os.path.basename(out_path), buffer.getvalue())
+    elif out_path:
+        with open(out_path, "wb") if binary else open(out_path, "w", encoding="utf-8") as f:
+            yield f
+    else:
+        yield sys.stdout.buffer if binary else sys.stdout
+
+def run_jsonl_mode(args):
+    """Streams JSON Lines records from the input file or stdin to the output sink, the output path or stdout."""
+    if args.input_file and not os.path.isfile(args.input_file):
+        print(f"Error: Input file '{args.input_file}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    personal_data = load_personal_data(args.personal_data) if args.personal_data else None
+    entities = list(args.entities) if args.entities else DEFAULT_ENTITIES
+    nlp = load_model()
+    warmup, server = warm_up_model(args, nlp, entities)
+    cache = open_cache(args)
+
+    input_file = open(args.input_file, "r", encoding="utf-8-sig") if args.input_file else sys.stdin
+    try:
+        with open_output(args, records_output_name(args) if args.output_sink else args.output_path,
+                         args.output_format == "standoff-binary") as output_file:
+            count = anonymize_jsonl(input_file, output_file, nlp, entities, args.per_matching, personal_data,
+                                    args.batch_size, args.output_format, cache,
+                                    ParagraphMemo() if args.dedup_paragraphs else None,
+                                    warmup.observe if warmup is not None else None)
+    except Exception as e:
+        print(f"Error processing JSONL stream: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if input_file is not sys.stdin: input_file.close()
+        report_cache(cache)
+        report_latencies(warmup, server)
+
+    if args.output_sink or args.output_path:
+        print(f"{count} anonymized records saved to '{args.output_sink or args.output_path}'.", file=sys.stderr)
+
+def is_patients_export(path: str | None) -> bool:
+    """Returns whether the given input file is a multi-patient JSON array or JSON Lines export."""
+    return bool(path) and strip_compression_suffix(path).lower().endswith((".json", ".jsonl")) and os.path.isfile(path) \
+        and is_multi_record_json(path)
+
+def run_patients_mode(args):
+    """
+    Streams the patients of a multi-patient export, one JSON Lines record each, to the output sink, the output path
+    or stdout.
+    """
+    personal_data = load_personal_data(args.personal_data) if args.personal_data else None
+    entities = list(args.entities) if args.entities else DEFAULT_ENTITIES
+    nlp = load_model()
+    warmup, _ = warm_up_model(args, nlp, entities)
+    cache = open_cache(args)
+
+    try:
+        with open_output(args, records_output_name(args) if args.output_sink else args.output_path,
+                         args.output_format == "standoff-binary") as output_file:
+            count = anonymize_patients(iter_json_records(args.input_file), output_file, nlp, entities, args.per_matching,
+                                       personal_data, args.batch_size, args.output_format, cache,
+                                       ParagraphMemo() if args.dedup_paragraphs else None)
+    except Exception as e:
+        print(f"Error processing patients of '{args.input_file}': {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        report_cache(cache)
+        report_latencies(warmup, None)
+
+    if args.output_sink or args.output_path:
+        print(f"{count} anonymized patients saved to '{args.output_sink or args.output_path}'.", file=sys.stderr)
+
+def run_text_file_mode(args):
+    """
+    Anonymizes a plain-text file of any size in paragraph-aligned chunks, writing the output incrementally
+    to the output path or next to the input file, or as an entry of the output sink.
+    """
+    if not os.path.isfile(args.input_file):
+        print(f"Error: Input file '{args.input_file}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    personal_data = load_personal_data(args.personal_data) if args.personal_data else None
+    entities = list(args.entities) if args.entities else DEFAULT_ENTITIES
+    nlp = load_model()
+    warmup, _ = warm_up_model(args, nlp, entities)
+    cache = open_cache(args)
+    chunks = iter_text_chunks(args.input_file)
+    if compression_of(args.input_file):
+        chunks = iter_prefetched(chunks)  # decompress ahead of the model
+    rule_timeouts = []
+    labelled = label_chunks(nlp, chunks, entities, args.per_matching, personal_data, args.batch_size, cache,
+                            ParagraphMemo() if args.dedup_paragraphs else None, rule_timeouts)
+    try:
+        if args.output_format != "text":
+            binary = args.output_format == "standoff-binary"
+            if args.output_sink:
+                with open_sink(args.output_sink) as sink:
+                    save_spans([join_chunk_spans(labelled)], output_dir="",
+                               original_filename=strip_compression_suffix(args.input_file), binary=binary, sink=sink)
+                out_path = args.output_sink
+            elif args.output_path and not os.path.isdir(args.output_path):
+                out_path = save_spans([join_chunk_spans(labelled)], output_path=args.output_path, binary=binary)
+            else:
+                out_path = save_spans([join_chunk_spans(labelled)], output_dir=args.output_path or os.path.dirname(args.input_file),
+                                      original_filename=strip_compression_suffix(args.input_file), binary=binary)
+            print(f"Standoff spans saved to '{out_path}'.")
+            report_rule_timeouts(rule_timeouts)
+            return
+
+        if args.output_sink:
+            out_path = anonymized_text_path("", strip_compression_suffix(args.input_file))
+        elif args.output_path and not os.path.isdir(args.output_path):
+            out_path = args.output_path
+        else:
+            out_path = anonymized_text_path(args.output_path or os.path.dirname(args.input_file),
+                                            strip_compression_suffix(args.input_file))
+        with open_output(args, out_path, False) as f:
+            write_anonymized_chunks(labelled, f)
+        print(f"Anonymized text saved to '{args.output_sink or out_path}'.")
+        report_rule_timeouts(rule_timeouts)
+    except Exception as e:
+        print(f"Error processing file '{args.input_file}': {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        report_cache(cache)
+        report_latencies(warmup, None)
+
+def run_directory_mode(args):
+    """Anonymizes all documents of the input directory, resuming from the manifest of previous runs."""
+    if not os.path.isdir(args.input_dir):
+        print(f"Error: Input directory '{args.input_dir}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+    if not args.output_dir and not args.output_sink:
+        print("Error: --output-dir or --output-sink is required together with --input-dir.", file=sys.stderr)
+        sys.exit(1)
+
+    personal_data = load_personal_data(args.personal_data) if args.personal_data else None
+    entities = list(args.entities) if args.entities else DEFAULT_ENTITIES
+    try:
+        summary = anonymize_directory(args.input_dir, args.output_dir, entities=entities, per_matching=args.per_matching,
+                                      personal_data=personal_data, recursive=args.recursive, workers=max(1, args.workers),
+                                      manifest_path=args.manifest, batch_size=args.batch_size, output_format=args.output_format,
+                                      cache_path=args.cache, cache_max_mb=args.cache_max_mb,
+                                      paragraph_dedup=args.dedup_paragraphs, ner_store_dir=args.ner_store,
+                                      pdf_workers=max(1, args.pdf_workers), patient_registry=args.patient_registry,
+                                      output_sink=args.output_sink, reader_threads=max(0, args.reader_threads),
+                                      read_queue_size=max(1, args.read_queue_size),
+                                      write_queue_size=max(1, args.write_queue_size),
+                                      max_tasks_per_worker=max(0, args.max_tasks_per_worker),
+                                      max_worker_rss_mb=max(0, args.max_worker_rss_mb),
+                                      log=lambda message: print(message, file=sys.stderr))
+    except Exception as e:
+        print(f"Error processing directory '{args.input_dir}': {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Processed {summary['processed']} files, skipped {summary['skipped']} unchanged, {summary['failed']} failed.")
+    if summary["rule_timeouts"]:
+        print(f"Warning: some rule exceeded its timeout on {summary['rule_timeouts']} files, recorded as "
+              f"'rule_timeout' in the manifest: only the matches found so far are masked, and they will be processed "
+              f"again by the next run.", file=sys.stderr)
+    if args.cache:
+        print(f"Result cache: {summary['cache_hits']} hits, {summary['cache_misses']} misses.", file=sys.stderr)
+    for stage, stats in summary.get("stages", {}).items():
+        print(f"Stage '{stage}': {stats['items']} items, {stats['busy_seconds']}s busy over {stats['threads']} thread(s), "
+              f"utilization {stats['utilization']}, {stats['blocked_seconds']}s blocked on the next stage.", file=sys.stderr)
+    for stats in summary.get("workers", []):
+        print(f"Worker {stats['pid']}: {stats['tasks']} tasks, {stats['busy_seconds']}s busy, "
+              f"utilization {stats['utilization']}, peak RSS {stats['peak_rss_mb']}MB.", file=sys.stderr)
+    for event in summary.get("recycles", []):
+        reason = "task limit" if event["reason"] == "tasks" else "RSS ceiling" if event["reason"] == "rss" else "crash"
+        print(f"Recycled worker {event['pid']} after {event['tasks']} tasks ({reason}, RSS {event['rss_mb']}MB) "
+              f"at {event['at_seconds']}s.", file=sys.stderr)
+    if summary["failed"]:
+        sys.exit(1)
+
+def run_queue_mode(args):
+    """
+    Joins a distributed batch run through a work queue on a shared filesystem, first adding the files of the input
+    directory to the queue if one is given.
+    """
+    if args.input_dir and not os.path.isdir(args.input_dir):
+        print(f"Error: Input directory '{args.input_dir}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+    if args.input_dir and not args.output_dir:
+        print("Error: --output-dir is required to add the files of --input-dir to --queue.", file=sys.stderr)
+        sys.exit(1)
+    if args.output_sink or args.ner_store:
+        print("Error: --queue writes to --output-dir and cannot be combined with --output-sink or --ner-store.", file=sys.stderr)
+        sys.exit(1)
+
+    personal_data = load_personal_data(args.personal_data) if args.personal_data else None
+    entities = list(args.entities) if args.entities else DEFAULT_ENTITIES
+    try:
+        summary = anonymize_queue(args.queue, args.input_dir, args.output_dir, entities=entities,
+                                  per_matching=args.per_matching, personal_data=personal_data, recursive=args.recursive,
+                                  workers=max(1, args.workers), batch_size=args.batch_size,
+                                  output_format=args.output_format, cache_path=args.cache, cache_max_mb=args.cache_max_mb,
+                                  paragraph_dedup=args.dedup_paragraphs, pdf_workers=max(1, args.pdf_workers),
+                                  patient_registry=args.patient_registry, lease_seconds=args.lease_seconds,
+                                  log=lambda message: print(message, file=sys.stderr))
+    except Exception as e:
+        print(f"Error processing queue '{args.queue}': {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Processed {summary['processed']} files, {summary['failed']} failed, {summary['lost']} taken over by other workers.")
+    if summary["rule_timeouts"]:
+        print(f"Warning: some rule exceeded its timeout on {summary['rule_timeouts']} files, whose rules are stored "
+              f"as the error of their job: only the matches found so far are masked.", file=sys.stderr)
+    print(f"Queue: {', '.join(f'{count} {status}' for status, count in sorted(summary['queue'].items()))}.", file=sys.stderr)
+    if summary["failed"]:
+        sys.exit(1)
+
+def run_reapply_mode(args):
+    """Re-applies the current rules to the NER output stored by a previous directory run, without loading the model."""
+    if not args.ner_store or not os.path.isdir(args.ner_store):
+        print("Error: --reapply-rules requires the directory of an existing NER store given with --ner-store.", file=sys.stderr)
+        sys.exit(1)
+    if not args.output_dir:
+        print("Error: --output-dir is required together with --reapply-rules.", file=sys.stderr)
+        sys.exit(1)
+
+    personal_data = load_personal_data(args.personal_data) if args.personal_data else None
+    entities = list(args.entities) if args.entities else DEFAULT_ENTITIES
+    summary = reapply_rules_directory(args.ner_store, args.output_dir, entities, args.per_matching, personal_data,
+                                      args.output_format, log=lambda message: print(message, file=sys.stderr))
+
+    print(f"Re-applied rules to {summary['processed']} files, {summary['failed']} failed.")
+    if summary["rule_timeouts"]:
+        print(f"Warning: some rule exceeded its timeout on {summary['rule_timeouts']} files: only the matches found "
+              f"so far are masked in them.", file=sys.stderr)
+    if summary["failed"]:
+        sys.exit(1)
+
+def run_with_deadline(labeller: DeadlineLabeller, texts: list[str],
+                      personal_data: dict[str, str] | None) -> tuple[list[str], list[Future | None] | None]:
+    """
+    Anonymizes the texts within --deadline seconds each (see DeadlineLabeller), returning them with the Futures of the
+    full-quality passes of the degraded ones, or None if no text was degraded.
+    """
+    anonymized, full_quality = [], []
+    for i, text in enumerate(texts):
+        start = time.perf_counter()
+        redacted, degraded, full = labeller.anonymize(text, personal_data)
+        anonymized.append(redacted)
+        full_quality.append(full)
+        if degraded:
+            print(f"Text {i + 1}: degraded to rules only after {time.perf_counter() - start:.2f}s, "
+                  f"full-quality pass queued.", file=sys.stderr)
+    return anonymized, full_quality if any(future is not None for future in full_quality) else None
+
+def write_text_output(args, anonymized: list[str]):
+    """Writes the anonymized texts of the CLI mode to the output sink, the output path, next to the input file, or to stdout."""
+    if args.output_sink:
+        try:
+            with open_sink(args.output_sink) as sink:
+                save_many_texts(anonymized, output_dir="", original_filename=strip_compression_suffix(args.input_file or "text"), sink=sink)
+        except Exception as e:
+            print(f"Error writing to output sink '{args.output_sink}': {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"{len(anonymized)} anonymized texts saved to '{args.output_sink}'.")
+    elif args.output_path:
+        if not os.path.isdir(args.output_path):
+            try:
+                out_path = save_anonymized_text('\n\n'.join(anonymized), output_path=args.output_path)
+            except Exception as e:
+                print(f"Error writing to '{args.output_path}': {e}", file=sys.stderr)
+                sys.exit(1)
+        else:
+            try:
+                out_path = save_many_texts(anonymized, output_dir=args.output_path, original_filename=strip_compression_suffix(args.input_file))
+            except Exception as e:
+                print(f"Error writing to directory '{args.output_path}': {e}", file=sys.stderr)
+                sys.exit(1)
+        print(f"Anonymized text saved to '{out_path}'.")
+    elif args.input_file:
+        out_path = save_many_texts(anonymized, output_dir=os.path.dirname(args.input_file), original_filename=strip_compression_suffix(args.input_file))
+        print(f"Anonymized text saved to '{out_path}'.")
+    else:
+        print(anonymized)
+
+
+def run_standoff_output(args, nlp: Language, texts: list[str], entities: list[str], personal_data: dict[str, str] | None,
+                        cache: ResultCache | None = None):
+    """Writes the standoff spans of the given texts to the output path, next to the input file, or to stdout."""
+    memo = ParagraphMemo() if args.dedup_paragraphs else None
+    rule_timeouts = []
+    spans_per_text = list(extract_spans(nlp, texts, entities, args.per_matching, personal_data, args.batch_size, cache,
+                                        memo, rule_timeouts))
+    binary = args.output_format == "standoff-binary"
+    report_rule_timeouts(rule_timeouts)
+
+    if not args.output_path and not args.input_file:
+        print(json.dumps([[list(span) for span in spans] for spans in spans_per_text], ensure_ascii=False))
+        return
+
+    try:
+        if args.output_path and not os.path.isdir(args.output_path):
+            out_path = save_spans(spans_per_text, output_path=args.output_path, binary=binary)
+        else:
+            out_path = save_spans(spans_per_text, output_dir=args.output_path or os.path.dirname(args.input_file),
+                                  original_filename=strip_compression_suffix(args.input_file or "text"), binary=binary)
+    except Exception as e:
+        print(f"Error writing spans: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Standoff spans saved to '{out_path}'.")
+
 def main():
     parser = argparse.ArgumentParser(description="Anonymize text based on spaCy NER and additional rules.")
 
     # Command options
     parser.add_argument("--text", type=str, help="Text to anonymize.")
-    parser.add_argument("--input-file", type=str, help="Path to a file containing text to anonymize. In case of a json, it can also contain a dictionary of personal data.")
+    parser.add_argument("--input-file", type=str, help="Path to a file containing text to anonymize. In case of a json, it can also contain a dictionary of personal data. Compressed files (.gz, .bz2, .xz, .zst) and zip/tar archives are read without extracting them.")
     parser.add_argument("--output-path", type=str, help="Path to save anonymized text. If omitted, prints to stdout.")
     parser.add_argument("--entities", type=str, nargs="+", help="List of entity types to anonymize.")
     parser.add_argument("--per-matching", action="store_true", help="Enable extra matching for PER and PATIENT entities using dictionaries.")
     parser.add_argument("--personal-data", type=str, help=f"Path to json dictionary of specific personal data to anonymize. Provided dictionary should have the following fields: {list(PERSONAL_DATA_FORMAT.keys())}.")
+    parser.add_argument("--jsonl", action="store_true", help="Stream JSON Lines records (one object per line with a 'testo' field and an optional 'anagrafica' dictionary) from --input-file or stdin to --output-path or stdout.")
+    parser.add_argument("--input-dir", type=str, help="Directory of documents to anonymize in batch mode. Requires --output-dir.")
+    parser.add_argument("--output-dir", type=str, help="Directory where batch mode writes anonymized documents, mirroring the input tree.")
+    parser.add_argument("--output-sink", type=str, metavar="PATH", help="Write all outputs as entries of a single archive (.zip, .tar, .tar.gz, .tar.xz, .tar.bz2, .tar.zst), JSON Lines file (.jsonl, optionally compressed) or SQLite database (.sqlite, .db) instead of one file per text.")
+    parser.add_argument("--recursive", action="store_true", help="Descend into subdirectories of --input-dir.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of worker processes used in batch mode. Files are dispatched largest first and long .txt and PDF files are split across workers.")
+    parser.add_argument("--max-tasks-per-worker", type=int, default=DEFAULT_MAX_TASKS_PER_WORKER, help="With several workers, replace each worker process by a fresh one after this many files or parts (0 for never).")
+    parser.add_argument("--max-worker-rss-mb", type=float, default=DEFAULT_MAX_WORKER_RSS_MB, help="With several workers, replace a worker process whose resident memory exceeds this many MB after a file (0 for no limit).")
+    parser.add_argument("--reader-threads", type=int, default=DEFAULT_READER_THREADS, help="With a single worker, number of threads reading files ahead of the model in batch mode, while a writer thread saves the outputs (0 processes files strictly in turn).")
+    parser.add_argument("--read-queue-size", type=int, default=DEFAULT_READ_QUEUE_SIZE, help="Files read ahead of the model by the reader threads in batch mode.")
+    parser.add_argument("--write-queue-size", type=int, default=DEFAULT_WRITE_QUEUE_SIZE, help="Labelled files waiting for the writer thread in batch mode.")
+    parser.add_argument("--queue", type=str, metavar="PATH", help="SQLite work queue on a shared filesystem for distributed batch mode: workers on any node sharing it claim files until none is left. With --input-dir and --output-dir, the files are added to the queue first.")
+    parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS, help="With --queue, time after which a file claimed by a dead worker is claimed again.")
+    parser.add_argument("--pdf-workers", type=int, default=DEFAULT_PDF_WORKERS, help="Number of processes extracting the pages of each PDF in batch mode, ahead of the model.")
+    parser.add_argument("--manifest", type=str, help="Path of the SQLite manifest used to resume batch runs. Defaults to a file inside --output-dir.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default=DEFAULT_OUTPUT_FORMAT, help="Output rewritten texts, or only the (start, end, label, source) spans of the entities as JSONL ('standoff') or compact binary records ('standoff-binary').")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of texts processed together by the NER model.")
+    parser.add_argument("--cache", type=str, metavar="PATH", help="SQLite result cache: texts already anonymized with the same model, rules and options are not processed again.")
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_CACHE_MAX_MB, help="Size bound of the result cache, enforced by evicting the least recently used results.")
+    parser.add_argument("--dedup-paragraphs", action="store_true", help="Label texts paragraph by paragraph, running NER and rules only once on paragraphs repeated within and across documents (letterheads, footers, templates).")
+    parser.add_argument("--ner-store", type=str, metavar="DIR", help="In batch mode, also store the raw NER output of every file in DIR, so that rules can later be re-applied with --reapply-rules without running the model.")
+    parser.add_argument("--reapply-rules", action="store_true", help="Re-apply the current rules and dictionaries to the NER output stored in --ner-store, writing outputs to --output-dir without loading the model.")
+    parser.add_argument("--patient-registry", type=str, metavar="PATH", help="JSON or JSONL registry of patient 'anagrafica' dictionaries: the names (labelled PATIENT) and the birthplaces and residences (labelled GPE, only when capitalized and not a common Italian word) of every registered patient are masked in all documents.")
+    parser.add_argument("--profile", type=str, nargs="?", const="anonymization_profile", metavar="PREFIX", help="Record wall time, calls and characters processed by each pipeline stage and rule, saving them to PREFIX.json and to PREFIX.folded (collapsed stacks for flame graphs).")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS", help="Time budget of each text given with --text, --input-file or stdin: parts whose inference would exceed it are anonymized by rules and dictionaries only, and the output is marked as degraded until a full-quality pass replaces it. Cannot be combined with --cache or --dedup-paragraphs.")
+    parser.add_argument("--warmup", action="store_true", help="Run synthetic documents of several lengths through the pipeline after loading the model, before the first input is read, and report cold and warm latencies separately. With --deadline, the measured throughput is used to plan the first text. Not supported with --input-dir, --queue or --reapply-rules.")
+    parser.add_argument("--readiness-port", type=int, metavar="PORT", help="With --jsonl, warm up the model and serve a readiness probe on http://127.0.0.1:PORT/ready (503 until the warm-up completes, then 200), with the cold and warm latencies as JSON on /metrics.")
     parser.add_argument("--gui", action="store_true", help="Launch the graphical user interface.")
 
     args = parser.parse_args()
@@ -71,6 +539,78 @@ def main():
         gui_main()
         return
 
+    profiler = Profiler() if args.profile else None
+    set_profiler(profiler)
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            json_path, folded_path = profiler.save(args.profile)
+            print(f"Profiling report saved to '{json_path}' and '{folded_path}'.", file=sys.stderr)
+
+def run(args):
+    """Runs the CLI mode selected by the parsed arguments."""
+    if args.patient_registry:
+        if not os.path.isfile(args.patient_registry):
+            print(f"Error: Patient registry '{args.patient_registry}' does not exist.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            registry = load_patient_registry(args.patient_registry)
+        except Exception as e:
+            print(f"Error loading patient registry '{args.patient_registry}': {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"Loaded {registry.patients} patients from '{args.patient_registry}'.", file=sys.stderr)
+
+    if args.readiness_port and not args.jsonl:
+        print("Error: --readiness-port is only supported together with --jsonl.", file=sys.stderr)
+        sys.exit(1)
+    if args.warmup and (args.reapply_rules or args.queue or args.input_dir):
+        print("Error: --warmup is not supported with --input-dir, --queue or --reapply-rules, whose workers load the "
+              "model themselves (or not at all).", file=sys.stderr)
+        sys.exit(1)
+
+    # -----------------------------------
+    # JSONL STREAMING MODE
+    # -----------------------------------
+    if args.jsonl:
+        run_jsonl_mode(args)
+        return
+
+    # -----------------------------------
+    # RULES RE-APPLICATION MODE
+    # -----------------------------------
+    if args.reapply_rules:
+        run_reapply_mode(args)
+        return
+
+    # -----------------------------------
+    # DISTRIBUTED QUEUE MODE
+    # -----------------------------------
+    if args.queue:
+        run_queue_mode(args)
+        return
+
+    # -----------------------------------
+    # DIRECTORY BATCH MODE
+    # -----------------------------------
+    if args.input_dir:
+        run_directory_mode(args)
+        return
+
+    # -----------------------------------
+    # MULTI-PATIENT EXPORT MODE
+    # -----------------------------------
+    if is_patients_export(args.input_file):
+        run_patients_mode(args)
+        return
+
+    # -----------------------------------
+    # PLAIN-TEXT FILE MODE
+    # -----------------------------------
+    if not args.text and not args.deadline and args.input_file and strip_compression_suffix(args.input_file).lower().endswith(".txt"):
+        run_text_file_mode(args)
+        return
+
     # -----------------------------------
     # CLI MODE
     # -----------------------------------
@@ -102,44 +642,61 @@ def main():
         entities = list(args.entities)
 
     if args.personal_data:
-        try:
-            with open(args.personal_data, "r", encoding="utf-8") as f:
-                personal_data = json.load(f)
-        except Exception as e:
-            print(f"Error reading personal data file '{args.personal_data}': {e}", file=sys.stderr)
-            sys.exit(1)
+        personal_data = load_personal_data(args.personal_data)
 
-    # Load spaCy model
-    try:
-        nlp = spacy.load(DEFAULT_NER_MODEL)
-    except Exception as e:
-        print(f"Error loading spaCy model '{args.model}': {e}", file=sys.stderr)
+    if args.deadline and args.output_format != "text":
+        print("Error: --deadline only supports the text output format.", file=sys.stderr)
         sys.exit(1)
+    if args.deadline and (args.cache or args.dedup_paragraphs):
+        print("Error: --deadline cannot be combined with --cache or --dedup-paragraphs.", file=sys.stderr)
+        sys.exit(1)
+
+    nlp = load_model()
+    warmup, _ = warm_up_model(args, nlp, entities or DEFAULT_ENTITIES)
+    cache = open_cache(args)
+
+    if args.output_format != "text":
+        try:
+            run_standoff_output(args, nlp, texts, entities or DEFAULT_ENTITIES, personal_data, cache)
+        finally:
+            report_cache(cache)
+        return
 
     # Anonymize
-    anonymized = [anonymize(text, nlp=nlp, entities=entities, per_matching=args.per_matching, personal_data=personal_data)
-                    for text in texts]
+    full_quality, rule_timeouts = None, []
+    labeller = None
+    if args.deadline:
+        # The throughput measured by --warmup, if given, replaces the initial estimate of the labeller
+        labeller = DeadlineLabeller(nlp, entities or DEFAULT_ENTITIES, args.per_matching, args.deadline,
+                                    (warmup.chars_per_second() if warmup is not None else None) or DEADLINE_INITIAL_CHARS_PER_SECOND)
+    start = time.perf_counter()
+    try:
+        try:
+            if labeller is not None:
+                anonymized, full_quality = run_with_deadline(labeller, texts, personal_data)
+            else:
+                anonymized = list(anonymize_texts(nlp, texts, entities or DEFAULT_ENTITIES, args.per_matching, personal_data,
+                                                  args.batch_size, cache, ParagraphMemo() if args.dedup_paragraphs else None,
+                                                  rule_timeouts))
+        finally:
+            report_cache(cache)
+        report_rule_timeouts(rule_timeouts)
+        if warmup is not None:
+            warmup.observe(sum(len(text) for text in texts), time.perf_counter() - start)
+            report_latencies(warmup, None)
 
-    # Output result
-    if args.output_path:
-        if not os.path.isdir(args.output_path):
-            try:
-                out_path = save_anonymized_text('\n\n'.join(anonymized), output_path=args.output_path)
-            except Exception as e:
-                print(f"Error writing to '{args.output_path}': {e}", file=sys.stderr)
-                sys.exit(1)
-        else:
-            try:
-                out_path = save_many_texts(anonymized, output_dir=args.output_path, original_filename=args.input_file)
-            except Exception as e:
-                print(f"Error writing to directory '{args.output_path}': {e}", file=sys.stderr)
-                sys.exit(1)
-        print(f"Anonymized text saved to '{out_path}'.")
-    elif args.input_file:
-        out_path = save_many_texts(anonymized, output_dir=os.path.dirname(args.input_file), original_filename=args.input_file)
-        print(f"Anonymized text saved to '{out_path}'.")
-    else:
-        print(anonymized)
+        # Output result
+        write_text_output(args, anonymized)
+        if full_quality:
+            if args.output_sink or not (args.output_path or args.input_file):
+                print("Full-quality pass skipped: it can only replace outputs saved to --output-path or next to --input-file.", file=sys.stderr)
+                return
+            print("Waiting for the full-quality pass of the degraded texts...", file=sys.stderr)
+            write_text_output(args, [future.result() if future is not None else text for text, future in zip(anonymized, full_quality)])
+            print("Degraded texts replaced by their full-quality anonymization.", file=sys.stderr)
+    finally:
+        if labeller is not None:
+            labeller.close(cancel_pending=True)  # stops the model thread, dropping the full-quality passes not needed anymore
 
 
 if __name__ == "__main__":
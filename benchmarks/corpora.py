@@ -0,0 +1,91 @@
+"""
+Corpora of controlled size for the benchmarks, built from the synthetic test samples and the rule test files.
+"""
+
+import os
+import random
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from utils.json_utils import read_json_file
+
+SYNTHETIC_TEST_DIR = os.path.join(PROJECT_ROOT, "data_generation/synthetic_samples/test")
+RULES_TEST_FILES_DIR = os.path.join(PROJECT_ROOT, "rules/test_files")
+
+DIARY_FILES = ["synthetic_diaries_edu_test.json", "synthetic_diaries_it_test.json",
+               "synthetic_diaries_psych_test.json", "synthetic_diaries_therap_test.json"]
+REPORT_FILES = ["synthetic_reports_test.json"]
+ENTITY_DENSE_FILES = ["mixed_text.txt", "email_text.txt", "codes_text.txt", "url_text.txt"]
+DIGIT_HEAVY_FILES = ["phone_text.txt", "codes_text.txt"]
+
+CORPORA = ["short_diaries", "long_reports", "entity_dense", "digit_heavy"]
+
+
+def _synthetic_texts(file_names: list[str]) -> list[str]:
+    return [sample["text"] for name in file_names for sample in read_json_file(os.path.join(SYNTHETIC_TEST_DIR, name))]
+
+
+def _test_file_texts(file_names: list[str]) -> list[str]:
+    texts = []
+    for name in file_names:
+        with open(os.path.join(RULES_TEST_FILES_DIR, name), "r", encoding="utf-8") as f:
+            texts += [paragraph.strip() for paragraph in f.read().split("\n\n") if paragraph.strip()]
+    return texts
+
+
+def _digit_heavy_texts(rng: random.Random) -> list[str]:
+    """Rule test paragraphs about phones and codes, plus generated lab-report-like lines full of numbers and dates."""
+    texts = _test_file_texts(DIGIT_HEAVY_FILES)
+    for _ in range(50):
+        lines = [f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(1990, 2025)} "
+                 f"prelievo n. {rng.randint(10000, 99999)}: valori {rng.uniform(0, 300):.1f} mg/dl, "
+                 f"{rng.randint(100, 999)}-{rng.randint(1000, 9999)}, tel. 3{rng.randint(10, 99)} {rng.randint(1000000, 9999999)}"
+                 for _ in range(rng.randint(3, 10))]
+        texts.append("\n".join(lines))
+    return texts
+
+
+def source_texts(corpus: str, seed: int = 42) -> list[str]:
+    """Returns the texts a corpus is sampled from."""
+    rng = random.Random(seed)
+    if corpus == "short_diaries":
+        return _synthetic_texts(DIARY_FILES)
+    if corpus == "long_reports":
+        return _synthetic_texts(REPORT_FILES)
+    if corpus == "entity_dense":
+        return _test_file_texts(ENTITY_DENSE_FILES)
+    if corpus == "digit_heavy":
+        return _digit_heavy_texts(rng)
+    raise ValueError(f"Unknown corpus '{corpus}'. Available corpora: {CORPORA}.")
+
+
+def build_corpus(corpus: str, n_docs: int, doc_chars: int = None, seed: int = 42) -> list[str]:
+    """
+    Samples n_docs documents from the given corpus. If doc_chars is given, every document is made of randomly chosen
+    source texts joined as paragraphs until it reaches doc_chars characters, then cut at the last whitespace.
+
+    :param corpus: One of CORPORA.
+    :param n_docs: Number of documents.
+    :param doc_chars: Approximate size of each document, or None to keep source texts as they are.
+    :param seed: Seed of the sampling.
+    """
+    rng = random.Random(seed)
+    sources = source_texts(corpus, seed)
+
+    if doc_chars is None:
+        return [rng.choice(sources) for _ in range(n_docs)]
+
+    docs = []
+    for _ in range(n_docs):
+        paragraphs, length = [], 0
+        while length < doc_chars:
+            paragraphs.append(rng.choice(sources))
+            length += len(paragraphs[-1]) + 2
+        text = "\n\n".join(paragraphs)[:doc_chars]
+        cut = text.rfind(" ")
+        docs.append(text[:cut] if cut > 0 else text)
+    return docs
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark of DOCX text extraction: the streaming reader of utils/reader_utils.py against python-docx, which builds
+the whole document tree before the paragraphs can be joined. Synthetic reports of growing size are generated with
+python-docx from the synthetic test samples, with a table every 50 paragraphs and a header and footer.
+Time and peak Python memory (tracemalloc) of each reader are reported, together with the number of paragraphs found.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from docx import Document
+
+from utils.reader_utils import iter_docx_paragraphs
+from benchmarks.corpora import source_texts
+
+
+def build_docx(path: str, n_paragraphs: int, seed: int = 42) -> None:
+    """Writes a report of n_paragraphs paragraphs sampled from the synthetic diaries, with tables, header and footer."""
+    rng = random.Random(seed)
+    texts = source_texts("short_diaries", seed)
+    document = Document()
+    document.sections[0].header.paragraphs[0].text = "Servizio per le Dipendenze - Relazione clinica"
+    document.sections[0].footer.paragraphs[0].text = "Documento riservato"
+    for i in range(n_paragraphs):
+        document.add_paragraph(rng.choice(texts))
+        if i % 50 == 49:
+            table = document.add_table(rows=3, cols=3)
+            for row in table.rows:
+                for cell in row.cells:
+                    cell.text = rng.choice(texts)[:80]
+    document.save(path)
+
+
+def python_docx_reader(path: str) -> int:
+    """The reader previously used by read_file: body paragraphs only."""
+    paragraphs = Document(path).paragraphs
+    "\n".join(paragraph.text for paragraph in paragraphs)
+    return len(paragraphs)
+
+
+def streaming_reader(path: str) -> int:
+    """Consumes the paragraphs one at a time, as the streaming pipeline does."""
+    return sum(1 for _ in iter_docx_paragraphs(path))
+
+
+def measure(reader, path: str) -> dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    paragraphs = reader(path)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": round(seconds, 4), "peak_mb": round(peak / (1024 * 1024), 2), "paragraphs": paragraphs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the streaming DOCX reader against python-docx.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="Numbers of paragraphs of the generated documents.")
+    parser.add_argument("--output", type=str, default="docx_benchmark_results.json", help="Path of the JSON results file.")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            path = os.path.join(tmp_dir, f"report_{size}.docx")
+            build_docx(path, size)
+            result = {"paragraphs": size, "file_mb": round(os.path.getsize(path) / (1024 * 1024), 2),
+                      "python_docx": measure(python_docx_reader, path), "streaming": measure(streaming_reader, path)}
+            results.append(result)
+            print(f"{size:>7} paragraphs ({result['file_mb']} MB): "
+                  f"python-docx {result['python_docx']['seconds']}s {result['python_docx']['peak_mb']}MB, "
+                  f"streaming {result['streaming']['seconds']}s {result['streaming']['peak_mb']}MB")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
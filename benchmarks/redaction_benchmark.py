@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the redaction writer on entity-dense documents, comparing the single-pass anonymize_doc and
+its streaming variant with the previous implementation rebuilding the whole string once per entity.
+"""
+
+import io
+import sys
+import timeit
+import argparse
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import spacy
+from spacy.tokens import Doc, Span
+
+from utils.anonymization_utils import anonymize_doc, write_anonymized_doc
+
+SENTENCE = "Il 12/03/2021 Mario Rossi ha incontrato Luca Bianchi a Milano e ne ha parlato con la dott.ssa Verdi."
+SENTENCE_ENTITIES = [(1, 2, "DATE"), (2, 4, "PATIENT"), (6, 8, "PER"), (9, 10, "GPE"), (17, 18, "PER")]
+
+
+def make_dense_doc(n_sentences: int) -> Doc:
+    """Builds a document repeating a sentence with five entities, n_sentences times."""
+    nlp = spacy.blank("it")
+    sentence_doc = nlp(SENTENCE)
+    words = [t.text for t in sentence_doc] * n_sentences
+    spaces = [bool(t.whitespace_) for t in sentence_doc]
+    spaces[-1] = True
+    doc = Doc(nlp.vocab, words=words, spaces=spaces * n_sentences)
+
+    size = len(sentence_doc)
+    doc.ents = [Span(doc, i * size + start, i * size + end, label=label)
+                for i in range(n_sentences) for start, end, label in SENTENCE_ENTITIES]
+    return doc
+
+
+def anonymize_doc_quadratic(doc: Doc, labels_to_anonymize=None) -> str:
+    """Previous implementation, copying the whole text once per replaced entity."""
+    labels_to_anonymize = set(ent.label_ for ent in doc.ents) if labels_to_anonymize is None else set(labels_to_anonymize)
+    text = doc.text
+    offsets = [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents if ent.label_ in labels_to_anonymize]
+    offsets.sort(reverse=True)
+    for start, end, label in offsets:
+        text = text[:start] + f"[{label}]" + text[end:]
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark anonymize_doc on entity-dense documents.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000], help="Document sizes in sentences.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs per measure (best is reported).")
+    args = parser.parse_args()
+
+    print(f"{'sentences':>10} {'chars':>9} {'entities':>9} {'quadratic (ms)':>15} {'single-pass (ms)':>17} {'streaming (ms)':>15}")
+    for n in args.sizes:
+        doc = make_dense_doc(n)
+        assert anonymize_doc(doc) == anonymize_doc_quadratic(doc)
+
+        def stream():
+            write_anonymized_doc(doc, io.StringIO())
+
+        timings = [min(timeit.repeat(fn, number=1, repeat=args.repeat)) * 1000
+                   for fn in (lambda: anonymize_doc_quadratic(doc), lambda: anonymize_doc(doc), stream)]
+        print(f"{n:>10} {len(doc.text):>9} {len(doc.ents):>9} {timings[0]:>15.2f} {timings[1]:>17.2f} {timings[2]:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
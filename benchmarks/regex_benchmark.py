@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Worst-case benchmark of the regex patterns used by the rules (rules/rules.py) and by the data cleaning
+(data_generation/mistakes_cleaner.py). Every pattern is run on families of pathological inputs of growing size,
+such as long digit runs, separator-only lines or OCR-like garbage without newlines, and the growth of the matching
+time with input size is reported, so that super-linear patterns can be spotted before they hang a worker.
+"""
+
+import os
+import ast
+import sys
+import json
+import math
+import time
+import random
+import argparse
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import regex as re
+
+from rules.rules import compiled_rule_patterns
+
+MISTAKES_CLEANER_PATH = os.path.join(PROJECT_ROOT, "data_generation/mistakes_cleaner.py")
+SUPER_LINEAR_EXPONENT = 1.5
+MIN_FLAGGED_SECONDS = 0.01  # growth between sub-millisecond timings is mostly noise
+
+
+def _repeat_to(unit: str, size: int) -> str:
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def _ocr_garbage(size: int, seed: int = 42) -> str:
+    """Random letters, digits, punctuation and spaces on a single line, as returned by text extraction of scanned PDFs."""
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZàèéìòù0123456789 .,;:-/()[]@'\"*"
+    return "".join(rng.choice(alphabet) for _ in range(size))
+
+
+INPUT_FAMILIES = {
+    "digits_spaces": lambda n: _repeat_to("1 ", n),
+    "digit_run": lambda n: _repeat_to("1234567890", n),
+    "digits_separators": lambda n: _repeat_to("12-34/56.78 (9)", n),
+    "dotted_labels": lambda n: _repeat_to("a.", n),
+    "alnum_dashes": lambda n: _repeat_to("A1-", n),
+    "email_like": lambda n: _repeat_to("a.b@", n),
+    "blank_lines": lambda n: _repeat_to(" \n\t", n),
+    "punctuation_spaces": lambda n: _repeat_to(". ", n),
+    "capitalized_words": lambda n: _repeat_to("Rossi ", n),
+    "brackets": lambda n: _repeat_to("[A1", n),
+    "ocr_garbage": _ocr_garbage,
+}
+
+
+def mistakes_cleaner_patterns() -> dict[str, re.Pattern]:
+    """
+    Compiles the module-level '*_pattern' string constants of mistakes_cleaner.py. The module is parsed rather than
+    imported, since it depends on the data generation environment (e.g. Faker). Fragments that do not compile
+    on their own are skipped.
+    """
+    with open(MISTAKES_CLEANER_PATH, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    patterns = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name.endswith("_pattern") or name.startswith("common_"):
+                try:
+                    value = ast.literal_eval(node.value)
+                except ValueError:
+                    continue
+                if not isinstance(value, str):
+                    continue
+                try:
+                    patterns[f"mistakes_cleaner.{name}"] = re.compile(value, re.IGNORECASE)
+                except re.error:
+                    continue  # fragment only valid once combined with other patterns
+    return patterns
+
+
+def time_pattern(pattern: re.Pattern, text: str, timeout: float) -> float | None:
+    """Returns the seconds needed to find all matches of the pattern in the text, or None if timeout is exceeded."""
+    start = time.perf_counter()
+    try:
+        for _ in pattern.finditer(text, timeout=timeout):
+            pass
+    except TimeoutError:
+        return None
+    return time.perf_counter() - start
+
+
+def growth_exponent(sizes: list[int], timings: list[float | None]) -> float | None:
+    """Estimates k in time ~ size^k from the two largest sizes with a measure (infinite if the largest timed out)."""
+    if timings[-1] is None:
+        return math.inf
+    measured = [(n, t) for n, t in zip(sizes, timings) if t]
+    if len(measured) < 2:
+        return None
+    (n1, t1), (n2, t2) = measured[-2], measured[-1]
+    return math.log(t2 / t1) / math.log(n2 / n1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rule and cleaning regexes on pathological inputs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Input sizes in characters.")
+    parser.add_argument("--families", nargs="+", choices=list(INPUT_FAMILIES), default=list(INPUT_FAMILIES), help="Input families to generate.")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Maximum seconds per pattern and input.")
+    parser.add_argument("--include-dictionaries", action="store_true", help="Also benchmark the (slow to compile) dictionary patterns.")
+    parser.add_argument("--output", type=str, default="regex_benchmark_results.json", help="Path of the JSON results file.")
+    args = parser.parse_args()
+
+    sizes = sorted(args.sizes)
+    patterns = {**compiled_rule_patterns(args.include_dictionaries), **mistakes_cleaner_patterns()}
+    results = []
+
+    for name, pattern in patterns.items():
+        for family in args.families:
+            timings = [time_pattern(pattern, INPUT_FAMILIES[family](size), args.timeout) for size in sizes]
+            exponent = growth_exponent(sizes, timings)
+            flagged = exponent is not None and exponent > SUPER_LINEAR_EXPONENT \
+                      and (timings[-1] is None or timings[-1] >= MIN_FLAGGED_SECONDS)
+            results.append({"pattern": name, "family": family, "sizes": sizes,
+                            "seconds": [None if t is None else round(t, 6) for t in timings],
+                            "growth_exponent": None if exponent is None or math.isinf(exponent) else round(exponent, 2),
+                            "timed_out": timings[-1] is None, "super_linear": flagged})
+            if flagged:
+                shown = ", ".join("timeout" if t is None else f"{t * 1000:.1f}ms" for t in timings)
+                print(f"SUPER-LINEAR {name:<45} {family:<20} {shown}")
+
+    print(f"{sum(r['super_linear'] for r in results)} super-linear cases out of {len(results)} "
+          f"({len(patterns)} patterns x {len(args.families)} input families).")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput and latency benchmark of the anonymization pipeline.
+
+Every combination of corpus, target (full 'anonymize', 'rules' alone or 'ner' alone), batch size and worker count
+runs in a fresh process, so that peak RSS and model warm-up are measured independently for each configuration.
+Results are written to a JSON file to compare commits.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import spacy
+
+from config import DEFAULT_NER_MODEL, DEFAULT_ENTITIES
+from rules.rules import apply_rules
+from utils.batch_utils import anonymize_texts, run_pipeline, iter_batches
+from benchmarks.corpora import CORPORA, build_corpus
+
+TARGETS = ["anonymize", "rules", "ner"]
+BLANK_MODEL = "blank"
+
+_state = {}
+
+
+def load_nlp(model: str):
+    """Loads the given model, or a blank Italian pipeline (tokenizer only) for 'blank'."""
+    return spacy.blank("it") if model == BLANK_MODEL else spacy.load(model)
+
+
+def _init_state(model: str, target: str, per_matching: bool, batch_size: int) -> None:
+    _state.update(nlp=load_nlp(model), target=target, per_matching=per_matching, batch_size=batch_size)
+
+
+def _process_chunk(texts: list[str]) -> list[float]:
+    """
+    Processes a chunk of texts with the configured target and returns the latency of each text in seconds.
+    Batched targets report the duration of the whole batch for each of its texts, i.e. their time to result.
+    """
+    nlp, target, batch_size = _state["nlp"], _state["target"], _state["batch_size"]
+    if target == "rules":
+        latencies = []
+        for text in texts:
+            start = time.perf_counter()
+            apply_rules(nlp.make_doc(text), _state["per_matching"])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    if target == "ner":
+        run_pipeline(nlp, texts, batch_size)
+    else:
+        list(anonymize_texts(nlp, texts, DEFAULT_ENTITIES, _state["per_matching"], batch_size=batch_size))
+    return [time.perf_counter() - start] * len(texts)
+
+
+def peak_rss_mb(who: int) -> float | None:
+    """Returns the peak resident set size in MB of the current process or of its terminated children."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_configuration(config: dict) -> dict:
+    """Runs one benchmark configuration in the current process and returns its measures."""
+    texts = build_corpus(config["corpus"], config["n_docs"], config["doc_chars"])
+    chunks = list(iter_batches(texts, config["batch_size"]))
+    init_args = (config["model"], config["target"], config["per_matching"], config["batch_size"])
+
+    if config["workers"] == 1:
+        _init_state(*init_args)
+        _process_chunk(chunks[0])  # warm-up
+        start = time.perf_counter()
+        latencies = [latency for chunk in chunks for latency in _process_chunk(chunk)]
+        wall = time.perf_counter() - start
+    else:
+        with ProcessPoolExecutor(config["workers"], initializer=_init_state, initargs=init_args) as executor:
+            list(executor.map(_process_chunk, chunks[:config["workers"]]))  # warm-up
+            start = time.perf_counter()
+            latencies = [latency for result in executor.map(_process_chunk, chunks) for latency in result]
+            wall = time.perf_counter() - start
+
+    latencies.sort()
+    chars = sum(len(text) for text in texts)
+    return {
+        **config,
+        "chars": chars,
+        "wall_seconds": round(wall, 4),
+        "docs_per_second": round(len(texts) / wall, 2),
+        "chars_per_second": round(chars / wall, 1),
+        "latency_ms": {f"p{q}": round(percentile(latencies, q) * 1000, 2) for q in (50, 95, 99)},
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "peak_worker_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource and config["workers"] > 1 else None,
+    }
+
+
+def _configuration_process(config: dict, queue) -> None:
+    try:
+        queue.put(run_configuration(config))
+    except Exception as e:
+        queue.put({**config, "error": repr(e)})
+
+
+def run_isolated(config: dict) -> dict:
+    """Runs a configuration in a freshly spawned process, so that its peak RSS is not affected by previous runs."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_configuration_process, args=(config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark throughput and latency of the anonymization pipeline.")
+    parser.add_argument("--corpora", nargs="+", choices=CORPORA, default=CORPORA, help="Corpora to benchmark.")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS, help="Pipeline parts to benchmark.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32], help="Batch sizes to benchmark.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="Worker process counts to benchmark.")
+    parser.add_argument("--n-docs", type=int, default=200, help="Number of documents per corpus.")
+    parser.add_argument("--doc-chars", type=int, default=None, help="Approximate size of each document in characters (default: source texts as they are).")
+    parser.add_argument("--model", type=str, default=DEFAULT_NER_MODEL, help=f"spaCy model path, or '{BLANK_MODEL}' for a tokenizer-only pipeline.")
+    parser.add_argument("--per-matching", action="store_true", help="Enable dictionary matching for PER and PATIENT entities.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="Path of the JSON results file.")
+    args = parser.parse_args()
+
+    results = []
+    for corpus in args.corpora:
+        for target in args.targets:
+            # batch size does not affect rules, applied one document at a time
+            batch_sizes = args.batch_sizes if target != "rules" else args.batch_sizes[:1]
+            for batch_size in batch_sizes:
+                for workers in args.workers:
+                    config = {"corpus": corpus, "target": target, "batch_size": batch_size, "workers": workers,
+                              "n_docs": args.n_docs, "doc_chars": args.doc_chars, "model": args.model,
+                              "per_matching": args.per_matching}
+                    result = run_isolated(config)
+                    results.append(result)
+                    if "error" in result:
+                        print(f"{corpus:>14} {target:>9} batch={batch_size:<3} workers={workers:<2} ERROR {result['error']}")
+                    else:
+                        print(f"{corpus:>14} {target:>9} batch={batch_size:<3} workers={workers:<2} "
+                              f"{result['docs_per_second']:>9.1f} docs/s {result['chars_per_second']:>11.0f} chars/s "
+                              f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                              f"p99={result['latency_ms']['p99']}ms rss={result['peak_rss_mb']}MB")
+
+    report = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "platform": platform.platform(), "cpu_count": os.cpu_count(), "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the streaming anonymization of large plain-text files: concatenated note dumps of growing size are
+generated from the synthetic test samples and anonymized chunk by chunk (memory-mapped input, incremental output),
+each size in a fresh process. Peak RSS should stay flat as the file grows, since only a batch of chunks is held in
+memory at a time. Throughput and peak RSS above the loaded pipeline are reported for every size.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from config import DEFAULT_ENTITIES, DEFAULT_BATCH_SIZE
+from utils.reader_utils import iter_text_chunks
+from utils.batch_utils import label_chunks, write_anonymized_chunks
+from benchmarks.corpora import source_texts
+from benchmarks.throughput_benchmark import BLANK_MODEL, load_nlp, peak_rss_mb, resource
+
+
+def build_dump(path: str, size_mb: float, seed: int = 42) -> None:
+    """Writes a dump of about size_mb megabytes of synthetic diaries separated by blank lines."""
+    rng = random.Random(seed)
+    texts = source_texts("short_diaries", seed)
+    target, written = int(size_mb * 1024 * 1024), 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            text = rng.choice(texts) + "\n\n"
+            f.write(text)
+            written += len(text.encode("utf-8"))
+
+
+def run_size(config: dict) -> dict:
+    """Anonymizes one dump in the current process and returns its measures."""
+    nlp = load_nlp(config["model"])
+    list(label_chunks(nlp, ["Warm-up del modello."], DEFAULT_ENTITIES, config["per_matching"]))
+    base_rss = peak_rss_mb(resource.RUSAGE_SELF) if resource else None
+
+    start = time.perf_counter()
+    labelled = label_chunks(nlp, iter_text_chunks(config["path"]), DEFAULT_ENTITIES, config["per_matching"],
+                            batch_size=config["batch_size"])
+    with open(os.devnull, "w", encoding="utf-8") as f:
+        write_anonymized_chunks(labelled, f)
+    seconds = time.perf_counter() - start
+
+    peak_rss = peak_rss_mb(resource.RUSAGE_SELF) if resource else None
+    return {"size_mb": config["size_mb"], "seconds": round(seconds, 2),
+            "mb_per_second": round(config["size_mb"] / seconds, 3), "base_rss_mb": base_rss, "peak_rss_mb": peak_rss,
+            "rss_growth_mb": round(peak_rss - base_rss, 1) if resource else None}
+
+
+def _size_process(config: dict, queue) -> None:
+    try:
+        queue.put(run_size(config))
+    except Exception as e:
+        queue.put({"size_mb": config["size_mb"], "error": repr(e)})
+
+
+def run_isolated(config: dict) -> dict:
+    """Runs a size in a freshly spawned process, so that its peak RSS is not affected by the previous ones."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_size_process, args=(config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the memory of streaming anonymization of large .txt files.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 16], help="Sizes of the generated dumps in MB.")
+    parser.add_argument("--model", type=str, default=BLANK_MODEL, help="Model path, or 'blank' for tokenizer and rules only.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Number of chunks labelled together.")
+    parser.add_argument("--per-matching", action="store_true", help="Enable the dictionary matching of PER and PATIENT entities.")
+    parser.add_argument("--output", type=str, default="txt_benchmark_results.json", help="Path of the JSON results file.")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            path = os.path.join(tmp_dir, f"dump_{size}.txt")
+            build_dump(path, size)
+            result = run_isolated({"path": path, "size_mb": size, "model": args.model, "batch_size": args.batch_size,
+                                   "per_matching": args.per_matching})
+            results.append(result)
+            os.remove(path)
+            if "error" in result:
+                print(f"{size:>8} MB: failed with {result['error']}")
+            else:
+                print(f"{size:>8} MB: {result['seconds']}s ({result['mb_per_second']} MB/s), "
+                      f"peak RSS {result['peak_rss_mb']}MB (+{result['rss_growth_mb']}MB over the loaded pipeline)")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,43 @@
 DEFAULT_NER_MODEL = "NER/models/deployed/deployed_v2.2"
 DEFAULT_ENTITIES = ["PATIENT", "PER", "LOC", "ORG", "FAC", "GPE", "PROV", "DATE", "NORP", "CODE", "MAIL", "PHONE", "URL"]
 DEFAULT_EXTRA_PER_MATCHING = False
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_WORKERS = 1
+DEFAULT_RULE_TIMEOUT = 10.0  # seconds each rule can spend on a single document
+DEADLINE_INITIAL_CHARS_PER_SECOND = 2000.0  # model throughput assumed by --deadline until the first chunk is labelled
+DEADLINE_MIN_RULE_SECONDS = 0.05  # timeout of each rule in the rules-only fallback of --deadline once the budget is spent
+WARMUP_DOCUMENT_CHARS = [300, 2000, 5000]  # lengths of the synthetic documents run through the pipeline by --warmup
+DEFAULT_PDF_WORKERS = 1
+DEFAULT_MAX_TASKS_PER_WORKER = 0  # tasks after which a batch worker process is replaced by a fresh one (0 for never)
+DEFAULT_MAX_WORKER_RSS_MB = 0  # resident memory above which a batch worker process is replaced (0 for no limit)
+DEFAULT_READER_THREADS = 2  # threads reading files ahead of the model in single-process batch mode (0 disables the staged pipeline)
+DEFAULT_READ_QUEUE_SIZE = 16  # files read ahead of the model
+DEFAULT_WRITE_QUEUE_SIZE = 16  # labelled files waiting for the writer thread
+PIPELINE_STREAM_MIN_BYTES = 1024 * 1024  # larger files (and archives, multi-patient exports) are streamed by the model stage
+DEFAULT_OUTPUT_FORMAT = "text"
+OUTPUT_FORMATS = ["text", "standoff", "standoff-binary"]
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".json", ".jsonl", ".txt")
+MANIFEST_FILENAME = ".anonymization_manifest.sqlite"
+PDF_PAGE_SEPARATOR = "\f"  # form feed, kept between the pages of anonymized PDFs
+PDF_PAGES_PER_TASK = 8
+SCHEDULER_PART_CHARS = 500_000  # with several workers, longer .txt and PDF files are split into parts of about this size
+COST_PER_BYTE = {".txt": 1.0, ".json": 0.8, ".jsonl": 0.8, ".docx": 1.5, ".pdf": 0.2}  # rough characters of text per byte
+COMPRESSED_COST_FACTOR = 4  # rough compression ratio of compressed files and archives, when estimating their cost
+DEFAULT_LEASE_SECONDS = 300.0  # lease of a file claimed from a shared --queue, renewed while the worker is alive
+QUEUE_MAX_ATTEMPTS = 3  # files whose lease expired this many times (e.g. crashing their worker) are marked as failed
+QUEUE_PROGRESS_SECONDS = 30.0  # interval of the queue progress messages
+QUEUE_POLL_SECONDS = 5.0  # idle workers wait this long before checking again for expired leases of other workers
+DOCX_CHUNK_CHARS = 5000  # paragraphs of DOCX files are labelled in chunks of about this size
+TXT_CHUNK_BYTES = 5000  # size bound of the paragraph-aligned chunks large .txt files are streamed in
+SINK_BATCH_ENTRIES = 256  # output sink entries handed to the writer thread together
+SINK_BATCH_BYTES = 4 * 1024 * 1024
+SINK_QUEUE_BATCHES = 4  # batches waiting for the writer thread before producers block
+PREFETCH_ITEMS = 8  # chunks or archive members read and decompressed ahead of the model by the reader thread
+ARCHIVE_PREFETCH_MEMBERS = 2  # archive members held in memory ahead of the one being anonymized
+DEFAULT_CACHE_MAX_MB = 1024
+DEFAULT_INCREMENTAL_MARGIN = 1  # unchanged paragraphs relabelled around each edit, as context for the model
+DEFAULT_PARAGRAPH_MEMO_SIZE = 100_000  # paragraphs whose spans are kept in memory when deduplicating
 
 PATIENT_DATA_FIELDS = ["anagrafica", "testi"]
 SINGLE_TEXT_FIELDS = ["tipo", "testo"]
@@ -13,4 +50,6 @@ PERSONAL_DATA_FORMAT = {
     "nazione_residenza": "GPE",
     "luogo_residenza": "GPE",
     "prov_residenza": "PROV"
-}
\ No newline at end of file
+}
+PERSONAL_DATA_INITIALS = False  # also mask the bare initials of the patient (e.g. 'M.R.'), which collide with abbreviations like 'P.S.'
+REGISTRY_PLACE_FIELDS = ["luogo_nascita", "luogo_residenza"]  # anagrafica places matched by --patient-registry
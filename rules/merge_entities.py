@@ -22,14 +22,24 @@ label_patterns = {  # label_patterns for merging overlapping or adjacent entitie
     ("EMAIL", "ORG"): "MAIL",
     ("PER", "MAIL"): "MAIL",
     ("EMAIL", "PER"): "MAIL",
+    ("PATIENT", "MAIL"): "MAIL",
+    ("MAIL", "PATIENT"): "MAIL",
+    ("PATIENT", "URL"): "URL",
+    ("URL", "PATIENT"): "URL",
     ("URL", "ORG"): "URL",
     ("ORG", "URL"): "URL"
 }
 
+def _merged_span(doc: Doc, first: Span, second: Span, label: str) -> Span:
+    """Returns the span covering both given spans with the given label, keeping the id of the span providing the label."""
+    span_id = first.id if first.label_ == label or second.label_ != label else second.id
+    return Span(doc, first.start, second.end, label=label, span_id=span_id)
+
 def merged_entity_spans(new_entities: list[Span], doc: Doc) -> Doc:
     """
     Merges overlapping spans of the given doc emerging from the new entities, splitting spans in non-overlapping parts
     in the general case and merging adjacent or space-separated spans with the same label or according to predefined patterns.
+    Merged spans keep the id (i.e. the source) of the span whose label they take.
     """
     all_spans = list(doc.ents) + new_entities
     if not all_spans:
@@ -51,10 +61,10 @@ def merged_entity_spans(new_entities: list[Span], doc: Doc) -> Doc:
                 continue
             label = label_patterns.get((current.label_, next_span.label_))
             if label:  # pattern-based merge
-                new = Span(doc, current.start, next_span.end, label=label)
+                new = _merged_span(doc, current, next_span, label)
             else:  # fallback: keep longest label
                 longest = current if (current.end-current.start) >= (next_span.end-next_span.start) else next_span
-                new = Span(doc, current.start, next_span.end, label=longest.label_)
+                new = _merged_span(doc, current, next_span, longest.label_)
 
             if new is not None:
                 current = new
@@ -68,7 +78,7 @@ def merged_entity_spans(new_entities: list[Span], doc: Doc) -> Doc:
                 label = label_patterns.get((current.label_, next_span.label_))
 
             if label:
-                new = Span(doc, current.start, next_span.end, label=label)
+                new = _merged_span(doc, current, next_span, label)
                 if new is not None:
                     current = new
                 continue
@@ -0,0 +1,143 @@
+import os
+import hashlib
+import time
+from functools import lru_cache
+from typing import Iterator
+
+import regex as re
+
+from config import PERSONAL_DATA_FORMAT, PATIENT_DATA_FIELDS, REGISTRY_PLACE_FIELDS
+from rules.prepare_dictionaries import load_wordlist
+from utils.json_utils import iter_json_records
+from utils.profiling_utils import profile_stage
+
+_WORD = re.compile(r"\w+")
+_GAP = re.compile(r"[\s'’\-]{1,3}")  # what may separate the words of a registered phrase in the text
+_AMBIGUOUS_PLACES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dictionaries_processed",
+                                      "comuni_it_ambiguous.txt")
+
+
+class PatientRegistry:
+    """
+    Index of the names, birthplaces and residences of all the patients of a registry (a JSON array or JSON Lines file
+    of 'anagrafica' dictionaries, or of records holding one), matched against a text in a single pass.
+    Phrases are indexed by their case-folded words: for each word of the text, only the registered phrases starting
+    with it are looked up, longest first, so matching time does not depend on the size of the registry.
+    Full names match in both orders and are labelled PATIENT, places keep their PERSONAL_DATA_FORMAT label (GPE).
+    Places only match when capitalized in the text, and places that are also common Italian words (the ambiguous
+    comuni dictionary, e.g. 'Medicina', 'Campagna') are not indexed, since with thousands of patients they would be
+    masked in every document.
+    The index is built once and rebuilt by reload only when the registry file changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.phrases: dict[str, str] = {}      # case-folded words joined by spaces -> label
+        self.places: set[str] = set()          # phrases that are only places, matched when capitalized
+        self.max_words: dict[str, int] = {}    # first word -> number of words of the longest phrase starting with it
+        self.patients = 0
+        self.checksum = None
+        self._stat = None
+        self.reload()
+
+    def reload(self) -> bool:
+        """Rebuilds the index if the registry file changed since it was last loaded, returning whether it did."""
+        stat = os.stat(self.path)
+        if (stat.st_size, stat.st_mtime_ns) == self._stat:
+            return False
+        with profile_stage("load_patient_registry"):
+            phrases, places, max_words, patients = {}, set(), {}, 0
+            for record in iter_json_records(self.path):
+                data = record.get(PATIENT_DATA_FIELDS[0], record) if isinstance(record, dict) else None
+                if not isinstance(data, dict):
+                    continue
+                patients += 1
+                for words, label in self._record_phrases(data):
+                    key = " ".join(words)
+                    if phrases.get(key) != "PATIENT":  # a phrase that is also a name stays a name
+                        phrases[key] = label
+                    if label == "PATIENT":
+                        places.discard(key)
+                    elif phrases[key] == label:
+                        places.add(key)
+                    max_words[words[0]] = max(max_words.get(words[0], 0), len(words))
+            digest = hashlib.sha256()
+            with open(self.path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+        self.phrases, self.places, self.max_words = phrases, places, max_words
+        self.patients, self.checksum = patients, digest.hexdigest()
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        return True
+
+    @staticmethod
+    def _record_phrases(data: dict) -> Iterator[tuple[list[str], str]]:
+        names = _words(data.get("nome"))
+        surnames = _words(data.get("cognome"))
+        if names and surnames:
+            yield names + surnames, "PATIENT"
+            yield surnames + names, "PATIENT"
+        for field in REGISTRY_PLACE_FIELDS:
+            if (words := _words(data.get(field))) and " ".join(words) not in _ambiguous_places():
+                yield words, PERSONAL_DATA_FORMAT[field]
+
+    def find(self, text: str, deadline: float = None) -> Iterator[tuple[int, int, str]]:
+        """
+        Yields the (start, end, label) character spans of the registered phrases found in the text, keeping only the
+        longest phrase starting at each word, among the names and the capitalized places. Raises TimeoutError once
+        time.monotonic() exceeds the deadline.
+        """
+        words = [(match.start(), match.end(), match.group().casefold()) for match in _WORD.finditer(text)]
+        for i, (start, _, word) in enumerate(words):
+            if deadline is not None and i % 1024 == 0 and time.monotonic() > deadline:
+                raise TimeoutError
+            longest = self.max_words.get(word, 0)
+            for n in range(min(longest, len(words) - i), 0, -1):
+                phrase = words[i:i + n]
+                key = " ".join(w for _, _, w in phrase)
+                label = self.phrases.get(key)
+                if label is not None and (key not in self.places or text[start].isupper()) and all(_GAP.fullmatch(text, previous[1], following[0])
+                                             for previous, following in zip(phrase, phrase[1:])):
+                    yield start, phrase[-1][1], label
+                    break
+
+    def __len__(self) -> int:
+        return len(self.phrases)
+
+
+def _words(value) -> list[str]:
+    return [word.casefold() for word in _WORD.findall(str(value))] if value else []
+
+
+@lru_cache(maxsize=None)
+def _ambiguous_places() -> frozenset[str]:
+    """Comuni whose names are also common Italian words, which registry places are not matched against."""
+    if not os.path.isfile(_AMBIGUOUS_PLACES_PATH):
+        return frozenset()
+    return frozenset(" ".join(_words(place)) for place in load_wordlist(_AMBIGUOUS_PLACES_PATH))
+
+
+_active_registry: PatientRegistry | None = None
+
+
+def get_patient_registry() -> PatientRegistry | None:
+    """Returns the registry every document is matched against, if any."""
+    return _active_registry
+
+
+def set_patient_registry(registry: PatientRegistry | None) -> None:
+    """Activates the given registry for the whole process (None disables registry matching)."""
+    global _active_registry
+    _active_registry = registry
+
+
+def load_patient_registry(path: str) -> PatientRegistry:
+    """
+    Activates the registry at the given path, reusing the active one, reloaded if its file changed, when it comes
+    from the same path.
+    """
+    if _active_registry is not None and os.path.abspath(_active_registry.path) == os.path.abspath(path):
+        _active_registry.reload()
+    else:
+        set_patient_registry(PatientRegistry(path))
+    return _active_registry
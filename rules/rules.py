@@ -1,16 +1,22 @@
 import os
 import sys
+import hashlib
+import time
 from pathlib import Path
 import regex as re
 
 import unicodedata
+import warnings
+from functools import lru_cache
 import spacy
 from spacy.tokens import Doc, Span
 from typing import List
-from config import PERSONAL_DATA_FORMAT
+from config import PERSONAL_DATA_FORMAT, PERSONAL_DATA_INITIALS, DEFAULT_RULE_TIMEOUT
 
 from rules.prepare_dictionaries import load_wordlist
 from rules.merge_entities import merged_entity_spans
+from rules.patient_registry import get_patient_registry
+from utils.profiling_utils import profile_stage, profile_count
 
 # Ensures project root is on sys.path
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
@@ -34,9 +40,12 @@ url_tag = "URL"
 prov_tag = "PROV"
 code_tag = "CODE"
 
+personal_data_source = "personal_data"
+registry_source = "patient_registry"
+
 common_ambiguous_names = "[Mm]arco|[Ll]uca|[Ff]rancesco|[Pp]aolo|[Pp]aolino|Pasquale|Omero|[Ll]aura|Linda|Aurora|[Dd]ante|[Dd]iana|[Mm]aria|[Ll]ucia|Bruno|Viola|Angelo|Angela|[Aa]ugusto|[Ss]ilvia|[Ss]ilvio|[Ss]andra|Roman[oa]|Diletta|Fede|[Ll]idia|Gloria|[Pp]iero|[Rr]enat[oa]|Franco|[Ll]eo|[Mm]attia|Marino|Giada|[Rr]occo|[Vv]anessa|[Ss]auro|[Aa]lessia|Violetta|Massimo|[Cc]laudia|[Vv]eronica|[Vv]ittorio|Vittoria|[Pp]enelope|[Pp]atrizi[oa]|[Gg]raziano|Grazia|Cristian[oa]|[Ff]ilippo|[Ff]abiano|[Mm]oira|[Rr]affaella|[Ee]lisa|[Ll]isa|[Ll]azzaro|[Gg]iacinto|Salvatore|Stella|Fausto|[Tt]iziano|[Mm]immo|Italo|Guido|[Ii]do|[Mm]aia|Luna|[Cc]iro|[Cc]aio|[Aa]melia|[Mm]elissa|Gustavo"
 
-email_re = r"[A-Za-z0-9._%+-]+@+[A-Za-z0-9.-]+\.[A-Za-z]{2,}"
+email_re = re.compile(r"[A-Za-z0-9._%+-]+@+[A-Za-z0-9.-]+\.[A-Za-z]{2,}", re.IGNORECASE)
 
 phone_re = re.compile(r"""
 (?:(?<=^)|(?<=[\s.,;:()]))                                        # allowed delimiter
@@ -93,137 +102,323 @@ codes_re = re.compile(r"""
 """, re.VERBOSE | re.IGNORECASE)
 
 
+common_ambiguous_names_re = re.compile(r"\b(?:" + common_ambiguous_names + r")\b")
+
+if not Doc.has_extension("rule_timeouts"):
+    Doc.set_extension("rule_timeouts", default=None)
+
+
 def _get_file_path(entities: str, ambiguous: bool = False) -> str:
     suffix = "ambiguous" if ambiguous else "not_ambiguous"
     return os.path.join(processed_dictionaries_path, f"{entities}_it_{suffix}.txt")
 
 
-def _collect_entity_spans_from_regex(doc: Doc, pattern: str | re.Pattern[str], tag: str, flags = 0) -> list[Span]:
+def _get_source_name(path: str) -> str:
+    """Returns the rule name of a dictionary-based rule, i.e. the dictionary file name without extension."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _collect_entity_spans_from_regex(doc: Doc, pattern: str | re.Pattern[str], tag: str, flags = 0, source: str = None,
+                                     timeout: float = None) -> list[Span]:
     """
     Enriches the Doc with entities found by regex. Possible conflicts with existing entities are resolved by
     merging overlapping spans and preferring the longest span label.
+    The name of the rule producing the spans, if given, is stored as their span id.
+    If matching takes longer than timeout seconds, the spans found so far are kept and the rule is recorded
+    in the doc._.rule_timeouts list instead of blocking the caller.
     """
     # normalize to NFC so composed/decomposed forms match consistently
     text_nfc = unicodedata.normalize("NFC", doc.text)
     # collect spans for entities found by regex
     new_entities = []
 
-    def replacer(match):
-        start, end = (match.start(1), match.end(1)) if match.lastindex else (match.start(), match.end())
-        span = doc.char_span(start, end, label=tag, alignment_mode="expand")
-        if span is not None:
-            new_entities.append(span)
+    with profile_stage(source or tag, len(text_nfc)):
+        try:
+            for match in re.finditer(pattern, text_nfc, flags=flags, timeout=timeout):
+                start, end = (match.start(1), match.end(1)) if match.lastindex else (match.start(), match.end())
+                span = doc.char_span(start, end, label=tag, alignment_mode="expand", span_id=source or 0)
+                if span is not None:
+                    new_entities.append(span)
+        except TimeoutError:
+            _record_rule_timeout(doc, source or tag, timeout)
+
+    return new_entities
 
-        return f"[{tag}]"
 
-    re.sub(pattern, replacer, text_nfc, flags=flags)
+def _record_rule_timeout(doc: Doc, rule: str, timeout: float) -> None:
+    doc._.rule_timeouts = get_rule_timeouts(doc) + [rule]
+    profile_count(f"rule_timeout:{rule}")
+    warnings.warn(f"Rule '{rule}' exceeded its {timeout}s timeout on a document of {len(doc.text)} characters; "
+                  f"the document has been flagged and only the matches found so far are kept.", RuntimeWarning)
 
-    return new_entities
 
-def _mask_not_ambiguous_entities(doc: Doc, dictionary: List[str], tag: str, flags = 0) -> list[Span]:
+def get_rule_timeouts(doc: Doc) -> list[str]:
+    """Returns the names of the rules that exceeded their timeout on the given doc."""
+    return doc._.rule_timeouts or []
+
+
+def _not_ambiguous_entities_pattern(dictionary: List[str]) -> str:
     """
     Finds exact names from the given dictionary (case-insensitive, preserves accents).
     Longer names are placed first to avoid partial matches (e.g. 'Marco Antonio' before 'Marco').
     It is assumed that the dictionary is sorted by length descending.
     """
-    if not dictionary:
-        return []
+    return r"\b(?:" + "|".join(re.escape(n) for n in dictionary) + r")\b"
 
-    pattern = r"\b(?:" + "|".join(re.escape(n) for n in dictionary) + r")\b"
-    return _collect_entity_spans_from_regex(doc, pattern, tag, flags)
-
-
-def _mask_ambiguous_entities(doc: Doc, dictionary: List[str], tag: str, flags = 0) -> list[Span]:
-    if not dictionary:
-        return []
 
+def _ambiguous_entities_pattern(dictionary: List[str]) -> str:
     capitalized_dic = [t.capitalize() for t in dictionary if t]
     capitalized_dic += [t.upper() for t in dictionary if t]
-    pattern = ( # ensure not at start of sentence or after punctuation or paragraph break
+    return ( # ensure not at start of sentence or after punctuation or paragraph break
             r"(?<!^)"
             r"(?<!\n[\s\t]*\n[\s\t\n]*)"
             r"(?<![-\.!?:;·…»«>\n][\s\t\n]*)"
             r"\b(?:" + "|".join(re.escape(t) for t in capitalized_dic) + r")\b"
     )
-    return _collect_entity_spans_from_regex(doc, pattern, tag, flags)
 
 
-def _mask_province(doc: Doc, path: str, ambiguous: bool) -> list[Span]:
-    """Mask province names by checking if they appear in capitalized form. If ambiguous, also check they are sorrounded by parentheses."""
-    tokens = load_wordlist(path)
+@lru_cache(maxsize=None)
+def _dictionary_pattern(path: str, ambiguous: bool) -> re.Pattern | None:
+    """
+    Loads a dictionary and compiles it into a single pattern, once per process.
+    Not ambiguous entries match case-insensitively, ambiguous ones only when capitalized and not at sentence start.
+    """
+    with profile_stage("load_wordlist"):
+        word_list = load_wordlist(path)
+    if not word_list:
+        return None
+    return re.compile(_ambiguous_entities_pattern(word_list)) if ambiguous \
+        else re.compile(_not_ambiguous_entities_pattern(word_list), re.IGNORECASE)
+
+
+@lru_cache(maxsize=None)
+def _province_pattern(path: str, ambiguous: bool) -> re.Pattern | None:
+    """Province names in capitalized form. If ambiguous, they must also be surrounded by parentheses."""
+    with profile_stage("load_wordlist"):
+        tokens = load_wordlist(path)
     if not tokens:
-        return []
+        return None
 
     capitalized_tokens = [t.upper() for t in tokens if t]
-    pattern = r"\(\s*(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\s*\)" if ambiguous \
-        else r"\b(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\b"
-    return _collect_entity_spans_from_regex(doc, pattern, prov_tag)
+    return re.compile(r"\(\s*(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\s*\)" if ambiguous
+                      else r"\b(" + "|".join(re.escape(t) for t in capitalized_tokens) + r")\b")
+
+
+def _mask_province(doc: Doc, path: str, ambiguous: bool, timeout: float = None) -> list[Span]:
+    """Mask province names by checking if they appear in capitalized form. If ambiguous, also check they are sorrounded by parentheses."""
+    pattern = _province_pattern(path, ambiguous)
+    if pattern is None:
+        return []
+    return _collect_entity_spans_from_regex(doc, pattern, prov_tag, source=_get_source_name(path), timeout=timeout)
 
-def _mask_ambiguous_common_names(doc: Doc) -> list[Span]:
+def _mask_ambiguous_common_names(doc: Doc, timeout: float = None) -> list[Span]:
     """
     Mask common ambiguous names according to the regex capitalization in any possible position (even start of sentence).
     """
-    pattern = r"\b(?:" + common_ambiguous_names + r")\b"
-    return _collect_entity_spans_from_regex(doc, pattern, per_tag)
+    return _collect_entity_spans_from_regex(doc, common_ambiguous_names_re, per_tag, source="common_ambiguous_names",
+                                            timeout=timeout)
 
 
-def _mask_entities_in_text(doc: Doc, file: str, tag: str, ambguous: bool = False) -> list[Span]:
+def _mask_entities_in_text(doc: Doc, file: str, tag: str, ambguous: bool = False, timeout: float = None) -> list[Span]:
     """
     Mask entities in the text using both not ambiguous and ambiguous masking.
     """
-    word_list = load_wordlist(file)
-    masked_ents = _mask_ambiguous_entities(doc, word_list, tag) if ambguous \
-        else _mask_not_ambiguous_entities(doc, word_list, tag, re.IGNORECASE)
+    pattern = _dictionary_pattern(file, ambguous)
+    if pattern is None:
+        return []
+    return _collect_entity_spans_from_regex(doc, pattern, tag, source=_get_source_name(file), timeout=timeout)
 
-    return masked_ents
 
+class PersonalDataMatcher:
+    """
+    Matches the personal data of one patient in a single scan of the text. All the fields of PERSONAL_DATA_FORMAT
+    are combined into one pattern, compiled once, together with common variants of the patient name: full name in
+    both orders and abbreviated names (e.g. 'M. Rossi', 'Rossi M.'). With initials, the bare initials of the patient
+    (e.g. 'M.R.') are matched too; they are off by default, since they collide with common abbreviations (a patient
+    'Paolo Sartori' would turn every 'P.S.' into PATIENT). Values are matched case-insensitively, except provinces and
+    initials which must be uppercase, and only as whole words (not preceded or followed by a letter or digit, even
+    when the value starts or ends with punctuation). Use personal_data_matcher to reuse the matcher of a patient
+    across all its texts.
+    """
 
-def _mask_personal_data(doc: Doc, personal_data: dict[str, str]) -> list[Span]:
-    """Mask personal data in the text using the provided dictionary."""
+    def __init__(self, personal_data: dict[str, str], initials: bool = PERSONAL_DATA_INITIALS):
+        alternatives = []  # (value pattern, label)
+        for key, label in PERSONAL_DATA_FORMAT.items():
+            value = str(personal_data.get(key) or "").strip()
+            if value:
+                escaped = re.escape(value)
+                alternatives.append((escaped if label == prov_tag else f"(?i:{escaped})", label))
+        alternatives += [(variant, "PATIENT") for variant in self._name_variants(personal_data, initials)]
+
+        # Longer values first, so that at the same position a full name wins over its parts
+        alternatives.sort(key=lambda alternative: len(alternative[0]), reverse=True)
+        self.labels = {f"f{i}": label for i, (_, label) in enumerate(alternatives)}
+        self.pattern = re.compile(r"(?<!\w)(?:" + "|".join(f"(?P<f{i}>{value})" for i, (value, _) in enumerate(alternatives))
+                                  + r")(?!\w)") if alternatives else None
+
+    @staticmethod
+    def _name_variants(personal_data: dict[str, str], initials: bool) -> list[str]:
+        """Returns the patterns of the full name, in both orders, of the abbreviated names and, if asked, of the initials."""
+        names = str(personal_data.get("nome") or "").split()
+        surnames = str(personal_data.get("cognome") or "").split()
+        if not names or not surnames:
+            return []
+        surname = " ".join(surnames)
+        separator = r"\s+"
+        name_initials = [re.escape(word[0].upper()) + r"\." for word in names]
+        variants = [
+            f"(?i:{separator.join(re.escape(word) for word in names + surnames)})",
+            f"(?i:{separator.join(re.escape(word) for word in surnames + names)})",
+            r"\s*".join(name_initials) + separator + f"(?i:{re.escape(surname)})",
+            f"(?i:{re.escape(surname)})" + separator + r"\s*".join(name_initials),
+        ]
+        if initials:
+            variants.append(r"\s*".join(name_initials + [re.escape(word[0].upper()) + r"\." for word in surnames]))
+        return variants
+
+    def find_spans(self, doc: Doc, timeout: float = None) -> list[Span]:
+        """
+        Returns the spans of the personal data found in the doc. Overlapping matches starting at different
+        positions are all kept, as they are merged with the other entities afterwards.
+        """
+        if self.pattern is None:
+            return []
+        text_nfc = unicodedata.normalize("NFC", doc.text)
+        new_entities = []
+        with profile_stage(personal_data_source, len(text_nfc)):
+            try:
+                for match in self.pattern.finditer(text_nfc, overlapped=True, timeout=timeout):
+                    span = doc.char_span(match.start(), match.end(), label=self.labels[match.lastgroup],
+                                         alignment_mode="expand", span_id=personal_data_source)
+                    if span is not None:
+                        new_entities.append(span)
+            except TimeoutError:
+                _record_rule_timeout(doc, personal_data_source, timeout)
+        return new_entities
+
+
+@lru_cache(maxsize=1024)
+def _cached_personal_data_matcher(items: tuple[tuple[str, str], ...], initials: bool) -> PersonalDataMatcher:
+    profile_count("personal_data_matcher_compiled")
+    return PersonalDataMatcher(dict(items), initials)
+
+
+def personal_data_matcher(personal_data: dict[str, str], initials: bool = PERSONAL_DATA_INITIALS) -> PersonalDataMatcher:
+    """Returns the matcher of the given personal data, compiling it only the first time the same data is seen."""
+    return _cached_personal_data_matcher(tuple(sorted((key, str(value)) for key, value in personal_data.items()
+                                                      if key in PERSONAL_DATA_FORMAT and value)), initials)
+
+
+def _mask_registry_patients(doc: Doc, timeout: float = None) -> list[Span]:
+    """Mask the names and places of all the patients of the active registry, if any."""
+    registry = get_patient_registry()
+    if registry is None:
+        return []
+    text_nfc = unicodedata.normalize("NFC", doc.text)
     new_entities = []
-    for key, label in PERSONAL_DATA_FORMAT.items():
-        if key in personal_data:
-            pattern = r"\b" + re.escape(personal_data[key]) + r"\b"
-            flag = re.IGNORECASE if label != "PROV" else 0
-            new_entities += _collect_entity_spans_from_regex(doc, pattern, label, flag)
-
+    with profile_stage(registry_source, len(text_nfc)):
+        try:
+            for start, end, label in registry.find(text_nfc, None if timeout is None else time.monotonic() + timeout):
+                span = doc.char_span(start, end, label=label, alignment_mode="expand", span_id=registry_source)
+                if span is not None:
+                    new_entities.append(span)
+        except TimeoutError:
+            _record_rule_timeout(doc, registry_source, timeout)
     return new_entities
 
 
-def apply_rules(doc: Doc | str, per_matching:bool = True, personal_data:dict[str, str] = None) -> Doc:
+def _mask_personal_data(doc: Doc, personal_data: dict[str, str], timeout: float = None) -> list[Span]:
+    """Mask personal data in the text using the provided dictionary."""
+    return personal_data_matcher(personal_data).find_spans(doc, timeout)
+
+
+def compiled_rule_patterns(include_dictionaries: bool = True) -> dict[str, re.Pattern]:
+    """Returns every compiled pattern used by apply_rules, keyed by rule name (personal data patterns excluded)."""
+    patterns = {"email_re": email_re, "urls_re": urls_re, "phone_re": phone_re, "codes_re": codes_re,
+                "common_ambiguous_names": common_ambiguous_names_re}
+    if include_dictionaries:
+        for name in ["nomi", "cognomi", "comuni", "regioni", "nazioni"]:
+            for ambiguous in (False, True):
+                path = _get_file_path(name, ambiguous)
+                if (pattern := _dictionary_pattern(path, ambiguous)) is not None:
+                    patterns[_get_source_name(path)] = pattern
+        for ambiguous in (False, True):
+            path = _get_file_path("province", ambiguous)
+            if (pattern := _province_pattern(path, ambiguous)) is not None:
+                patterns[_get_source_name(path)] = pattern
+    return patterns
+
+
+def rules_checksum() -> str:
+    """
+    Returns a checksum of everything the rules depend on besides the input: the processed dictionaries, the source
+    of the rule and merging modules and the active patient registry. It changes whenever a dictionary is regenerated,
+    a pattern is edited or the registry is reloaded with new patients.
+    """
+    registry = get_patient_registry()
+    if registry is None:
+        return _sources_checksum()
+    return hashlib.sha256(f"{_sources_checksum()}:{registry.checksum}".encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _sources_checksum() -> str:
+    digest = hashlib.sha256()
+    rule_sources = [os.path.join(PROJECT_ROOT, "rules/rules.py"), os.path.join(PROJECT_ROOT, "rules/merge_entities.py"),
+                    os.path.join(PROJECT_ROOT, "rules/patient_registry.py")]
+    dictionaries = sorted(os.path.join(processed_dictionaries_path, name) for name in os.listdir(processed_dictionaries_path))
+    for path in rule_sources + dictionaries:
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    digest.update(f"initials={PERSONAL_DATA_INITIALS}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def apply_rules(doc: Doc | str, per_matching:bool = True, personal_data:dict[str, str] = None,
+                timeout: float | None = DEFAULT_RULE_TIMEOUT) -> Doc:
     """
     Mask various entities in the text using dictionaries and regex patterns.
 
     :param doc: The spaCy Doc object or raw text to process.
     :param per_matching: Whether to anonymize PER and PATIENT entities in combination with dictionaries
     :param personal_data: A dictionary of personal data to make specific masking
+    :param timeout: Maximum number of seconds each rule can spend on the document (None for no limit).
+                    Rules exceeding it are listed in doc._.rule_timeouts.
     """
     if isinstance(doc, str):
         doc = Doc(spacy.blank("it").vocab, words=doc.split())
 
+    with profile_stage("apply_rules", len(doc.text)):
+        return _apply_rules(doc, per_matching, personal_data, timeout)
+
+
+def _apply_rules(doc: Doc, per_matching: bool, personal_data: dict[str, str] | None, timeout: float | None) -> Doc:
     new_entities = []
 
     if personal_data:
-        new_entities += _mask_personal_data(doc, personal_data)
+        new_entities += _mask_personal_data(doc, personal_data, timeout)
+    new_entities += _mask_registry_patients(doc, timeout)
 
-    new_entities += _collect_entity_spans_from_regex(doc, email_re, email_tag, re.IGNORECASE)
-    new_entities += _collect_entity_spans_from_regex(doc, urls_re, url_tag)
+    new_entities += _collect_entity_spans_from_regex(doc, email_re, email_tag, source="email_re", timeout=timeout)
+    new_entities += _collect_entity_spans_from_regex(doc, urls_re, url_tag, source="urls_re", timeout=timeout)
 
     if per_matching:
-        new_entities += _mask_entities_in_text(doc, _get_file_path("nomi"), per_tag)
-        new_entities += _mask_entities_in_text(doc, _get_file_path("nomi", True), per_tag, ambguous=True)
-        new_entities += _mask_ambiguous_common_names(doc)
-        new_entities += _mask_entities_in_text(doc, _get_file_path("cognomi"), per_tag)
-        new_entities += _mask_entities_in_text(doc, _get_file_path("cognomi", True), per_tag, ambguous=True)
-        new_entities += _mask_entities_in_text(doc, _get_file_path("comuni"), gpe_tag)
-        new_entities += _mask_entities_in_text(doc, _get_file_path("comuni", True), gpe_tag, ambguous=True)
-
-    new_entities += _mask_entities_in_text(doc, _get_file_path("regioni"), gpe_tag)
-    new_entities += _mask_entities_in_text(doc, _get_file_path("nazioni"), gpe_tag)
-
-    new_entities += _collect_entity_spans_from_regex(doc, phone_re, phone_tag)
-    new_entities += _collect_entity_spans_from_regex(doc, codes_re, code_tag)
-    new_entities += _mask_province(doc, _get_file_path("province", False), False)
-    new_entities += _mask_province(doc, _get_file_path("province", True), True)
-
-    return merged_entity_spans(new_entities, doc)
+        new_entities += _mask_entities_in_text(doc, _get_file_path("nomi"), per_tag, timeout=timeout)
+        new_entities += _mask_entities_in_text(doc, _get_file_path("nomi", True), per_tag, ambguous=True, timeout=timeout)
+        new_entities += _mask_ambiguous_common_names(doc, timeout)
+        new_entities += _mask_entities_in_text(doc, _get_file_path("cognomi"), per_tag, timeout=timeout)
+        new_entities += _mask_entities_in_text(doc, _get_file_path("cognomi", True), per_tag, ambguous=True, timeout=timeout)
+        new_entities += _mask_entities_in_text(doc, _get_file_path("comuni"), gpe_tag, timeout=timeout)
+        new_entities += _mask_entities_in_text(doc, _get_file_path("comuni", True), gpe_tag, ambguous=True, timeout=timeout)
+
+    new_entities += _mask_entities_in_text(doc, _get_file_path("regioni"), gpe_tag, timeout=timeout)
+    new_entities += _mask_entities_in_text(doc, _get_file_path("nazioni"), gpe_tag, timeout=timeout)
+
+    new_entities += _collect_entity_spans_from_regex(doc, phone_re, phone_tag, source="phone_re", timeout=timeout)
+    new_entities += _collect_entity_spans_from_regex(doc, codes_re, code_tag, source="codes_re", timeout=timeout)
+    new_entities += _mask_province(doc, _get_file_path("province", False), False, timeout)
+    new_entities += _mask_province(doc, _get_file_path("province", True), True, timeout)
+
+    with profile_stage("merged_entity_spans", len(doc.text)):
+        return merged_entity_spans(new_entities, doc)
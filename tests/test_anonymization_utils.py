@@ -0,0 +1,20 @@
+import io
+
+import pytest
+
+from benchmarks.redaction_benchmark import make_dense_doc, anonymize_doc_quadratic
+from utils.anonymization_utils import anonymize_doc, write_anonymized_doc, redact_text
+
+
+@pytest.mark.parametrize("labels", [None, ["PATIENT", "DATE"], []])
+def test_single_pass_redaction_matches_the_previous_implementation(labels):
+    doc = make_dense_doc(50)
+    buffer = io.StringIO()
+    write_anonymized_doc(doc, buffer, labels)
+
+    assert anonymize_doc(doc, labels) == buffer.getvalue() == anonymize_doc_quadratic(doc, labels)
+
+
+def test_redact_text_handles_adjacent_spans_and_text_edges():
+    assert redact_text("Mario Rossi12/03", [(0, 5, "PER"), (6, 11, "PER"), (11, 16, "DATE")]) == "[PER] [PER][DATE]"
+    assert redact_text("Nessun dato.", []) == "Nessun dato."
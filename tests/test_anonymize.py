@@ -0,0 +1,64 @@
+import sys
+import zipfile
+
+import spacy
+import pytest
+
+import anonymize
+
+
+@pytest.fixture
+def run_cli(monkeypatch):
+    """Runs the CLI with the given arguments and a blank model instead of the deployed one."""
+    nlp = spacy.blank("it")
+    monkeypatch.setattr(anonymize, "load_model", lambda *args, **kwargs: nlp)
+
+    def run(*argv: str) -> None:
+        monkeypatch.setattr(sys, "argv", ["anonymize.py", *argv])
+        anonymize.main()
+
+    return run
+
+
+def _sink_entries(path) -> dict[str, str]:
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name).decode("utf-8") for name in archive.namelist()}
+
+
+def test_text_file_is_written_to_output_sink(tmp_path, run_cli):
+    (tmp_path / "note.txt").write_text("Scrivere a mario.rossi@example.it.\n\nSecondo paragrafo.\n", encoding="utf-8")
+
+    run_cli("--input-file", str(tmp_path / "note.txt"), "--output-sink", str(tmp_path / "out.zip"))
+
+    assert _sink_entries(tmp_path / "out.zip") == {"note_anonymized.txt": "Scrivere a [MAIL].\n\nSecondo paragrafo.\n"}
+    assert not (tmp_path / "note_anonymized.txt").exists()
+
+
+def test_patients_export_is_written_to_output_sink(tmp_path, run_cli):
+    (tmp_path / "export.json").write_text('[{"testi": [{"testo": "a@example.it"}]}, {"testi": [{"testo": "b"}]}]',
+                                          encoding="utf-8")
+
+    run_cli("--input-file", str(tmp_path / "export.json"), "--output-sink", str(tmp_path / "out.zip"),
+            "--output-format", "standoff")
+
+    entries = _sink_entries(tmp_path / "out.zip")
+    assert list(entries) == ["export_spans.jsonl"]
+    assert len(entries["export_spans.jsonl"].splitlines()) == 2
+
+
+@pytest.mark.parametrize("mode", [["--input-dir", "in", "--output-dir", "out"], ["--queue", "queue.sqlite"],
+                                  ["--reapply-rules", "--ner-store", "store", "--output-dir", "out"]])
+def test_warmup_is_rejected_where_workers_load_the_model(run_cli, capsys, mode):
+    with pytest.raises(SystemExit):
+        run_cli(*mode, "--warmup")
+    assert "--warmup is not supported" in capsys.readouterr().err
+
+
+def test_warmup_runs_in_text_file_mode(tmp_path, run_cli, capsys):
+    (tmp_path / "note.txt").write_text("Scrivere a mario.rossi@example.it.", encoding="utf-8")
+
+    run_cli("--input-file", str(tmp_path / "note.txt"), "--warmup")
+
+    err = capsys.readouterr().err
+    assert "Model warmed up" in err and "Warm latency" in err
+    assert (tmp_path / "note_anonymized.txt").read_text(encoding="utf-8") == "Scrivere a [MAIL]."
@@ -0,0 +1,69 @@
+import io
+import json
+
+import spacy
+import pytest
+
+from config import DEFAULT_ENTITIES
+from utils.batch_utils import anonymize_jsonl, label_spans
+from utils.cache_utils import ParagraphMemo
+from utils.profiling_utils import profiling
+
+_LETTERHEAD = "ASL 3 - Servizio Dipendenze, tel. 0737 123456, sert@example.it"
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    return spacy.blank("it")
+
+
+class _CountingInput(io.StringIO):
+    """JSON Lines input recording how many lines were read when each output line is written."""
+
+    def __init__(self, text: str):
+        super().__init__(text)
+        self.lines_read = 0
+
+    def __next__(self):
+        line = super().__next__()
+        self.lines_read += 1
+        return line
+
+
+def test_jsonl_records_are_written_batch_by_batch(nlp):
+    records = [{"id": i, "testo": f"Nota {i}: scrivere a paziente{i}@example.it."} for i in range(5)]
+    records[3]["anagrafica"] = {"nome": "Nota"}
+    input_file = _CountingInput("".join(json.dumps(record) + "\n" for record in records))
+    read_when_written = []
+
+    class Output(io.StringIO):
+        def write(self, text):
+            read_when_written.append(input_file.lines_read)
+            return super().write(text)
+
+    output_file = Output()
+    count = anonymize_jsonl(input_file, output_file, nlp, DEFAULT_ENTITIES, False, batch_size=2)
+
+    lines = [json.loads(line) for line in output_file.getvalue().splitlines()]
+    assert count == 5
+    assert [line["id"] for line in lines] == list(range(5))
+    assert lines[0]["testo"] == "Nota 0: scrivere a [MAIL]."
+    assert lines[3]["testo"] == "[PATIENT] 3: scrivere a [MAIL]."
+    assert "anagrafica" not in lines[3]
+    assert read_when_written[0] <= 3  # the first batch is written before the whole input is read
+
+
+def test_paragraph_dedup_gives_the_same_spans_and_labels_repeats_once(nlp):
+    texts = [f"{_LETTERHEAD}\n\nColloquio del 0{i}/03/2021 con mario.rossi@example.it.\n\n{_LETTERHEAD}" for i in range(1, 4)]
+    records = [(text, None) for text in texts]
+
+    expected = list(label_spans(nlp, records, DEFAULT_ENTITIES, False))
+    memo = ParagraphMemo()
+    with profiling() as profiler:
+        deduplicated = list(label_spans(nlp, records, DEFAULT_ENTITIES, False, memo=memo))
+        again = list(label_spans(nlp, records[:1], DEFAULT_ENTITIES, False, memo=memo))
+
+    assert deduplicated == expected and again == expected[:1]
+    assert any(label == "MAIL" for _, _, label, _ in expected[0][0])
+    assert profiler.counters["paragraph_memo_miss"] == 4  # the letterhead and the three notes
+    assert profiler.counters["paragraph_memo_hit"] == 5 + 3
@@ -0,0 +1,35 @@
+import math
+import regex
+
+import pytest
+
+from benchmarks.corpora import build_corpus
+from benchmarks.regex_benchmark import growth_exponent, time_pattern
+from benchmarks.throughput_benchmark import percentile
+
+
+def test_corpus_documents_have_the_requested_size():
+    docs = build_corpus("digit_heavy", 5, doc_chars=2000)
+
+    assert len(docs) == 5
+    assert all(1800 < len(doc) <= 2000 for doc in docs)
+    assert docs == build_corpus("digit_heavy", 5, doc_chars=2000)  # same seed, same corpus
+    with pytest.raises(ValueError):
+        build_corpus("unknown", 1)
+
+
+def test_nearest_rank_percentiles():
+    values = [float(i) for i in range(1, 101)]
+
+    assert (percentile(values, 50), percentile(values, 95), percentile(values, 100)) == (50.0, 95.0, 100.0)
+    assert percentile([3.0], 99) == 3.0
+
+
+def test_catastrophic_pattern_is_reported_as_exponential():
+    assert time_pattern(regex.compile(r"^(a|a)*$"), "a" * 40 + "b", timeout=0.05) is None
+    assert time_pattern(regex.compile(r"a+"), "a" * 1000, timeout=1) is not None
+
+    assert growth_exponent([1000, 10000], [0.001, None]) == math.inf
+    assert growth_exponent([1000, 10000], [0.001, 0.01]) == pytest.approx(1.0)
+    assert growth_exponent([1000, 10000], [0.001, 0.1]) == pytest.approx(2.0)
+    assert growth_exponent([1000, 10000], [None, 0.01]) is None
@@ -0,0 +1,43 @@
+import multiprocessing
+
+from utils.cache_utils import ResultCache
+
+_MAX_MB = 0.05
+
+
+def _fill(path: str, worker: int, results: int) -> None:
+    """Worker process: stores results of about 200 bytes in the shared cache, evicting as it goes."""
+    with ResultCache(path, _MAX_MB) as cache:
+        for i in range(results):
+            cache.put_many({f"{worker}-{i}": [(0, 150, "PER", "ner")] * 8})
+
+
+def _stored_bytes(cache: ResultCache) -> int:
+    return cache.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    with ResultCache(str(tmp_path / "cache.sqlite"), _MAX_MB) as cache:
+        cache.put_many({"first": [(0, 5, "PER", "ner")]})
+        for i in range(400):
+            cache.get_many(["first"])  # keeps the first result recently used
+            cache.put_many({f"other-{i}": [(0, 150, "PER", "ner")] * 8})
+
+        assert cache.evictions > 0
+        assert cache.get_many(["first"]) == {"first": [(0, 5, "PER", "ner")]}
+        assert cache.get_many(["other-0"]) == {}
+        assert cache.size_bytes() == _stored_bytes(cache) <= cache.max_bytes
+
+
+def test_concurrent_evictions_keep_size_consistent(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    ResultCache(path, _MAX_MB).close()
+    processes = [multiprocessing.Process(target=_fill, args=(path, worker, 300)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+    assert all(process.exitcode == 0 for process in processes)
+
+    with ResultCache(path, _MAX_MB) as cache:
+        assert cache.size_bytes() == _stored_bytes(cache) <= cache.max_bytes
@@ -0,0 +1,67 @@
+import time
+import threading
+
+import spacy
+import pytest
+from spacy.language import Language
+
+import utils.deadline_utils as deadline_utils
+from config import DEADLINE_MIN_RULE_SECONDS
+from rules.rules import apply_rules
+from utils.deadline_utils import DeadlineLabeller
+
+_release_model = threading.Event()
+
+
+@Language.component("test_wait_for_release")
+def _wait_for_release(doc):
+    _release_model.wait(timeout=30)
+    return doc
+
+
+@pytest.fixture
+def slow_nlp():
+    """Blank pipeline whose model blocks until the test releases it."""
+    _release_model.clear()
+    nlp = spacy.blank("it")
+    nlp.add_pipe("test_wait_for_release")
+    yield nlp
+    _release_model.set()
+
+
+def test_degraded_chunk_uses_own_vocab_and_capped_rule_timeout(monkeypatch, slow_nlp):
+    timeouts = []
+
+    def recording_rules(doc, per_matching, personal_data, timeout):
+        timeouts.append(timeout)
+        assert doc.vocab is not slow_nlp.vocab  # the model thread may be writing to the pipeline vocab meanwhile
+        return apply_rules(doc, per_matching, personal_data, timeout)
+
+    monkeypatch.setattr(deadline_utils, "apply_rules", recording_rules)
+    labeller = DeadlineLabeller(slow_nlp, deadline_seconds=0.2, chars_per_second=1e6)
+    try:
+        start = time.perf_counter()
+        redacted, degraded, full = labeller.anonymize("Scrivere a mario.rossi@example.it.")
+        assert time.perf_counter() - start < 1.0
+    finally:
+        _release_model.set()
+        labeller.close()
+
+    assert degraded and redacted == "Scrivere a [MAIL]."
+    assert timeouts and all(DEADLINE_MIN_RULE_SECONDS <= timeout <= 0.2 for timeout in timeouts)
+    assert full.result(timeout=10) == "Scrivere a [MAIL]."
+
+
+def test_close_cancels_pending_full_quality_passes(slow_nlp):
+    labeller = DeadlineLabeller(slow_nlp, deadline_seconds=0.1, chars_per_second=1e6)
+    _, first_degraded, first_full = labeller.anonymize("Primo testo.")
+    _, second_degraded, second_full = labeller.anonymize("Secondo testo.")
+    assert first_degraded and second_degraded
+
+    closer = threading.Thread(target=labeller.close, kwargs={"cancel_pending": True})
+    closer.start()
+    _release_model.set()  # lets the running chunk of the first text complete
+    closer.join(timeout=10)
+
+    assert not closer.is_alive()
+    assert first_full.cancelled() and second_full.cancelled()
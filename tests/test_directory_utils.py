@@ -0,0 +1,196 @@
+import io
+import os
+import gzip
+import json
+import time
+import tarfile
+import zipfile
+import functools
+
+import spacy
+import pytest
+
+import utils.batch_utils as batch_utils
+import utils.directory_utils as directory_utils
+import utils.file_pipeline_utils as file_pipeline_utils
+from config import MANIFEST_FILENAME
+from rules.rules import apply_rules
+from utils.directory_utils import anonymize_directory
+from utils.manifest_utils import Manifest, STATUS_DONE, STATUS_RULE_TIMEOUT
+from utils.profiling_utils import profiling
+from utils.scheduling_utils import plan_parts
+from utils.span_utils import iter_spans_jsonl
+
+
+@pytest.fixture
+def blank_model(tmp_path):
+    path = tmp_path / "model"
+    spacy.blank("it").to_disk(path)
+    return str(path)
+
+
+def _timing_out_rules(doc, *args, **kwargs):
+    """apply_rules, as if the e-mail rule had exceeded its timeout on every document."""
+    doc = apply_rules(doc, *args, **kwargs)
+    doc._.rule_timeouts = ["email_re"]
+    return doc
+
+
+@pytest.mark.parametrize("reader_threads", [0, 2])
+def test_rule_timeout_is_recorded_in_manifest_and_rerun(monkeypatch, tmp_path, blank_model, reader_threads):
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    (input_dir / "note.txt").write_text("Scrivere a mario.rossi@example.it entro il 12/03/2021.", encoding="utf-8")
+
+    def run():
+        return anonymize_directory(str(input_dir), str(output_dir), model_path=blank_model, reader_threads=reader_threads,
+                                   log=lambda message: None)
+
+    monkeypatch.setattr(batch_utils, "apply_rules", _timing_out_rules)
+    summary = run()
+    assert summary["processed"] == 1 and summary["rule_timeouts"] == 1
+    with Manifest(str(output_dir / MANIFEST_FILENAME)) as manifest:
+        entry = manifest.get("note.txt")
+    assert entry["status"] == STATUS_RULE_TIMEOUT
+    assert "email_re" in entry["error"]
+    assert (output_dir / "note_anonymized.txt").exists()
+
+    monkeypatch.setattr(batch_utils, "apply_rules", apply_rules)
+    summary = run()
+    assert summary["processed"] == 1 and summary["skipped"] == 0 and summary["rule_timeouts"] == 0
+    with Manifest(str(output_dir / MANIFEST_FILENAME)) as manifest:
+        assert manifest.get("note.txt")["status"] == STATUS_DONE
+
+
+def test_failed_pipeline_batch_does_not_write_streamed_files_twice(monkeypatch, tmp_path, blank_model):
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    (input_dir / "first.txt").write_text("Primo.", encoding="utf-8")
+    with zipfile.ZipFile(input_dir / "bundle.zip", "w") as archive:
+        archive.writestr("member.txt", "Scrivere a mario.rossi@example.it.")
+    (input_dir / "boom.txt").write_text("BOOM", encoding="utf-8")
+    (input_dir / "ok.txt").write_text("Nessun dato.", encoding="utf-8")
+    order = ["first.txt", "bundle.zip", "boom.txt", "ok.txt"]
+
+    original_walk, original_label_spans, original_process_file = \
+        directory_utils.iter_input_files, file_pipeline_utils.label_spans, file_pipeline_utils.process_file_timeouts
+    processed, calls = [], []
+
+    def ordered_walk(*args, **kwargs):
+        return sorted(original_walk(*args, **kwargs), key=lambda entry: order.index(entry.name))
+
+    def failing_label_spans(nlp, records, *args, **kwargs):
+        records = list(records)
+        calls.append(records)
+        if len(calls) == 1:
+            time.sleep(0.5)  # the other files queue up meanwhile, and are then labelled in one batch
+        if any("BOOM" in text for text, _ in records):
+            raise ValueError("model failure")
+        return original_label_spans(nlp, records, *args, **kwargs)
+
+    def counting_process_file(ctx, input_path, *args):
+        processed.append(os.path.basename(input_path))
+        return original_process_file(ctx, input_path, *args)
+
+    monkeypatch.setattr(directory_utils, "iter_input_files", ordered_walk)
+    monkeypatch.setattr(file_pipeline_utils, "label_spans", failing_label_spans)
+    monkeypatch.setattr(file_pipeline_utils, "process_file_timeouts", counting_process_file)
+    summary = anonymize_directory(str(input_dir), str(output_dir), model_path=blank_model, reader_threads=2,
+                                  log=lambda message: None)
+
+    assert summary["processed"] == 3 and summary["failed"] == 1
+    assert processed == ["bundle.zip"]
+    assert (output_dir / "ok_anonymized.txt").read_text(encoding="utf-8") == "Nessun dato."
+    assert (output_dir / "bundle" / "member_anonymized.txt").read_text(encoding="utf-8") == "Scrivere a [MAIL]."
+
+
+def _anonymize(input_dir, output, model, log=lambda message: None, **kwargs):
+    return anonymize_directory(str(input_dir), str(output) if output else None, model_path=model, log=log, **kwargs)
+
+
+def test_unchanged_files_are_skipped_on_resume(tmp_path, blank_model):
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    (input_dir / "sub").mkdir(parents=True)
+    (input_dir / "a.txt").write_text("Scrivere a mario.rossi@example.it.", encoding="utf-8")
+    (input_dir / "sub" / "b.txt").write_text("Nessun dato.", encoding="utf-8")
+
+    assert _anonymize(input_dir, output_dir, blank_model, recursive=True)["processed"] == 2
+    assert (output_dir / "sub" / "b_anonymized.txt").exists()
+
+    os.utime(input_dir / "a.txt", ns=(0, 0))  # touched but unchanged
+    first = _anonymize(input_dir, output_dir, blank_model, recursive=True)
+    (input_dir / "sub" / "b.txt").write_text("Telefonare a luca@example.it.", encoding="utf-8")
+    second = _anonymize(input_dir, output_dir, blank_model, recursive=True)
+
+    assert (first["processed"], first["skipped"]) == (0, 2)
+    assert (second["processed"], second["skipped"]) == (1, 1)
+    assert (output_dir / "sub" / "b_anonymized.txt").read_text(encoding="utf-8") == "Telefonare a [MAIL]."
+    assert _anonymize(input_dir, output_dir, blank_model, recursive=True, output_format="standoff")["processed"] == 2
+
+
+def test_compressed_files_and_archives_are_read_without_extracting(tmp_path, blank_model):
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    with gzip.open(input_dir / "note.txt.gz", "wt", encoding="utf-8") as f:
+        f.write("Scrivere a mario.rossi@example.it.")
+    with tarfile.open(input_dir / "bundle.tar.gz", "w:gz") as archive:
+        for name, text in [("reparto/a.txt", "Mail a luca@example.it."), ("b.json", '{"anagrafica": {"nome": "Mario"}, "testi": [{"testo": "Mario, x@example.it"}]}')]:
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    with profiling() as profiler:
+        summary = _anonymize(input_dir, output_dir, blank_model)
+
+    assert summary["processed"] == 2 and summary["failed"] == 0
+    assert (output_dir / "note_anonymized.txt").read_text(encoding="utf-8") == "Scrivere a [MAIL]."
+    assert (output_dir / "bundle" / "reparto" / "a_anonymized.txt").read_text(encoding="utf-8") == "Mail a [MAIL]."
+    assert (output_dir / "bundle" / "b_anonymized.txt").read_text(encoding="utf-8") == "[PATIENT], [MAIL]"
+    assert profiler.counters["archive_members"] == 2
+
+
+def test_patients_export_and_standoff_outputs_go_to_the_sink(tmp_path, blank_model):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    (input_dir / "export.jsonl").write_text(
+        '{"anagrafica": {"nome": "Mario", "cognome": "Rossi"}, "testi": [{"testo": "Visto Mario Rossi."}]}\n'
+        '{"anagrafica": {"nome": "Luca", "cognome": "Bianchi"}, "testi": [{"testo": "Mario Rossi e Luca Bianchi."}]}\n',
+        encoding="utf-8")
+    (input_dir / "note.txt").write_text("Scrivere a mario.rossi@example.it.", encoding="utf-8")
+    sink_path = tmp_path / "out.zip"
+
+    summary = _anonymize(input_dir, None, blank_model, output_sink=str(sink_path), output_format="standoff")
+
+    assert summary["processed"] == 2
+    assert os.path.exists(str(sink_path) + MANIFEST_FILENAME)
+    with zipfile.ZipFile(sink_path) as archive:
+        patients = [json.loads(line) for line in archive.read("export_spans.jsonl").decode("utf-8").splitlines()]
+        note_spans = list(iter_spans_jsonl(io.StringIO(archive.read("note_spans.jsonl").decode("utf-8"))))
+    # the personal data of each patient applies to its own texts only
+    assert [[span[2] for span in patient["testi"][0]["spans"]] for patient in patients] == [["PATIENT"], ["PATIENT"]]
+    assert patients[1]["testi"][0]["spans"][0][:2] == [14, 26]
+    assert note_spans == [[(11, 33, "MAIL", "email_re")]]
+
+
+@pytest.mark.parametrize("output_format", ["text", "standoff"])
+def test_long_documents_split_across_workers_match_a_single_worker(monkeypatch, tmp_path, blank_model, output_format):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    paragraphs = [f"Nota {i}: scrivere a paziente{i}@example.it entro il {i % 28 + 1:02d}/03/2021." for i in range(400)]
+    (input_dir / "long.txt").write_text("\n\n".join(paragraphs), encoding="utf-8")
+    (input_dir / "short.txt").write_text("Nessun dato.", encoding="utf-8")
+    monkeypatch.setattr(directory_utils, "plan_parts", functools.partial(plan_parts, part_chars=4000))
+
+    single = _anonymize(input_dir, tmp_path / "single", blank_model, output_format=output_format)
+    with profiling() as profiler:
+        split = _anonymize(input_dir, tmp_path / "split", blank_model, output_format=output_format, workers=2,
+                           max_tasks_per_worker=2)
+
+    assert single["processed"] == split["processed"] == 2 and split["failed"] == 0
+    assert split["recycles"] and all(recycle["reason"] == "tasks" for recycle in split["recycles"])
+    assert sum(worker["tasks"] for worker in split["workers"]) > 2  # the long file went out in several parts
+    assert ("tokenizer",) in profiler.stats  # measured in the workers and merged in the parent
+    for name in os.listdir(tmp_path / "single"):
+        if name != MANIFEST_FILENAME:
+            assert (tmp_path / "split" / name).read_bytes() == (tmp_path / "single" / name).read_bytes()
@@ -0,0 +1,86 @@
+import sqlite3
+
+import spacy
+import pytest
+
+from config import DEFAULT_ENTITIES
+from utils.batch_utils import label_texts
+from utils.incremental_utils import VersionStore, changed_region, update_spans
+from utils.span_utils import doc_to_spans
+
+_PARAGRAPHS = [
+    "Visita del 12/03/2021: scrivere a mario.rossi@example.it per i referti.",
+    "Nessuna novità rilevante.",
+    "Telefonato al 333 1234567, richiamare lunedì.",
+    "Inviata mail a giulia.bianchi@example.it con il piano terapeutico.",
+    "Controllo fissato per il 02/05/2021.",
+]
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    return spacy.blank("it")
+
+
+def _full_spans(nlp, text):
+    return doc_to_spans(next(label_texts(nlp, [(text, None)], False)), DEFAULT_ENTITIES)
+
+
+def _join(paragraphs):
+    return "\n\n".join(paragraphs)
+
+
+@pytest.mark.parametrize("old, new", [
+    (_PARAGRAPHS[:3], _PARAGRAPHS),  # appended entries
+    (_PARAGRAPHS, _PARAGRAPHS[:2] + ["Telefonato al 347 7654321, richiamare martedì."] + _PARAGRAPHS[3:]),  # middle edit
+    (_PARAGRAPHS, _PARAGRAPHS[:1] + _PARAGRAPHS[2:]),  # deleted entry
+    (_PARAGRAPHS, _PARAGRAPHS[:4]),  # deleted last entry
+    (_PARAGRAPHS, ["Nuova nota, contatto luca@example.it."] + _PARAGRAPHS),  # inserted first entry
+    ([], _PARAGRAPHS),  # empty old text
+    (_PARAGRAPHS, _PARAGRAPHS),  # unchanged
+])
+@pytest.mark.parametrize("margin", [0, 1])
+def test_incremental_spans_match_full_relabelling(nlp, old, new, margin):
+    old_text, new_text = _join(old), _join(new)
+
+    spans, timeouts = update_spans(nlp, new_text, old_text, _full_spans(nlp, old_text), DEFAULT_ENTITIES, False,
+                                   margin=margin)
+
+    assert sorted(spans) == sorted(_full_spans(nlp, new_text))
+    assert any(label == "MAIL" for _, _, label, _ in spans)
+    assert timeouts == []
+
+
+def test_changed_region_of_appended_entry(nlp):
+    old_text = _join(_PARAGRAPHS[:3])
+    new_text = _join(_PARAGRAPHS[:4])
+    appended = new_text.index(_PARAGRAPHS[3])
+
+    assert changed_region(old_text, new_text, margin=0) == (len(old_text), appended, len(new_text))
+    assert changed_region(old_text, new_text, margin=1) == (new_text.index(_PARAGRAPHS[2]) - 2,
+                                                            new_text.index(_PARAGRAPHS[2]), len(new_text))
+    assert changed_region(old_text, old_text) == (len(old_text), len(old_text), len(old_text))
+
+
+def test_version_store_reuses_spans_without_storing_texts(tmp_path, nlp):
+    path = str(tmp_path / "versions.sqlite")
+    with VersionStore(path) as store:
+        first = store.anonymize(nlp, "diary", _join(_PARAGRAPHS[:3]), DEFAULT_ENTITIES, False)
+        second = store.anonymize(nlp, "diary", _join(_PARAGRAPHS), DEFAULT_ENTITIES, False)
+
+    assert sorted(first) == sorted(_full_spans(nlp, _join(_PARAGRAPHS[:3])))
+    assert sorted(second) == sorted(_full_spans(nlp, _join(_PARAGRAPHS)))
+    with sqlite3.connect(path) as conn:
+        dump = "\n".join(conn.iterdump())
+    assert "mario.rossi" not in dump and "Nessuna novità" not in dump
+
+
+def test_separator_change_only_shifts_spans(nlp):
+    old_text = _join(_PARAGRAPHS)
+    new_text = _PARAGRAPHS[0] + "\n\n\n\n" + _join(_PARAGRAPHS[1:])
+
+    prefix_end, start, end = changed_region(old_text, new_text)
+    spans, _ = update_spans(nlp, new_text, old_text, _full_spans(nlp, old_text), DEFAULT_ENTITIES, False)
+
+    assert start == end
+    assert sorted(spans) == sorted(_full_spans(nlp, new_text))
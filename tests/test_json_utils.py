@@ -0,0 +1,54 @@
+import io
+import gzip
+import json
+
+import pytest
+
+from utils.json_utils import iter_json_array, iter_json_records, iter_json_stream_records, is_multi_record_json
+
+_RECORDS = [{"anagrafica": {"nome": "Mario"}, "testi": [{"testo": "Note con ] e , e \"virgolette\" [x]"}]},
+            12345678, -0.5e-3, "testo", [1, [2, 3]], {}, None, True]
+
+
+class _ReadCounter(io.StringIO):
+    def __init__(self, text: str):
+        super().__init__(text)
+        self.chars_read = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.chars_read += len(chunk)
+        return chunk
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1 << 20])
+def test_array_elements_are_parsed_across_chunk_boundaries(chunk_size):
+    text = " [ " + " ,\n ".join(json.dumps(record) for record in _RECORDS) + " ] "
+
+    assert list(iter_json_array(io.StringIO(text), chunk_size=chunk_size)) == _RECORDS
+
+
+def test_array_is_read_lazily():
+    text = json.dumps([{"testo": "x" * 100}] * 1000)
+    stream = _ReadCounter(text)
+    first = next(iter_json_array(stream, chunk_size=1000))
+
+    assert first == {"testo": "x" * 100}
+    assert stream.chars_read < len(text) // 10
+
+
+@pytest.mark.parametrize("text", ["", "{}", "[1 2]", "[1,"])
+def test_invalid_arrays_are_rejected(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text)))
+
+
+def test_exports_are_detected_and_streamed_from_compressed_files(tmp_path):
+    records = [{"anagrafica": {"nome": "Mario"}, "testi": [{"testo": "a"}]}, {"testi": []}]
+    with gzip.open(tmp_path / "export.json.gz", "wt", encoding="utf-8") as f:
+        f.write("\ufeff" + json.dumps(records))
+    (tmp_path / "single.json").write_text(json.dumps(records[0]), encoding="utf-8")
+
+    assert is_multi_record_json(str(tmp_path / "export.json.gz")) and not is_multi_record_json(str(tmp_path / "single.json"))
+    assert list(iter_json_records(str(tmp_path / "export.json.gz"))) == records
+    assert list(iter_json_stream_records(io.StringIO("\n".join(map(json.dumps, records))), "export.jsonl")) == records
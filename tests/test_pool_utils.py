@@ -0,0 +1,25 @@
+import os
+
+from utils.pool_utils import WorkerPool
+
+
+def test_workers_are_recycled_after_max_tasks():
+    pool = WorkerPool(1, max_tasks=2)
+    try:
+        pids = [pool.submit(os.getpid).result(timeout=60) for _ in range(5)]
+    finally:
+        pool.shutdown()
+
+    assert len(set(pids)) == 3 and pids[0] == pids[1] and pids[2] == pids[3] != pids[0]
+    assert [(recycle["reason"], recycle["tasks"]) for recycle in pool.recycles] == [("tasks", 2), ("tasks", 2)]
+    assert sorted(stats["tasks"] for stats in pool.report()) == [1, 2, 2]
+
+
+def test_shutdown_stops_spare_workers():
+    pool = WorkerPool(1, max_tasks=3)
+    pool.submit(os.getpid).result(timeout=60)
+    pool.submit(os.getpid).result(timeout=60)  # one task away from the limit: a spare worker is started
+    pool.shutdown()
+
+    assert pool._slots[0]["spare"] is not None
+    assert all(not executor._processes for executor in [pool._slots[0]["executor"], pool._slots[0]["spare"]["executor"]])
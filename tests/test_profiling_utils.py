@@ -0,0 +1,63 @@
+import json
+import threading
+
+from utils.profiling_utils import Profiler, profiling, profile_stage, profile_count, get_profiler
+
+
+def test_nested_stages_counters_and_reports(tmp_path):
+    with profiling() as profiler:
+        with profile_stage("apply_rules", 100):
+            with profile_stage("email_re", 100):
+                pass
+            with profile_stage("email_re", 50):
+                pass
+        profile_count("cache_hit", 3)
+        profile_count("cache_miss")
+    assert get_profiler() is None
+    profile_count("cache_hit")  # no active profiler: ignored
+
+    assert profiler.stats[("apply_rules",)]["calls"] == 1
+    assert profiler.stats[("apply_rules", "email_re")]["calls"] == 2
+    assert profiler.stats[("apply_rules", "email_re")]["chars"] == 150
+    assert profiler.hit_rates() == {"cache": 0.75}
+    assert [line.split()[0] for line in profiler.collapsed_stacks()] == ["apply_rules", "apply_rules;email_re"]
+
+    json_path, folded_path = profiler.save(str(tmp_path / "profile"))
+    with open(json_path, encoding="utf-8") as f:
+        assert [stage["stage"] for stage in json.load(f)["stages"]] == ["apply_rules", "apply_rules;email_re"]
+
+
+def test_snapshots_of_other_profilers_are_merged():
+    worker = Profiler()
+    with worker.stage("ner", 10):
+        pass
+    worker.count("archive_members", 2)
+    snapshot = worker.snapshot(reset=True)
+
+    parent = Profiler()
+    parent.merge(snapshot)
+    parent.merge(snapshot)
+
+    assert worker.stats == {} and worker.counters == {}
+    assert parent.stats[("ner",)]["calls"] == 2 and parent.stats[("ner",)]["chars"] == 20
+    assert parent.counters == {"archive_members": 4}
+
+
+def test_stages_of_different_threads_are_not_nested():
+    profiler = Profiler()
+    entered, release = threading.Event(), threading.Event()
+
+    def other_thread():
+        with profiler.stage("reader"):
+            entered.set()
+            release.wait(timeout=10)
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    entered.wait(timeout=10)
+    with profiler.stage("ner"):
+        pass
+    release.set()
+    thread.join()
+
+    assert set(profiler.stats) == {("reader",), ("ner",)}
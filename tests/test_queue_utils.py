@@ -0,0 +1,104 @@
+import os
+import time
+import multiprocessing
+
+import spacy
+import pytest
+
+from utils.queue_batch_utils import anonymize_queue
+from utils.manifest_utils import STATUS_DONE, STATUS_FAILED
+from utils.queue_utils import JobQueue
+
+
+def _claim_all(queue_path: str, owner: str, claimed) -> None:
+    """Worker process: claims and completes files until none is pending, reporting each claimed path."""
+    with JobQueue(queue_path) as queue:
+        while (path := queue.claim(owner, lease_seconds=60)) is not None:
+            claimed.put(path)
+            assert queue.complete(path, owner, f"out/{path}")
+
+
+def _claim_and_die(queue_path: str, owner: str, max_attempts: int, claimed) -> None:
+    """Worker process: claims a file with a short lease and exits without releasing it, as if it had crashed."""
+    with JobQueue(queue_path, max_attempts=max_attempts) as queue:
+        claimed.put(queue.claim(owner, lease_seconds=0.05))
+    claimed.close()
+    claimed.join_thread()
+    os._exit(1)
+
+
+def _run_processes(target, args_per_process: list[tuple]) -> list:
+    claimed = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=target, args=args + (claimed,)) for args in args_per_process]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+    results = []
+    while not claimed.empty():
+        results.append(claimed.get(timeout=5))
+    return results
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.sqlite")
+
+
+def test_every_job_is_claimed_exactly_once(queue_path):
+    paths = [f"note_{i:03d}.txt" for i in range(60)]
+    with JobQueue(queue_path) as queue:
+        assert queue.enqueue([(path, 100 + i, 0) for i, path in enumerate(paths)]) == len(paths)
+
+    claimed = _run_processes(_claim_all, [(queue_path, f"worker-{i}") for i in range(4)])
+
+    assert sorted(claimed) == paths
+    with JobQueue(queue_path) as queue:
+        assert queue.counts() == {STATUS_DONE: len(paths)}
+
+
+def test_expired_lease_is_claimed_by_another_worker(queue_path):
+    with JobQueue(queue_path) as queue:
+        queue.enqueue([("note.txt", 10, 0)])
+        assert queue.claim("dead-worker", lease_seconds=0.05) == "note.txt"
+        assert queue.claim("other-worker", lease_seconds=60) is None  # still leased
+    time.sleep(0.1)
+
+    claimed = _run_processes(_claim_all, [(queue_path, "live-worker")])
+
+    assert claimed == ["note.txt"]
+    with JobQueue(queue_path) as queue:
+        assert not queue.complete("note.txt", "dead-worker", "out/note.txt")
+        assert queue.counts() == {STATUS_DONE: 1}
+
+
+def test_job_fails_after_max_attempts(queue_path):
+    with JobQueue(queue_path) as queue:
+        queue.enqueue([("crash.txt", 10, 0)])
+
+    claimed = []
+    for attempt in range(2):
+        claimed += _run_processes(_claim_and_die, [(queue_path, f"worker-{attempt}", 2)])
+        time.sleep(0.1)
+    assert claimed == ["crash.txt", "crash.txt"]
+
+    with JobQueue(queue_path, max_attempts=2) as queue:
+        assert queue.claim("worker-2", lease_seconds=60) is None
+        assert queue.counts() == {STATUS_FAILED: 1}
+
+
+def test_anonymize_queue_with_several_worker_processes(tmp_path):
+    model_path, input_dir, output_dir = tmp_path / "model", tmp_path / "in", tmp_path / "out"
+    spacy.blank("it").to_disk(model_path)
+    input_dir.mkdir()
+    for i in range(6):
+        (input_dir / f"note_{i}.txt").write_text(f"Scrivere a paziente{i}@example.it.", encoding="utf-8")
+    queue_path = str(tmp_path / "queue.sqlite")
+
+    summary = anonymize_queue(queue_path, str(input_dir), str(output_dir), model_path=str(model_path), workers=2,
+                              log=lambda message: None)
+
+    assert summary["processed"] == 6 and summary["failed"] == 0 and summary["lost"] == 0
+    assert summary["queue"] == {STATUS_DONE: 6}
+    assert sorted(os.listdir(output_dir)) == [f"note_{i}_anonymized.txt" for i in range(6)]
+    assert "@example.it" not in (output_dir / "note_0_anonymized.txt").read_text(encoding="utf-8")
@@ -0,0 +1,104 @@
+import zipfile
+
+import pytest
+
+from config import PDF_PAGE_SEPARATOR
+from utils.reader_utils import iter_docx_paragraphs, iter_pdf_pages, read_pdf, iter_text_chunks, text_chunk_offsets
+
+
+def _write_pdf(path, page_texts):
+    """Writes a minimal PDF with one line of Helvetica text per page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %d 0 R >>" % len(objects))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    data, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_read_pdf_separates_pages_with_form_feed(tmp_path, workers):
+    path = _write_pdf(tmp_path / "letter.pdf", ["Prima pagina", "Seconda pagina", "Terza pagina"])
+
+    pages = list(iter_pdf_pages(path, workers=workers, pages_per_task=1))
+    assert [page.strip() for page in pages] == ["Prima pagina", "Seconda pagina", "Terza pagina"]
+
+    assert PDF_PAGE_SEPARATOR == "\f"
+    assert read_pdf(path, workers=workers) == "\f".join(pages)
+
+
+_DOCX_NAMESPACES = ('xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+                    'xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006"')
+
+
+def _write_docx(path, parts):
+    """Writes a DOCX-like archive with the given WordprocessingML parts (name -> body of the root element)."""
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, body in parts.items():
+            root = "w:document" if name == "word/document.xml" else "w:hdr" if "header" in name else "w:ftr"
+            archive.writestr(name, f'<?xml version="1.0" encoding="UTF-8"?><{root} {_DOCX_NAMESPACES}>{body}</{root}>')
+    return str(path)
+
+
+def _paragraph(text, properties=""):
+    return f"<w:p>{properties}<w:r><w:t>{text}</w:t></w:r></w:p>"
+
+
+def test_docx_tab_stops_after_text_box_are_not_text(tmp_path):
+    text_box = ("<w:p><w:r><mc:AlternateContent>"
+                f"<mc:Choice><w:drawing><w:txbxContent>{_paragraph('box')}</w:txbxContent></w:drawing></mc:Choice>"
+                f"<mc:Fallback><w:pict><w:txbxContent>{_paragraph('box')}</w:txbxContent></w:pict></mc:Fallback>"
+                "</mc:AlternateContent></w:r></w:p>")
+    tab_stops = '<w:pPr><w:tabs><w:tab w:val="left" w:pos="720"/></w:tabs></w:pPr>'
+    body = f"<w:body>{text_box}{_paragraph('Mario', tab_stops)}<w:p><w:r><w:t>a</w:t><w:tab/><w:t>b</w:t></w:r></w:p></w:body>"
+    path = _write_docx(tmp_path / "letter.docx", {"word/document.xml": body})
+
+    assert [p for p in iter_docx_paragraphs(path) if p] == ["box", "Mario", "a\tb"]
+
+
+def test_docx_headers_and_footers_are_read_in_numeric_order(tmp_path):
+    path = _write_docx(tmp_path / "letter.docx", {
+        "word/document.xml": f"<w:body>{_paragraph('body')}</w:body>",
+        "word/header10.xml": _paragraph("header10"), "word/header2.xml": _paragraph("header2"),
+        "word/footer10.xml": _paragraph("footer10"), "word/footer2.xml": _paragraph("footer2"),
+    })
+
+    assert list(iter_docx_paragraphs(path)) == ["header2", "header10", "body", "footer2", "footer10"]
+
+
+def test_text_chunks_follow_paragraphs_and_byte_ranges(tmp_path):
+    text = "\r\n\r\n".join(f"Paragrafo {i}: città, perché è così." for i in range(300))
+    path = tmp_path / "diary.txt"
+    path.write_bytes(text.encode("utf-8"))
+
+    chunks = list(iter_text_chunks(str(path), max_bytes=200))
+    assert "".join(chunks) == text.replace("\r\n", "\n")
+    assert all(len(chunk.encode("utf-8")) <= 200 and chunk.endswith("\n\n") for chunk in chunks[:-1])
+
+    offsets = [0] + list(text_chunk_offsets(str(path), max_bytes=200))
+    assert len(offsets) == len(chunks) + 1
+    ranges = [(offsets[i], offsets[min(i + 3, len(offsets) - 1)]) for i in range(0, len(offsets) - 1, 3)]
+    assert [chunk for start, end in ranges for chunk in iter_text_chunks(str(path), 200, start, end)] == chunks
+
+
+def test_text_chunks_without_separators_end_on_character_boundaries(tmp_path):
+    text = "è" * 1000
+    path = tmp_path / "garbage.txt"
+    path.write_bytes(text.encode("utf-8"))
+
+    chunks = list(iter_text_chunks(str(path), max_bytes=101))
+    assert "".join(chunks) == text and all(len(chunk) == 50 for chunk in chunks)
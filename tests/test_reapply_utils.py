@@ -0,0 +1,49 @@
+import spacy
+import pytest
+
+from utils.directory_utils import anonymize_directory
+from utils.reapply_utils import reapply_rules_directory
+
+
+@pytest.fixture
+def blank_model(tmp_path):
+    path = tmp_path / "model"
+    spacy.blank("it").to_disk(path)
+    return str(path)
+
+
+def test_rules_are_reapplied_to_stored_ner_output(tmp_path, blank_model):
+    input_dir, output_dir, store_dir = tmp_path / "in", tmp_path / "out", tmp_path / "store"
+    (input_dir / "sub").mkdir(parents=True)
+    (input_dir / "sub" / "note.txt").write_text("Mario Rossi scrive a mario.rossi@example.it.", encoding="utf-8")
+    (input_dir / "patient.json").write_text(
+        '{"anagrafica": {"nome": "Luca", "cognome": "Bianchi"}, "testi": [{"testo": "Visto Luca Bianchi e Mario Rossi."}]}',
+        encoding="utf-8")
+
+    summary = anonymize_directory(str(input_dir), str(output_dir), model_path=blank_model, recursive=True,
+                                  ner_store_dir=str(store_dir), log=lambda message: None)
+    assert summary["processed"] == 2
+    assert (store_dir / "sub" / "note.txt.spacy").exists()
+
+    summary = reapply_rules_directory(str(store_dir), str(tmp_path / "reapplied"),
+                                      personal_data={"nome": "Mario", "cognome": "Rossi"}, log=lambda message: None)
+
+    assert summary == {"processed": 2, "failed": 0, "rule_timeouts": 0}
+    # documents stored without personal data get the given one, the others keep their own
+    assert (tmp_path / "reapplied" / "sub" / "note_anonymized.txt").read_text(encoding="utf-8") == \
+           "[PATIENT] scrive a [MAIL]."
+    assert (tmp_path / "reapplied" / "patient_anonymized.txt").read_text(encoding="utf-8") == \
+           (output_dir / "patient_anonymized.txt").read_text(encoding="utf-8") == "Visto [PATIENT] e Mario Rossi."
+
+
+def test_ner_store_rejects_archives_and_result_cache(tmp_path, blank_model):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    (input_dir / "bundle.zip").write_bytes(b"PK\x05\x06" + b"\0" * 18)  # empty zip archive
+
+    summary = anonymize_directory(str(input_dir), str(tmp_path / "out"), model_path=blank_model,
+                                  ner_store_dir=str(tmp_path / "store"), log=lambda message: None)
+    assert summary["failed"] == 1
+    with pytest.raises(ValueError):
+        anonymize_directory(str(input_dir), str(tmp_path / "out"), model_path=blank_model,
+                            ner_store_dir=str(tmp_path / "store"), cache_path=str(tmp_path / "cache.sqlite"))
@@ -0,0 +1,86 @@
+import json
+
+import spacy
+import pytest
+
+import rules.rules as rules
+from config import DEFAULT_ENTITIES
+from rules.patient_registry import load_patient_registry, set_patient_registry
+from rules.rules import PersonalDataMatcher, apply_rules, get_rule_timeouts
+from utils.anonymization_utils import redact_text
+from utils.span_utils import doc_to_spans
+
+PATIENT = {"nome": "Mario", "cognome": "Rossi", "luogo_nascita": "Camerino", "data_nascita": "01/02/1980",
+           "prov_residenza": "MC"}
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    return spacy.blank("it")
+
+
+def _redact(nlp, text, personal_data=PATIENT):
+    doc = apply_rules(nlp.make_doc(text), False, personal_data)
+    return redact_text(text, [(start, end, label) for start, end, label, _ in doc_to_spans(doc, DEFAULT_ENTITIES)])
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Visto Mario Rossi oggi.", "Visto [PATIENT] oggi."),
+    ("Visto ROSSI MARIO oggi.", "Visto [PATIENT] oggi."),
+    ("Visto Rossi  Mario oggi.", "Visto [PATIENT] oggi."),
+    ("Firmato M. Rossi e Rossi M.", "Firmato [PATIENT] e [PATIENT]"),
+    ("Nato a camerino il 01/02/1980 (MC).", "Nato a [GPE] il [DATE] ([PROV])."),
+])
+def test_personal_data_and_name_variants(nlp, text, expected):
+    assert _redact(nlp, text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "Il sig. Rossini e la sig.ra Mariolina.",  # values are matched as whole words only
+    "Rientro nel 1980, mc minuscolo.",
+    "Inviato al P.S., poi dal M.R. di turno e al S.S.N.",  # initials are off by default
+])
+def test_no_false_positives(nlp, text):
+    assert _redact(nlp, text) == text
+
+
+def test_initials_only_when_enabled(nlp):
+    enabled = PersonalDataMatcher(PATIENT, initials=True)
+    doc = nlp.make_doc("Riferito da M.R. e da M. R. ieri.")
+    assert [span.text for span in enabled.find_spans(doc)] == ["M.R.", "M. R."]
+    assert PersonalDataMatcher(PATIENT).find_spans(doc) == []
+
+
+def test_common_two_letter_abbreviations_are_not_initials(nlp):
+    matcher = PersonalDataMatcher({"nome": "Paolo", "cognome": "Sartori"})
+    assert matcher.find_spans(nlp.make_doc("Accesso al P.S. per dolore toracico.")) == []
+
+
+def test_name_inside_email_and_url_keeps_their_label(nlp):
+    assert _redact(nlp, "Scrivere a mario.rossi@example.it.") == "Scrivere a [MAIL]."
+    assert _redact(nlp, "Sito https://www.mario-rossi.it/contatti oggi.") == "Sito [URL] oggi."
+
+
+def test_overlap_with_registry(tmp_path, nlp):
+    registry = tmp_path / "registry.jsonl"
+    registry.write_text("\n".join(json.dumps(data) for data in [PATIENT, {"nome": "Giulia", "cognome": "Bianchi"}]),
+                        encoding="utf-8")
+    load_patient_registry(str(registry))
+    try:
+        text = "Mario Rossi e Giulia Bianchi, nati a Camerino."
+        assert _redact(nlp, text) == "[PATIENT] e [PATIENT], nati a [GPE]."
+        doc = apply_rules(nlp.make_doc(text), False, PATIENT)
+        assert [(span.text, span.label_) for span in doc.ents] == [
+            ("Mario Rossi", "PATIENT"), ("Giulia Bianchi", "PATIENT"), ("Camerino", "GPE")]
+    finally:
+        set_patient_registry(None)
+
+
+def test_rule_exceeding_its_timeout_keeps_the_matches_found_so_far(nlp):
+    doc = nlp.make_doc("Codice 12 " + "a" * 40 + "b")
+    with pytest.warns(RuntimeWarning, match="slow_re"):
+        spans = rules._collect_entity_spans_from_regex(doc, r"\d+|(?<=\s)(?:a|a)*c", "CODE", source="slow_re", timeout=0.05)
+
+    assert [span.text for span in spans] == ["12"]
+    assert get_rule_timeouts(doc) == ["slow_re"]
+    assert get_rule_timeouts(apply_rules(nlp.make_doc("Codice 12."), False)) == []
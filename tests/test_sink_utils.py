@@ -0,0 +1,59 @@
+import gzip
+import json
+import base64
+import sqlite3
+import tarfile
+import zipfile
+
+import pytest
+
+from utils.sink_utils import open_sink
+
+_ENTRIES = {f"reparto/note_{i}_anonymized.txt": f"Nota {i}: [PATIENT]." for i in range(50)}
+_BINARY = ("note_spans.bin", bytes(range(256)))
+
+
+def _read_entries(path: str) -> dict[str, bytes]:
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    if ".tar" in path:
+        with tarfile.open(path) as archive:
+            return {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+    if ".jsonl" in path:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        return {record["name"]: base64.b64decode(record["content"]) if record.get("encoding") == "base64"
+                else record["content"].encode("utf-8") for record in records}
+    with sqlite3.connect(path) as conn:
+        return dict(conn.execute("SELECT name, content FROM outputs"))
+
+
+@pytest.mark.parametrize("name", ["out.zip", "out.tar.gz", "out.jsonl.gz", "out.sqlite"])
+def test_entries_are_written_in_batches_to_every_sink(tmp_path, name):
+    path = str(tmp_path / "sinks" / name)
+    sink = open_sink(path)
+    sink.batch_entries = 7  # several batches go through the writer thread
+    with sink:
+        for entry, text in _ENTRIES.items():
+            sink.write(entry, text)
+        sink.write(*_BINARY)
+
+    assert sink.entries == len(_ENTRIES) + 1
+    assert _read_entries(path) == {**{entry: text.encode("utf-8") for entry, text in _ENTRIES.items()},
+                                   _BINARY[0]: _BINARY[1]}
+
+
+def test_resumable_sinks_are_appended_to_and_tar_sinks_are_not(tmp_path):
+    for name in ("out.zip", "out.sqlite"):
+        path = str(tmp_path / name)
+        for entry in ("first.txt", "second.txt"):
+            with open_sink(path) as sink:
+                sink.write(entry, entry)
+        assert set(_read_entries(path)) == {"first.txt", "second.txt"}
+
+    open_sink(str(tmp_path / "out.tar")).close()
+    with pytest.raises(ValueError):
+        open_sink(str(tmp_path / "out.tar"))
+    with pytest.raises(ValueError):
+        open_sink(str(tmp_path / "out.csv"))
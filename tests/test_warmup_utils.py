@@ -0,0 +1,49 @@
+import json
+import urllib.error
+import urllib.request
+
+import spacy
+
+from utils.warmup_utils import ModelWarmup, serve_readiness, synthetic_document
+
+
+def _get(server, path: str) -> tuple[int, dict]:
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_readiness_probe_answers_once_the_warm_up_completed():
+    warmup = ModelWarmup(spacy.blank("it"), lengths=[300, 1000])
+    server = serve_readiness(warmup, 0)
+    try:
+        warmup.observe(100, 0.5)  # served before the warm-up completed
+        assert _get(server, "/ready") == (503, {"ready": False})
+
+        assert warmup.start().wait(timeout=30)
+        warmup.observe(100, 0.01)
+        status, metrics = _get(server, "/metrics")
+        assert _get(server, "/ready") == (200, {"ready": True})
+        assert _get(server, "/health")[0] == 404
+    finally:
+        server.shutdown()
+
+    assert status == 200 and metrics["error"] is None
+    assert [entry["chars"] for entry in metrics["warmup"]] == [300, 1000]
+    assert metrics["latencies"]["cold"]["documents"] == 2 + 1 and metrics["latencies"]["warm"]["documents"] == 2 + 1
+    assert warmup.chars_per_second() is not None
+
+
+def test_failed_warm_up_is_ready_but_reported():
+    warmup = ModelWarmup(None, lengths=[100]).run()  # no model: labelling fails
+
+    assert warmup.ready.is_set() and warmup.error is not None
+    assert warmup.metrics()["error"]
+
+
+def test_synthetic_documents_have_the_requested_length():
+    assert [len(synthetic_document(chars, seed)) for seed, chars in enumerate([1, 500, 5000])] == [1, 500, 5000]
+    assert synthetic_document(500, 1) == synthetic_document(500, 1) != synthetic_document(500, 2)
@@ -1,12 +1,60 @@
+import io
 import os
-from typing import Iterable
+import re
+import json
+import hashlib
+import warnings
+from typing import BinaryIO, Iterable, Iterator, TextIO
 
 from spacy.tokens import Doc
-from docx import Document
-from PyPDF2 import PdfReader
 
-from config import PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS
-from utils.json_utils import read_json_file
+from config import PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS, SUPPORTED_EXTENSIONS
+from utils.compression_utils import (open_compressed, strip_compression_suffix, is_archive, iter_archive_members,
+                                     is_compression_available)
+from utils.span_utils import BinarySpanWriter, write_spans_jsonl
+from utils.reader_utils import read_pdf, read_docx
+from utils.profiling_utils import profile_stage
+
+PARAGRAPH_SEPARATOR = re.compile(r"\n[ \t\r]*\n\s*")
+
+def paragraph_offsets(text: str) -> list[tuple[int, int]]:
+    """
+    Returns the (start, end) character offsets of the paragraphs of a text, i.e. its non-blank blocks separated by
+    one or more blank lines. Separators are excluded from the paragraphs.
+    """
+    offsets, start = [], 0
+    for separator in PARAGRAPH_SEPARATOR.finditer(text):
+        if text[start:separator.start()].strip():
+            offsets.append((start, separator.start()))
+        start = separator.end()
+    if text[start:].strip():
+        offsets.append((start, len(text)))
+    return offsets
+
+def _selected_offsets(doc: Doc, labels_to_anonymize: Iterable[str] = None) -> list[tuple[int, int, str]]:
+    """Returns the sorted (start_char, end_char, label) offsets of the doc entities with the selected labels."""
+    labels_to_anonymize = None if labels_to_anonymize is None else set(labels_to_anonymize)
+    return [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents
+            if labels_to_anonymize is None or ent.label_ in labels_to_anonymize]
+
+def iter_redacted_pieces(text: str, offsets: Iterable[tuple[int, int, str]]) -> Iterator[str]:
+    """
+    Walks the given (start, end, label) offsets in order and yields the slices of the text between them,
+    alternated with the [LABEL] placeholders replacing them. Offsets must be sorted by start;
+    spans overlapping an already replaced one are ignored. Extra tuple fields (e.g. the standoff source) are ignored.
+    """
+    position = 0
+    for start, end, label, *_ in offsets:
+        if start < position:
+            continue
+        yield text[position:start]
+        yield f"[{label}]"
+        position = end
+    yield text[position:]
+
+def redact_text(text: str, offsets: Iterable[tuple[int, int, str]]) -> str:
+    """Replaces the given sorted (start, end, label) offsets of the text with [LABEL] placeholders in a single pass."""
+    return "".join(iter_redacted_pieces(text, offsets))
 
 def anonymize_doc(doc: Doc, labels_to_anonymize: Iterable[str]=None) -> str:
     """
@@ -16,61 +64,138 @@ def anonymize_doc(doc: Doc, labels_to_anonymize: Iterable[str]=None) -> str:
     :param labels_to_anonymize: Iterable of entity labels to anonymize (e.g. {"PER", "LOC"})
                                 If None, anonymizes ALL entities.
     """
-    labels_to_anonymize = set(ent.label_ for ent in doc.ents) if labels_to_anonymize is None else set(labels_to_anonymize)
-    text = doc.text
+    with profile_stage("anonymize_doc", len(doc.text)):
+        return redact_text(doc.text, _selected_offsets(doc, labels_to_anonymize))
 
-    # collect only entities whose label is in the allowed set
-    offsets = [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents if ent.label_ in labels_to_anonymize]
-    offsets.sort(reverse=True) # Replace from end to beginning to preserve offsets
-
-    for start, end, label in offsets:
-        text = text[:start] + f"[{label}]" + text[end:]
+def write_anonymized_doc(doc: Doc, file: TextIO, labels_to_anonymize: Iterable[str]=None) -> None:
+    """
+    Streaming variant of anonymize_doc, writing the anonymized text directly to an open file handle
+    without building the full output string.
+    """
+    for piece in iter_redacted_pieces(doc.text, _selected_offsets(doc, labels_to_anonymize)):
+        file.write(piece)
 
-    return text
+def anonymized_text_path(output_dir: str, original_filename: str) -> str:
+    """Returns the path of the anonymized .txt file of the given input file inside the output directory."""
+    base_name = os.path.splitext(os.path.basename(original_filename))[0]
+    return os.path.join(output_dir, f"{base_name}_anonymized.txt")
 
-def save_anonymized_text(text:str, output_path=None, output_dir=None, original_filename=None) -> str:
-    """Saves anonymized text to a .txt file and returns the output path."""
+def save_anonymized_text(text:str, output_path=None, output_dir=None, original_filename=None, sink=None) -> str:
+    """
+    Saves anonymized text to a .txt file and returns the output path.
+    With an output sink (see utils.sink_utils), the text is added to it as an entry named after the output path instead.
+    """
     if output_path:
         out_path = output_path
-    elif output_dir and original_filename:
-        base_name = os.path.splitext(os.path.basename(original_filename))[0]
-        out_path = os.path.join(output_dir, f"{base_name}_anonymized.txt")
+    elif output_dir is not None and original_filename:
+        out_path = anonymized_text_path(output_dir, original_filename)
     else:
         return
 
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(text)
+    with profile_stage("write", len(text)):
+        if sink is not None:
+            sink.write(out_path, text)
+        else:
+            with open(out_path, "w", encoding="utf-8") as f:
+                f.write(text)
     return out_path
 
-def save_many_texts(texts: list[str], output_dir: str, original_filename: str):
-    """Saves multiple anonymized texts to separate files in the specified directory."""
+def save_spans(spans_per_text: list[list[tuple]], output_path=None, output_dir=None, original_filename=None,
+               binary: bool = False, sink=None) -> str:
+    """
+    Saves the standoff spans of one or more texts to a single .jsonl (or binary .bin) file and returns its path.
+    With an output sink, the file is added to it as an entry instead.
+    """
+    if not output_path:
+        base_name = os.path.splitext(os.path.basename(original_filename))[0]
+        output_path = os.path.join(output_dir, f"{base_name}_spans{'.bin' if binary else '.jsonl'}")
+
+    with profile_stage("write"):
+        if sink is not None:
+            buffer = io.BytesIO() if binary else io.StringIO()
+            _write_spans(spans_per_text, buffer, binary)
+            sink.write(output_path, buffer.getvalue())
+        else:
+            with open(output_path, "wb") if binary else open(output_path, "w", encoding="utf-8") as f:
+                _write_spans(spans_per_text, f, binary)
+    return output_path
+
+def _write_spans(spans_per_text: list[list[tuple]], file, binary: bool) -> None:
+    if binary:
+        writer = BinarySpanWriter(file)
+        for spans in spans_per_text:
+            writer.write(spans)
+    else:
+        for i, spans in enumerate(spans_per_text):
+            write_spans_jsonl(file, spans, index=i)
+
+def save_many_texts(texts: list[str], output_dir: str, original_filename: str, sink=None):
+    """
+    Saves multiple anonymized texts to separate files in the specified directory, or as separate entries of an
+    output sink, with output_dir as their name prefix.
+    """
     base_name = os.path.splitext(os.path.basename(original_filename))[0]
-    os.makedirs(output_dir, exist_ok=True)
+    if sink is None:
+        os.makedirs(output_dir, exist_ok=True)
 
     if len(texts) == 1:
-        return save_anonymized_text(texts[0], output_dir=output_dir, original_filename=original_filename)
+        return save_anonymized_text(texts[0], output_dir=output_dir, original_filename=original_filename, sink=sink)
     else:
         for i, text in enumerate(texts):
             out_path = os.path.join(output_dir, f"{base_name}_anonymized_{i + 1}.txt")
-            save_anonymized_text(text, output_path=out_path, original_filename=original_filename)
+            save_anonymized_text(text, output_path=out_path, original_filename=original_filename, sink=sink)
         return output_dir
 
 def read_file(file_path) -> tuple[list[str], dict[str,str]|None]:
-    """Reads a file and returns its text content in form of a list of texts, combined with an optional dictionary of personal data."""
-    ext = os.path.splitext(file_path)[1].lower()
+    """
+    Reads a file and returns its text content in form of a list of texts, combined with an optional dictionary of personal data.
+    Compressed files (.gz, .bz2, .xz, .zst) are decompressed on the fly, and the texts of all the supported members of
+    zip and tar archives are returned in archive order, without extracting them to disk.
+    """
+    with profile_stage("read_file") as stage:
+        texts, dict = _read_file(file_path)
+        stage.chars = sum(len(text) for text in texts)
+    return texts, dict
+
+def _read_file(file_path) -> tuple[list[str], dict[str,str]|None]:
+    if not is_archive(file_path):
+        with open_compressed(file_path, "rb") as f:
+            return read_stream(f, file_path)
+
+    texts = []
+    for name, stream in iter_archive_members(file_path):
+        if is_supported_input(name) and not is_archive(name):
+            member_texts, member_data = read_stream(stream, name)
+            if member_data is not None:
+                raise ValueError(f"Archive member '{name}' holds personal data: anonymize the archive in directory mode, "
+                                 f"which processes each member as a separate document.")
+            texts.extend(member_texts)
+    return texts, None
+
+def _seekable(stream: BinaryIO) -> BinaryIO:
+    """Returns the stream if it is a plain file or in memory, otherwise its content in memory (PDF and DOCX readers seek)."""
+    return stream if isinstance(stream, (io.BufferedReader, io.BytesIO)) else io.BytesIO(stream.read())
+
+def read_stream(stream: BinaryIO, name: str) -> tuple[list[str], dict[str,str]|None]:
+    """
+    Like read_file, for an open binary stream (e.g. a decompressed file or an archive member), whose type is given by
+    the extension of its name, compression suffix excluded.
+    """
+    ext = os.path.splitext(strip_compression_suffix(name))[1].lower()
     dict = None
 
     if ext == ".txt":
-        with open(file_path, "r", encoding="utf-8") as f:
-            texts = [f.read()]
+        texts = [stream.read().decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")]  # as in text mode
     elif ext == ".docx":
-        doc = Document(file_path)
-        texts = ["\n".join([para.text for para in doc.paragraphs])]
+        texts = [read_docx(_seekable(stream))]
     elif ext == ".pdf":
-        reader = PdfReader(file_path)
-        texts = ["\n".join([page.extract_text() or "" for page in reader.pages])]
-    elif ext == ".json":
-        data = read_json_file(file_path)
+        texts = [read_pdf(_seekable(stream))]
+    elif ext in (".json", ".jsonl"):
+        content = stream.read().decode("utf-8-sig")
+        if ext == ".jsonl" or content.lstrip().startswith("["):
+            raise ValueError("File holds several patient records: anonymize it in directory mode or from the command line, "
+                             "which stream one patient at a time.")
+        data = json.loads(content)
         try:
             texts = [text[SINGLE_TEXT_FIELDS[1]] for text in data[PATIENT_DATA_FIELDS[1]]]
         except IndexError:
@@ -83,3 +208,47 @@ def read_file(file_path) -> tuple[list[str], dict[str,str]|None]:
         raise ValueError("Unsupported file type.")
 
     return texts, dict
+
+def is_supported_input(name: str) -> bool:
+    """
+    Returns whether a file name is a supported document, possibly compressed (e.g. notes.txt.gz), or an archive of
+    documents. Files compressed with zstd are only supported when the optional zstandard package is installed.
+    """
+    return _is_supported_type(name) and is_compression_available(name)
+
+
+def _is_supported_type(name: str) -> bool:
+    return is_archive(name) or strip_compression_suffix(name).lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def iter_input_files(root: str, recursive: bool = False, exclude: Iterable[str] = ()) -> Iterator[os.DirEntry]:
+    """
+    Lazily walks a directory with os.scandir, yielding the entries of supported files in sorted order. Supported
+    documents whose compression cannot be read (.zst files without the zstandard package) are skipped with a warning.
+
+    :param root: Directory to walk.
+    :param recursive: Whether to descend into subdirectories.
+    :param exclude: Paths to skip entirely (e.g. an output directory nested in the input one, or an output sink file).
+    """
+    excluded = {os.path.realpath(path) for path in exclude}
+    with os.scandir(root) as it:
+        entries = sorted(it, key=lambda e: e.name)
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if recursive and os.path.realpath(entry.path) not in excluded:
+                yield from iter_input_files(entry.path, recursive, excluded)
+        elif entry.is_file() and _is_supported_type(entry.name) and os.path.realpath(entry.path) not in excluded:
+            if is_compression_available(entry.name):
+                yield entry
+            else:
+                warnings.warn(f"Skipped '{entry.path}': reading .zst files requires the zstandard package "
+                              f"(pip install zstandard).", RuntimeWarning)
+
+def file_content_hash(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """Returns the SHA-256 hex digest of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
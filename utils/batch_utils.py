@@ -0,0 +1,378 @@
+import time
+import itertools
+from collections import deque
+from typing import BinaryIO, Callable, Iterable, Iterator, TextIO
+
+from spacy import Language
+from spacy.tokens import Doc, DocBin
+
+from config import PATIENT_DATA_FIELDS, SINGLE_TEXT_FIELDS, DEFAULT_BATCH_SIZE, DEFAULT_OUTPUT_FORMAT
+from rules.rules import apply_rules, get_rule_timeouts, rules_checksum
+from utils.anonymization_utils import redact_text, paragraph_offsets, iter_redacted_pieces
+from utils.json_utils import iter_jsonl, write_jsonl_record
+from utils.span_utils import StandoffSpan, BinarySpanWriter, doc_to_spans, write_spans_jsonl
+from utils.profiling_utils import profile_stage, profile_count
+from utils.cache_utils import ResultCache, ParagraphMemo, model_fingerprint, result_key
+from utils.ner_store_utils import add_ner_doc
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    """Yields consecutive lists of at most batch_size items, consuming the given iterable lazily."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def run_pipeline(nlp: Language, texts: list[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[Doc]:
+    """
+    Runs the tokenizer and then each pipeline component (e.g. transformer and ner) on a batch of texts,
+    timing every step as a separate profiling stage.
+    """
+    chars = sum(len(text) for text in texts)
+    with profile_stage("tokenizer", chars):
+        docs = [nlp.make_doc(text) for text in texts]
+    for name, proc in nlp.pipeline:
+        with profile_stage(name, chars):
+            docs = list(proc.pipe(docs, batch_size=batch_size)) if hasattr(proc, "pipe") else [proc(doc) for doc in docs]
+    return docs
+
+
+def label_texts(nlp: Language,
+                records: Iterable[tuple[str, dict[str, str] | None]],
+                per_matching: bool,
+                batch_size: int = DEFAULT_BATCH_SIZE,
+                ner_docs: DocBin = None) -> Iterator[Doc]:
+    """
+    Runs NER and rules on (text, personal_data) pairs, yielding one labelled Doc per pair in input order.
+    Texts are fed to the model in batches, so only one batch of documents is held in memory at a time.
+    If ner_docs is given, the output of the model is also added to it before rules are applied (see ner_store_utils).
+    """
+    for batch in iter_batches(records, batch_size):
+        docs = run_pipeline(nlp, [text for text, _ in batch], batch_size)
+        for doc, (_, personal_data) in zip(docs, batch):
+            if ner_docs is not None:
+                add_ner_doc(ner_docs, doc, personal_data)
+            yield apply_rules(doc, per_matching, personal_data)
+
+
+def label_spans(nlp: Language,
+                records: Iterable[tuple[str, dict[str, str] | None]],
+                entities: Iterable[str],
+                per_matching: bool,
+                batch_size: int = DEFAULT_BATCH_SIZE,
+                cache: ResultCache = None,
+                memo: ParagraphMemo = None) -> Iterator[tuple[list[StandoffSpan], list[str]]]:
+    """
+    Like label_texts, but yields the standoff spans of the selected entities of each text, together with the rules
+    that exceeded their timeout on it. With a result cache, texts already anonymized with the same model, rules and
+    options are not processed again, and new results are stored unless some rule timed out.
+    With a paragraph memo, texts are labelled paragraph by paragraph and repeated paragraphs are processed only once
+    (see label_paragraphs).
+    """
+    entities = list(entities)
+    if cache is not None:
+        model, rules = model_fingerprint(nlp), rules_checksum()
+
+    for batch in iter_batches(records, batch_size):
+        if cache is None:
+            keys, cached = list(range(len(batch))), {}
+        else:
+            keys = [result_key(text, model, rules, per_matching, personal_data, entities, memo is not None)
+                    for text, personal_data in batch]
+            cached = cache.get_many(keys)
+
+        missing = [(key, record) for key, record in zip(keys, batch) if key not in cached]
+        if memo is None:
+            docs = label_texts(nlp, [record for _, record in missing], per_matching, batch_size)
+            results = ((doc_to_spans(doc, entities), get_rule_timeouts(doc)) for doc in docs)
+        else:
+            results = label_paragraphs(nlp, [record for _, record in missing], entities, per_matching, memo, batch_size)
+        labelled = {key: result for (key, _), result in zip(missing, results)}
+        if cache is not None:
+            cache.put_many({key: spans for key, (spans, timeouts) in labelled.items() if not timeouts})
+
+        for key in keys:
+            yield (cached[key], []) if key in cached else labelled[key]
+
+
+def label_paragraphs(nlp: Language,
+                     records: list[tuple[str, dict[str, str] | None]],
+                     entities: list[str],
+                     per_matching: bool,
+                     memo: ParagraphMemo,
+                     batch_size: int = DEFAULT_BATCH_SIZE) -> list[tuple[list[StandoffSpan], list[str]]]:
+    """
+    Labels (text, personal_data) pairs paragraph by paragraph, running NER and rules only on the paragraphs that are
+    neither in the memo nor repeated earlier in the same records, and re-basing the spans of every paragraph onto the
+    offsets of each text containing it. Paragraphs on which some rule timed out are not memoized.
+    The numbers of reused and processed paragraphs are reported as the 'paragraph_memo_hit' and 'paragraph_memo_miss'
+    profiling counters.
+
+    :return: The (spans, rule timeouts) of each text, in input order.
+    """
+    layouts, found, to_label = [], {}, {}
+    for text, personal_data in records:
+        layout = []
+        for start, end in paragraph_offsets(text):
+            paragraph = text[start:end]
+            key = memo.key(paragraph, personal_data, per_matching, entities)
+            if key not in found and key not in to_label:
+                if (spans := memo.get(key)) is not None:
+                    found[key] = (spans, [])
+                else:
+                    to_label[key] = (paragraph, personal_data)
+            layout.append((start, key))
+        layouts.append(layout)
+
+    docs = label_texts(nlp, to_label.values(), per_matching, batch_size)
+    for key, doc in zip(to_label, docs):
+        found[key] = (doc_to_spans(doc, entities), get_rule_timeouts(doc))
+        if not found[key][1]:
+            memo.put(key, found[key][0])
+
+    paragraphs = sum(len(layout) for layout in layouts)
+    profile_count("paragraph_memo_hit", paragraphs - len(to_label))
+    profile_count("paragraph_memo_miss", len(to_label))
+
+    results = []
+    for layout in layouts:
+        spans, timeouts = [], []
+        for offset, key in layout:
+            paragraph_spans, paragraph_timeouts = found[key]
+            spans += [(start + offset, end + offset, label, source) for start, end, label, source in paragraph_spans]
+            timeouts += [rule for rule in paragraph_timeouts if rule not in timeouts]
+        results.append((spans, timeouts))
+    return results
+
+
+def redact_spans(text: str, spans: list[StandoffSpan]) -> str:
+    """Redacts the spans of a text, timed as the 'anonymize_doc' profiling stage."""
+    with profile_stage("anonymize_doc", len(text)):
+        return redact_text(text, spans)
+
+
+def anonymize_texts(nlp: Language,
+                    texts: Iterable[str],
+                    entities: Iterable[str],
+                    per_matching: bool,
+                    personal_data: dict[str, str] = None,
+                    batch_size: int = DEFAULT_BATCH_SIZE,
+                    cache: ResultCache = None,
+                    memo: ParagraphMemo = None,
+                    rule_timeouts: list[str] = None) -> Iterator[str]:
+    """
+    Anonymizes the given texts in batches, all sharing the same optional personal data dictionary, result cache
+    and paragraph memo. If rule_timeouts is given, the rules that exceeded their timeout on some text are added to it.
+    """
+    texts, forwarded = itertools.tee(texts)
+    records = ((text, personal_data) for text in forwarded)
+    for text, (spans, timeouts) in zip(texts, label_spans(nlp, records, entities, per_matching, batch_size, cache, memo)):
+        add_rule_timeouts(rule_timeouts, timeouts)
+        yield redact_spans(text, spans)
+
+
+def extract_spans(nlp: Language,
+                  texts: Iterable[str],
+                  entities: Iterable[str],
+                  per_matching: bool,
+                  personal_data: dict[str, str] = None,
+                  batch_size: int = DEFAULT_BATCH_SIZE,
+                  cache: ResultCache = None,
+                  memo: ParagraphMemo = None,
+                  rule_timeouts: list[str] = None) -> Iterator[list[StandoffSpan]]:
+    """Like anonymize_texts, but yields the (start, end, label, source) standoff spans of each text instead of rewriting it."""
+    records = ((text, personal_data) for text in texts)
+    for spans, timeouts in label_spans(nlp, records, entities, per_matching, batch_size, cache, memo):
+        add_rule_timeouts(rule_timeouts, timeouts)
+        yield spans
+
+
+def label_chunks(nlp: Language,
+                 chunks: Iterable[str],
+                 entities: Iterable[str],
+                 per_matching: bool,
+                 personal_data: dict[str, str] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 cache: ResultCache = None,
+                 memo: ParagraphMemo = None,
+                 rule_timeouts: list[str] = None) -> Iterator[tuple[str, list[StandoffSpan]]]:
+    """
+    Labels a document read lazily in chunks (e.g. the pages of a PDF or paragraph-aligned pieces of a large text
+    file), each chunk on its own while the following ones are still being read, yielding every chunk with its spans.
+    Only a batch of chunks is held in memory at a time. If rule_timeouts is given, the rules that exceeded their
+    timeout on some chunk are added to it.
+    """
+    chunks, forwarded = itertools.tee(chunks)
+    records = ((chunk, personal_data) for chunk in forwarded)
+    for chunk, (spans, timeouts) in zip(chunks, label_spans(nlp, records, list(entities), per_matching, batch_size, cache, memo)):
+        add_rule_timeouts(rule_timeouts, timeouts)
+        yield chunk, spans
+
+
+def add_rule_timeouts(rule_timeouts: list[str] | None, timeouts: Iterable[str]) -> None:
+    """Adds the rules that timed out on a text to the rules collected for a whole document or run, if collected."""
+    if rule_timeouts is not None:
+        rule_timeouts += [rule for rule in timeouts if rule not in rule_timeouts]
+
+
+def write_anonymized_chunks(labelled: Iterable[tuple[str, list[StandoffSpan]]], file: TextIO, separator: str = "") -> None:
+    """Writes the labelled chunks of a document to an open stream as they come, redacted and joined by the separator."""
+    for i, (chunk, spans) in enumerate(labelled):
+        with profile_stage("write", len(chunk)):
+            if i:
+                file.write(separator)
+            file.writelines(iter_redacted_pieces(chunk, spans))
+
+
+def join_chunk_spans(labelled: Iterable[tuple[str, list[StandoffSpan]]], separator: str = "") -> list[StandoffSpan]:
+    """Returns the spans of the labelled chunks of a document re-based onto the chunks joined by the separator."""
+    document_spans, offset = [], 0
+    for chunk, spans in labelled:
+        document_spans += [(start + offset, end + offset, label, source) for start, end, label, source in spans]
+        offset += len(chunk) + len(separator)
+    return document_spans
+
+
+def anonymize_jsonl(input_file: TextIO,
+                    output_file: TextIO | BinaryIO,
+                    nlp: Language,
+                    entities: Iterable[str],
+                    per_matching: bool,
+                    personal_data: dict[str, str] = None,
+                    batch_size: int = DEFAULT_BATCH_SIZE,
+                    output_format: str = DEFAULT_OUTPUT_FORMAT,
+                    cache: ResultCache = None,
+                    memo: ParagraphMemo = None,
+                    latency: Callable[[int, float], None] = None) -> int:
+    """
+    Anonymizes a JSON Lines stream record by record. Each record must contain a 'testo' field and may contain an
+    'anagrafica' dictionary of personal data, which takes precedence over the given one. Records are processed in
+    rolling batches and every output line is written and flushed as soon as its batch completes, so memory usage
+    does not depend on the length of the stream.
+    Output records keep all input fields except the personal data, with the text replaced by its anonymized version
+    or, in 'standoff' format, by a 'spans' list. In 'standoff-binary' format only the spans are written, in input order.
+    Records on which some rule exceeded its timeout are flagged with the list of those rules in a 'rule_timeouts' field.
+
+    :param input_file: Open text stream of JSON records, one per line.
+    :param output_file: Open stream where anonymized records are written (binary for 'standoff-binary').
+    :param personal_data: Default personal data used for records without an 'anagrafica' field.
+    :param output_format: One of 'text', 'standoff' or 'standoff-binary'.
+    :param cache: Optional result cache, skipping NER and rules for records anonymized in previous runs.
+    :param memo: Optional paragraph memo, labelling each repeated paragraph of the stream only once.
+    :param latency: Optional function called with the characters and the seconds of every batch, from the moment its
+        records are read until they are written (e.g. ModelWarmup.observe).
+    :return: Number of processed records.
+    """
+    entities = list(entities)
+    text_field, data_field = SINGLE_TEXT_FIELDS[1], PATIENT_DATA_FIELDS[0]
+    binary_writer = BinarySpanWriter(output_file) if output_format == "standoff-binary" else None
+    count = 0
+
+    for batch in iter_batches(iter_jsonl(input_file), batch_size):
+        start = time.perf_counter()
+        records = []
+        for record in batch:
+            if not isinstance(record, dict) or not isinstance(record.get(text_field), str):
+                raise ValueError(f"Record {count + len(records) + 1} must be a JSON object with a '{text_field}' string field.")
+            records.append((record[text_field], record.get(data_field, personal_data)))
+
+        for record, (spans, timeouts) in zip(batch, label_spans(nlp, records, entities, per_matching, batch_size, cache, memo)):
+            output = {key: value for key, value in record.items() if key != data_field}
+            if timeouts:
+                output["rule_timeouts"] = timeouts
+            if output_format == "text":
+                output[text_field] = redact_spans(record[text_field], spans)
+            with profile_stage("write", len(record[text_field])):
+                if binary_writer is not None:
+                    binary_writer.write(spans)
+                elif output_format == "standoff":
+                    output.pop(text_field)
+                    write_spans_jsonl(output_file, spans, **output)
+                else:
+                    write_jsonl_record(output_file, output)
+
+        output_file.flush()
+        count += len(batch)
+        if latency is not None:
+            latency(sum(len(text) for text, _ in records), time.perf_counter() - start)
+
+    return count
+
+
+def anonymize_patients(patients: Iterable[dict],
+                       output_file: TextIO | BinaryIO,
+                       nlp: Language,
+                       entities: Iterable[str],
+                       per_matching: bool,
+                       personal_data: dict[str, str] = None,
+                       batch_size: int = DEFAULT_BATCH_SIZE,
+                       output_format: str = DEFAULT_OUTPUT_FORMAT,
+                       cache: ResultCache = None,
+                       memo: ParagraphMemo = None,
+                       rule_timeouts: list[str] = None) -> int:
+    """
+    Anonymizes a stream of patient records, as found in registry exports (a JSON array or JSON Lines of objects with
+    an 'anagrafica' dictionary and a 'testi' list of entries with a 'testo' field). The personal data of each patient
+    is applied to its own texts only. Texts of consecutive patients are batched together, and each patient is written
+    as a JSON Lines record as soon as all its texts are labelled, so memory does not depend on the size of the export.
+    Output records keep all fields except the personal data, with the text of each entry replaced by its anonymized
+    version or, in 'standoff' format, by a 'spans' list. In 'standoff-binary' format only the spans of each text are
+    written, in input order.
+
+    :param patients: Iterable of patient records, e.g. from iter_json_records.
+    :param output_file: Open stream where anonymized records are written (binary for 'standoff-binary').
+    :param personal_data: Default personal data used for patients without an 'anagrafica' field.
+    :param output_format: One of 'text', 'standoff' or 'standoff-binary'.
+    :param rule_timeouts: Optional list to which the rules that exceeded their timeout on some text are added, besides
+                          the 'rule_timeouts' field of its entry.
+    :return: Number of processed patients.
+    """
+    entities = list(entities)
+    data_field, texts_field, text_field = PATIENT_DATA_FIELDS[0], PATIENT_DATA_FIELDS[1], SINGLE_TEXT_FIELDS[1]
+    binary_writer = BinarySpanWriter(output_file) if output_format == "standoff-binary" else None
+    pending = deque()  # patients whose texts were handed to the model, with their entries labelled so far
+    count = 0
+
+    def records() -> Iterator[tuple[str, dict[str, str] | None]]:
+        for number, patient in enumerate(patients, start=1):
+            entries = patient.get(texts_field) if isinstance(patient, dict) else None
+            if not isinstance(entries, list) or not all(isinstance(entry, dict) and isinstance(entry.get(text_field), str)
+                                                        for entry in entries):
+                raise ValueError(f"Patient record {number} must be a JSON object with a '{texts_field}' list of entries "
+                                 f"with a '{text_field}' string field.")
+            pending.append((patient, []))
+            for entry in entries:
+                yield entry[text_field], patient.get(data_field) or personal_data
+
+    def write_completed() -> None:
+        nonlocal count
+        while pending and len(pending[0][1]) == len(pending[0][0][texts_field]):
+            patient, labelled = pending.popleft()
+            output = {key: value for key, value in patient.items() if key not in (data_field, texts_field)}
+            output[texts_field] = []
+            for entry, (spans, timeouts) in zip(patient[texts_field], labelled):
+                output_entry = dict(entry)
+                if timeouts:
+                    output_entry["rule_timeouts"] = timeouts
+                if output_format == "text":
+                    output_entry[text_field] = redact_spans(entry[text_field], spans)
+                else:
+                    output_entry.pop(text_field)
+                    output_entry["spans"] = [list(span) for span in spans]
+                output[texts_field].append(output_entry)
+            with profile_stage("write", sum(len(entry[text_field]) for entry in patient[texts_field])):
+                if binary_writer is not None:
+                    for spans, _ in labelled:
+                        binary_writer.write(spans)
+                else:
+                    write_jsonl_record(output_file, output)
+            count += 1
+
+    for result in label_spans(nlp, records(), entities, per_matching, batch_size, cache, memo):
+        add_rule_timeouts(rule_timeouts, result[1])
+        write_completed()  # patients without texts
+        pending[0][1].append(result)
+        write_completed()
+    write_completed()
+    output_file.flush()
+    return count
@@ -0,0 +1,206 @@
+import json
+import hashlib
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Iterable
+
+from spacy import Language
+
+from config import DEFAULT_CACHE_MAX_MB, DEFAULT_PARAGRAPH_MEMO_SIZE
+from utils.span_utils import StandoffSpan
+from utils.profiling_utils import profile_count
+
+EVICTION_TARGET = 0.9  # fraction of the size bound the cache is brought back to when it overflows
+
+
+def model_fingerprint(nlp: Language) -> str:
+    """
+    Returns a hash of the model meta.json. Beyond name and version, which are often left to their defaults, the meta
+    holds the labels and the evaluation scores of the trained pipeline, so retrained models get a different fingerprint.
+    """
+    return hashlib.sha256(json.dumps(nlp.meta, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def result_key(text: str,
+               model: str,
+               rules: str,
+               per_matching: bool,
+               personal_data: dict[str, str] | None,
+               entities: Iterable[str],
+               paragraph_dedup: bool = False) -> str:
+    """
+    Returns the cache key of an anonymization result: a hash of the text together with everything the result
+    depends on (model fingerprint, rules checksum, per_matching flag, personal data, selected entities and whether
+    paragraphs were labelled separately).
+    """
+    payload = json.dumps([model, rules, per_matching, personal_data, sorted(entities), paragraph_dedup, text],
+                         ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent content-addressed SQLite cache of anonymization results, mapping result keys to the final standoff
+    spans of a text, so that unchanged texts skip NER and rules entirely. Stored results are kept below max_mb
+    megabytes by evicting the least recently used ones. Hits and misses are counted both for the current session
+    and cumulatively in the database.
+    """
+
+    def __init__(self, path: str, max_mb: float = DEFAULT_CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Shared by the worker processes of a batch run; within a process, used by one thread at a time (e.g. the model
+        # stage of the staged pipeline, while the cache is opened and closed by the main thread)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                spans TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[StandoffSpan]]:
+        """Returns the cached spans of the given keys that are present, refreshing their last access time."""
+        found = {}
+        for start in range(0, len(keys), 500):  # stay below the SQLite limit of bound parameters
+            chunk = keys[start:start + 500]
+            rows = self.conn.execute(f"SELECT key, spans FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((key, [tuple(span) for span in json.loads(spans)]) for key, spans in rows)
+
+        hits, misses = len(found), len(keys) - len(found)
+        now = time.time()
+        self.conn.executemany("UPDATE results SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+        self._increment(hits=hits, misses=misses)
+        self.conn.commit()
+        self.hits += hits
+        self.misses += misses
+        profile_count("result_cache_hit", hits)
+        profile_count("result_cache_miss", misses)
+        return found
+
+    def put_many(self, results: dict[str, list[StandoffSpan]]) -> None:
+        """Stores the spans of the given keys, then evicts the least recently used results if the cache is too large."""
+        now = time.time()
+        added_bytes = 0
+        for key, spans in results.items():
+            value = json.dumps([list(span) for span in spans], ensure_ascii=False, separators=(",", ":"))
+            size = len(key) + len(value.encode("utf-8"))
+            # Results are content-addressed, so an already stored key holds the same spans
+            cursor = self.conn.execute("INSERT OR IGNORE INTO results (key, spans, size, last_access) VALUES (?, ?, ?, ?)",
+                                       (key, value, size, now))
+            added_bytes += size * cursor.rowcount
+        self._increment(size_bytes=added_bytes)
+        self.conn.commit()
+        if self.size_bytes() > self.max_bytes:
+            self._evict()
+
+    def _increment(self, **counters: int) -> None:
+        self.conn.executemany("INSERT INTO counters (name, value) VALUES (?, ?) "
+                              "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", list(counters.items()))
+
+    def _counter(self, name: str) -> int:
+        row = self.conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def size_bytes(self) -> int:
+        """Returns the total size of the stored keys and spans."""
+        return self._counter("size_bytes")
+
+    def _evict(self) -> None:
+        """
+        Deletes the least recently used results until the cache is below EVICTION_TARGET of its size bound. Worker
+        processes sharing the cache can evict at the same time, so the size is read, the results selected and deleted
+        in a single IMMEDIATE transaction holding the write lock, and only the sizes of deleted rows are subtracted.
+        """
+        self.conn.commit()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            excess = self.size_bytes() - self.max_bytes * EVICTION_TARGET
+            selected, selected_bytes = [], 0
+            cursor = self.conn.execute("SELECT key, size FROM results ORDER BY last_access")
+            for key, size in cursor:
+                if selected_bytes >= excess:
+                    break
+                selected.append((key, size))
+                selected_bytes += size
+            cursor.close()
+            freed = evicted = 0
+            for key, size in selected:
+                deleted = self.conn.execute("DELETE FROM results WHERE key = ?", (key,)).rowcount
+                freed += size * deleted
+                evicted += deleted
+            self._increment(size_bytes=-freed)
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.evictions += evicted
+        profile_count("result_cache_eviction", evicted)
+
+    def totals(self) -> dict[str, int]:
+        """Returns the hits and misses recorded in the database by all sessions."""
+        return {"hits": self._counter("hits"), "misses": self._counter("misses")}
+
+    def stats(self) -> dict:
+        """Returns entries, size and hit rate of the current session, together with the cumulative totals."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0],
+            "size_bytes": self.size_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "totals": self.totals(),
+        }
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ParagraphMemo:
+    """
+    In-memory memo of the spans found in single paragraphs, with offsets relative to the paragraph start, so that
+    paragraphs repeated within and across documents of a run (letterheads, footers, template sentences) go through
+    NER and rules only once. Keys depend on the paragraph text, the personal data and the options of the run.
+    The least recently used paragraphs are dropped beyond max_paragraphs entries.
+    """
+
+    def __init__(self, max_paragraphs: int = DEFAULT_PARAGRAPH_MEMO_SIZE):
+        self.max_paragraphs = max_paragraphs
+        self.entries: OrderedDict[str, list[StandoffSpan]] = OrderedDict()
+
+    @staticmethod
+    def key(paragraph: str, personal_data: dict[str, str] | None, per_matching: bool, entities: Iterable[str]) -> str:
+        payload = json.dumps([per_matching, personal_data, sorted(entities), paragraph],
+                             ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> list[StandoffSpan] | None:
+        spans = self.entries.get(key)
+        if spans is not None:
+            self.entries.move_to_end(key)
+        return spans
+
+    def put(self, key: str, spans: list[StandoffSpan]) -> None:
+        self.entries[key] = spans
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_paragraphs:
+            self.entries.popitem(last=False)
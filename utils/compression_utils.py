@@ -0,0 +1,105 @@
+import os
+import bz2
+import gzip
+import lzma
+import tarfile
+import zipfile
+from typing import BinaryIO, Iterator
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for .zst files
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".tgz": "gzip", ".bz2": "bz2", ".xz": "xz", ".zst": "zstd"}
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst")
+
+
+def compression_of(path: str) -> str | None:
+    """Returns the compression of a file ('gzip', 'bz2', 'xz' or 'zstd') according to its extension, if any."""
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def is_compression_available(path: str) -> bool:
+    """Returns whether the compression of a file, if any, can be read and written (zstd needs the zstandard package)."""
+    return compression_of(path) != "zstd" or zstandard is not None
+
+
+def strip_compression_suffix(path: str) -> str:
+    """Returns the path without its compression extension, e.g. 'notes.jsonl' for 'notes.jsonl.gz'."""
+    base, ext = os.path.splitext(path)
+    if ext.lower() == ".tgz":
+        return base + ".tar"
+    return base if ext.lower() in COMPRESSION_SUFFIXES else path
+
+
+def open_compressed(path: str, mode: str = "wb") -> BinaryIO:
+    """
+    Opens a binary stream on a file, compressing or decompressing it on the fly according to its extension
+    (plain files are opened as they are). Modes are 'rb', 'wb', 'xb' and 'ab'; appending to compressed files adds a new
+    frame, which all the supported decompressors read as a continuation of the same stream.
+    """
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, mode)
+    if compression == "bz2":
+        return bz2.open(path, mode)
+    if compression == "xz":
+        return lzma.open(path, mode)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError(f"Reading or writing '{path}' requires the zstandard package (pip install zstandard).")
+        if mode == "rb":
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True, read_across_frames=True)
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode), closefd=True)
+    return open(path, mode)
+
+
+def decompress_stream(stream: BinaryIO, name: str) -> BinaryIO:
+    """Wraps a binary stream (e.g. an archive member) so that it is decompressed on the fly according to the name extension."""
+    compression = compression_of(name)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if compression == "bz2":
+        return bz2.BZ2File(stream, "rb")
+    if compression == "xz":
+        return lzma.LZMAFile(stream, "rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError(f"Reading '{name}' requires the zstandard package (pip install zstandard).")
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    return stream
+
+
+def is_archive(path: str) -> bool:
+    """Returns whether the path is a zip or tar archive (optionally compressed), whose members are separate documents."""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def archive_base_name(path: str) -> str:
+    """Returns the file name of an archive without its archive extension, e.g. 'bundle' for 'exports/bundle.tar.gz'."""
+    name = os.path.basename(path)
+    for ext in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def iter_archive_members(path: str) -> Iterator[tuple[str, BinaryIO]]:
+    """
+    Yields the (name, stream) pairs of the regular files of a zip or tar archive, in archive order, decompressing
+    compressed members on the fly. Tar archives are read as a single stream, without seeking, so each member must
+    be read before moving to the next one, and nothing is extracted to disk.
+    """
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as member:
+                        yield info.filename, decompress_stream(member, info.filename)
+        return
+
+    with open_compressed(path, "rb") as f, tarfile.open(fileobj=f, mode="r|") as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, decompress_stream(archive.extractfile(member), member.name)
@@ -0,0 +1,168 @@
+import time
+import queue
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, Iterable
+
+import spacy
+from spacy import Language
+
+from config import (DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, DEADLINE_INITIAL_CHARS_PER_SECOND, DEADLINE_MIN_RULE_SECONDS,
+                    DOCX_CHUNK_CHARS)
+from rules.rules import apply_rules
+from utils.anonymization_utils import redact_text
+from utils.batch_utils import label_spans, join_chunk_spans
+from utils.reader_utils import iter_chunks
+from utils.span_utils import StandoffSpan, doc_to_spans
+
+_CANCEL, _INTERACTIVE, _BACKGROUND, _STOP = -1, 0, 1, 2  # priorities, _CANCEL stops before the queued tasks
+
+
+class _ModelThread:
+    """Single thread running the model, which takes the interactive tasks before the background ones."""
+
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._thread = threading.Thread(target=self._run, name="deadline-model", daemon=True)
+        self._thread.start()
+
+    def submit(self, priority: int, fn: Callable, *args) -> Future:
+        future = Future()
+        self._queue.put((priority, next(self._order), fn, args, future))
+        return future
+
+    def close(self, cancel_pending: bool = False) -> None:
+        """Stops the thread after the queued tasks, or, with cancel_pending, after the running one, cancelling the others."""
+        self._queue.put((_CANCEL if cancel_pending else _STOP, next(self._order), None, (), None))
+        self._thread.join()
+        while not self._queue.empty():
+            future = self._queue.get()[4]
+            if future is not None:
+                future.cancel()
+
+    def _run(self) -> None:
+        while (task := self._queue.get())[0] not in (_STOP, _CANCEL):
+            _, _, fn, args, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+
+class DeadlineLabeller:
+    """
+    Labels documents within a per-document deadline, for interactive use (e.g. a GUI preview or single requests).
+    Documents are labelled in paragraph-aligned chunks, and the inference time of each chunk is predicted from the
+    model throughput (a moving average of the characters per second of the previous chunks). A chunk that would not
+    fit in the time left, or whose inference is still running when the deadline expires, is labelled, together with
+    the following ones, by the rules alone (apply_rules on the tokenized text: regexes, personal data, registry and
+    place dictionaries), which takes a fraction of the time of the model. The fallback runs on the calling thread
+    with its own tokenizer and vocab, since the model thread may still be using those of the pipeline, and each rule
+    is limited to the time left (at least DEADLINE_MIN_RULE_SECONDS). The name dictionaries of per_matching are
+    left to the full-quality pass unless fallback_per_matching is set, since they take seconds per chunk. Such results are marked as degraded, and the full-quality pass of the
+    document is queued in the background, reusing the chunks the model already labelled; its Future is returned
+    with the result. The model runs on a single thread, which takes the chunks of new documents before queued
+    background passes.
+
+    :param nlp: Loaded spaCy pipeline.
+    :param entities: Entity labels to anonymize.
+    :param per_matching: Whether the full-quality pass uses the dictionary matching of PER and PATIENT entities.
+    :param deadline_seconds: Time budget of each document.
+    :param chars_per_second: Model throughput assumed before the first chunk is labelled.
+    :param chunk_chars: Approximate size of the chunks documents are labelled in.
+    :param fallback_per_matching: Whether the rules-only fallback also matches the name dictionaries.
+    """
+
+    def __init__(self, nlp: Language, entities: Iterable[str] = DEFAULT_ENTITIES,
+                 per_matching: bool = DEFAULT_EXTRA_PER_MATCHING, deadline_seconds: float = 1.0,
+                 chars_per_second: float = DEADLINE_INITIAL_CHARS_PER_SECOND, chunk_chars: int = DOCX_CHUNK_CHARS,
+                 fallback_per_matching: bool = False):
+        self.nlp, self.entities, self.per_matching = nlp, list(entities), per_matching
+        self.deadline_seconds = deadline_seconds
+        self.chars_per_second = chars_per_second
+        self.chunk_chars = chunk_chars
+        self.fallback_per_matching = fallback_per_matching
+        self.stats = {"documents": 0, "degraded": 0, "degraded_chunks": 0}
+        self._fallback_nlp = spacy.blank(nlp.lang)
+        self._model = _ModelThread()
+
+    def label(self, text: str, personal_data: dict[str, str] = None) -> tuple[list[StandoffSpan], bool, Future | None]:
+        """
+        Returns the spans of a document found within the deadline, whether they are degraded, and, if so, the Future
+        of the spans of the full-quality pass.
+        """
+        deadline = time.perf_counter() + self.deadline_seconds
+        chunks = list(iter_chunks(text.split("\n"), "\n", self.chunk_chars))
+        labelled: list[list[StandoffSpan]] = []
+        results: list[list[StandoffSpan] | Future | None] = []  # model output of each chunk, for the full-quality pass
+        degraded = False
+        for chunk in chunks:
+            remaining = deadline - time.perf_counter()
+            if not degraded and len(chunk) / self.chars_per_second <= remaining:
+                future = self._model.submit(_INTERACTIVE, self._label_chunk, chunk, personal_data)
+                try:
+                    results.append(future.result(timeout=max(remaining, 0)))
+                    labelled.append(results[-1])
+                    continue
+                except TimeoutError:
+                    results.append(None if future.cancel() else future)  # a started chunk is reused by the full pass
+            else:
+                results.append(None)
+            degraded = True
+            labelled.append(self._rules_only(chunk, personal_data, deadline - time.perf_counter()))
+            self.stats["degraded_chunks"] += 1
+
+        self.stats["documents"] += 1
+        if not degraded:
+            return join_chunk_spans(zip(chunks, labelled), "\n"), False, None
+        self.stats["degraded"] += 1
+        full = self._model.submit(_BACKGROUND, self._complete, chunks, results, personal_data)
+        return join_chunk_spans(zip(chunks, labelled), "\n"), True, full
+
+    def anonymize(self, text: str, personal_data: dict[str, str] = None) -> tuple[str, bool, Future | None]:
+        """Like label, but returns the redacted text, and a Future of the redacted text of the full-quality pass."""
+        spans, degraded, full = self.label(text, personal_data)
+        if full is None:
+            return redact_text(text, spans), degraded, None
+        redacted = Future()
+
+        def on_full_done(done: Future) -> None:
+            if done.cancelled():
+                redacted.cancel()
+            elif done.exception() is not None:
+                redacted.set_exception(done.exception())
+            else:
+                redacted.set_result(redact_text(text, done.result()))
+
+        full.add_done_callback(on_full_done)
+        return redact_text(text, spans), degraded, redacted
+
+    def close(self, cancel_pending: bool = False) -> None:
+        """
+        Stops the model thread, waiting for the queued full-quality passes, or, with cancel_pending, cancelling the
+        ones that did not start yet.
+        """
+        self._model.close(cancel_pending)
+
+    def _label_chunk(self, chunk: str, personal_data: dict[str, str] | None) -> list[StandoffSpan]:
+        start = time.perf_counter()
+        spans, _ = next(label_spans(self.nlp, [(chunk, personal_data)], self.entities, self.per_matching))
+        seconds = time.perf_counter() - start
+        if seconds > 0 and chunk:
+            self.chars_per_second = 0.8 * self.chars_per_second + 0.2 * len(chunk) / seconds
+        return spans
+
+    def _rules_only(self, chunk: str, personal_data: dict[str, str] | None, remaining: float) -> list[StandoffSpan]:
+        doc = apply_rules(self._fallback_nlp.make_doc(chunk), self.fallback_per_matching, personal_data,
+                          max(remaining, DEADLINE_MIN_RULE_SECONDS))
+        return doc_to_spans(doc, self.entities)
+
+    def _complete(self, chunks: list[str], results: list, personal_data: dict[str, str] | None) -> list[StandoffSpan]:
+        """Full-quality pass, run on the model thread after the chunks still running (which have higher priority)."""
+        labelled = [spans.result() if isinstance(spans, Future) else spans if spans is not None
+                    else self._label_chunk(chunk, personal_data) for chunk, spans in zip(chunks, results)]
+        return join_chunk_spans(zip(chunks, labelled), "\n")
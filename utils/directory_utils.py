@@ -0,0 +1,331 @@
+import io
+import os
+import json
+import functools
+import multiprocessing
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from typing import Callable, Iterable
+
+from config import (DEFAULT_BATCH_SIZE, DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, DEFAULT_WORKERS,
+                    MANIFEST_FILENAME, DEFAULT_OUTPUT_FORMAT, DEFAULT_CACHE_MAX_MB, DEFAULT_PDF_WORKERS, PDF_PAGE_SEPARATOR,
+                    DEFAULT_READER_THREADS, DEFAULT_READ_QUEUE_SIZE, DEFAULT_WRITE_QUEUE_SIZE, DEFAULT_MAX_TASKS_PER_WORKER,
+                    DEFAULT_MAX_WORKER_RSS_MB)
+from rules.patient_registry import load_patient_registry
+from utils.anonymization_utils import save_spans, iter_input_files, file_content_hash, anonymized_text_path
+from utils.reader_utils import iter_pdf_pages, iter_text_chunks
+from utils.span_utils import StandoffSpan
+from utils.profiling_utils import get_profiler
+from utils.manifest_utils import Manifest, STATUS_DONE, STATUS_FAILED, STATUS_RULE_TIMEOUT
+from utils.cache_utils import ResultCache
+from utils.sink_utils import open_sink
+from utils.pipeline_utils import StagedPipeline
+from utils.scheduling_utils import LargestFirstScheduler, estimate_cost, plan_parts
+from utils.pool_utils import WorkerPool
+from utils.ner_store_utils import ner_store_path
+from utils.batch_utils import label_chunks, add_rule_timeouts, write_anonymized_chunks, join_chunk_spans
+from utils.worker_utils import (WorkerContext, create_context, init_worker, worker_context, load_worker_model,
+                                anonymize_file, open_output)
+from utils.file_pipeline_utils import FileStages
+
+
+def label_part(ctx: WorkerContext, input_path: str,
+               bounds: tuple[int, int]) -> tuple[str | list[StandoffSpan], int, dict | None, list[str]]:
+    """
+    Labels one part of a long .txt or PDF document split by the scheduler (see plan_parts): the chunks of a byte range
+    or the pages of a page range. Returns the redacted text of the part, or its spans relative to the part in standoff
+    formats, together with its length in characters, the profiling measures of the worker and the rules that exceeded
+    their timeout on the part.
+    """
+    if input_path.lower().endswith(".pdf"):
+        chunks, separator = iter_pdf_pages(input_path, pages=range(*bounds)), PDF_PAGE_SEPARATOR
+    else:
+        chunks, separator = iter_text_chunks(input_path, start=bounds[0], end=bounds[1]), ""
+    rule_timeouts = []
+    labelled = list(label_chunks(ctx.nlp, chunks, ctx.entities, ctx.per_matching, ctx.personal_data, ctx.batch_size,
+                                 ctx.cache, ctx.memo, rule_timeouts))
+    length = sum(len(chunk) for chunk, _ in labelled) + len(separator) * max(len(labelled) - 1, 0)
+    if ctx.output_format == "text":
+        buffer = io.StringIO()
+        write_anonymized_chunks(labelled, buffer, separator)
+        payload = buffer.getvalue()
+    else:
+        payload = join_chunk_spans(labelled, separator)
+    return payload, length, ctx.profile_snapshot(), rule_timeouts
+
+def _file_task(*job) -> tuple[str, dict | None, list | None, list[str]]:
+    """Task of a worker process anonymizing a whole file with the context of the process (see anonymize_file)."""
+    return anonymize_file(worker_context(), *job)
+
+def _part_task(input_path: str, bounds: tuple[int, int]) -> tuple[str | list[StandoffSpan], int, dict | None, list[str]]:
+    """Task of a worker process labelling a part of a document with the context of the process (see label_part)."""
+    return label_part(worker_context(), input_path, bounds)
+
+class _SplitDocument:
+    """
+    Long document whose parts are labelled by different workers (see label_part) and complete in any order.
+    Once all the parts are done, they are joined, in the parent, into the same output as the whole document, and
+    done receives the outcome like the result of anonymize_file. A failing part fails the whole document.
+    """
+
+    def __init__(self, input_path: str, output_dir: str, parts: int, output_format: str, sink,
+                 done: Callable[[Callable[[], tuple]], None]):
+        self.input_path, self.output_dir, self.output_format, self.sink, self.done = input_path, output_dir, output_format, sink, done
+        self.results: list[tuple | None] = [None] * parts
+        self.remaining = parts
+        self.error: Exception | None = None
+
+    def set_part(self, index: int, result: Callable[[], tuple]) -> None:
+        try:
+            self.results[index] = result()
+        except Exception as e:
+            self.error = self.error or e
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done(self._save)
+
+    def _save(self) -> tuple[str, dict | None, None, list[str]]:
+        if self.error is not None:
+            raise self.error
+        rule_timeouts = []
+        for *_, timeouts in self.results:
+            add_rule_timeouts(rule_timeouts, timeouts)
+        separator = PDF_PAGE_SEPARATOR if self.input_path.lower().endswith(".pdf") else ""
+        if self.sink is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+        for _, _, profile, _ in self.results:
+            if profile is not None and get_profiler() is not None:
+                get_profiler().merge(profile)
+        if self.output_format == "text":
+            out_path = anonymized_text_path(self.output_dir, self.input_path)
+            with open_output(out_path, False, self.sink) as f:
+                for i, (text, _, _, _) in enumerate(self.results):
+                    f.write(separator + text if i else text)
+            return out_path, None, None, rule_timeouts
+        spans, offset = [], 0
+        for part_spans, length, _, _ in self.results:
+            spans += [(start + offset, end + offset, label, source) for start, end, label, source in part_spans]
+            offset += length + len(separator)
+        out_path = save_spans([spans], output_dir=self.output_dir, original_filename=self.input_path,
+                              binary=self.output_format == "standoff-binary", sink=self.sink)
+        return out_path, None, None, rule_timeouts
+
+def _run_inline(fn: Callable, *args) -> Future:
+    """Runs fn in the current process, wrapping its outcome in an already completed Future."""
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def anonymize_directory(input_dir: str,
+                        output_dir: str,
+                        model_path: str = DEFAULT_NER_MODEL,
+                        entities: Iterable[str] = DEFAULT_ENTITIES,
+                        per_matching: bool = DEFAULT_EXTRA_PER_MATCHING,
+                        personal_data: dict[str, str] = None,
+                        recursive: bool = False,
+                        workers: int = DEFAULT_WORKERS,
+                        manifest_path: str = None,
+                        batch_size: int = DEFAULT_BATCH_SIZE,
+                        output_format: str = DEFAULT_OUTPUT_FORMAT,
+                        cache_path: str = None,
+                        cache_max_mb: float = DEFAULT_CACHE_MAX_MB,
+                        paragraph_dedup: bool = False,
+                        ner_store_dir: str = None,
+                        pdf_workers: int = DEFAULT_PDF_WORKERS,
+                        patient_registry: str = None,
+                        output_sink: str = None,
+                        reader_threads: int = DEFAULT_READER_THREADS,
+                        read_queue_size: int = DEFAULT_READ_QUEUE_SIZE,
+                        write_queue_size: int = DEFAULT_WRITE_QUEUE_SIZE,
+                        max_tasks_per_worker: int = DEFAULT_MAX_TASKS_PER_WORKER,
+                        max_worker_rss_mb: float = DEFAULT_MAX_WORKER_RSS_MB,
+                        log: Callable[[str], None] = print) -> dict[str, int]:
+    """
+    Anonymizes every supported file of a directory tree, mirroring its structure inside the output directory.
+    Files are distributed over a pool of worker processes, each holding its own copy of the model. Files are queued
+    by estimated cost and dispatched largest first (see utils.scheduling_utils), and long .txt and PDF files are split
+    into parts labelled by different workers, so that a few large reports do not leave the other workers idle.
+    Progress is recorded in a SQLite manifest (by default inside the output directory): files already processed with
+    the same settings are skipped when their size and modification time are unchanged, or when their content hash
+    still matches, so an interrupted run resumes where it stopped.
+
+    :param input_dir: Root directory of the documents to anonymize.
+    :param output_dir: Directory where anonymized files are written. Optional with an output sink.
+    :param recursive: Whether to descend into subdirectories.
+    :param workers: Number of worker processes. With 1, files are processed in the current process.
+    :param manifest_path: Path of the SQLite manifest.
+    :param output_format: One of 'text', 'standoff' or 'standoff-binary'.
+    :param cache_path: Path of an optional SQLite result cache shared by the workers, so that texts anonymized in
+                       previous runs (e.g. unchanged notes of a re-exported file) skip NER and rules.
+    :param cache_max_mb: Size bound of the result cache.
+    :param paragraph_dedup: Whether to label repeated paragraphs (letterheads, footers, templates) only once per worker.
+    :param ner_store_dir: Optional directory where the raw NER output of every file is stored, mirroring the input
+                          tree, so that rules can later be re-applied without the model (see utils.reapply_utils).
+                          Since every file must go through the model, it cannot be combined with cache or dedup.
+    :param pdf_workers: Number of processes extracting the pages of each PDF ahead of the model. PDFs are anonymized
+                        page by page, with pages separated by a form feed in the output.
+    :param patient_registry: Optional path of a registry of patients whose names and places are masked in every file
+                             (see rules.patient_registry). Files are processed again when the registry changes.
+    :param output_sink: Optional path of a zip or tar archive (optionally compressed), JSON Lines file or SQLite database
+                        (see utils.sink_utils.open_sink) where all the outputs are written as entries named after
+                        their relative output paths, instead of one file each. The manifest then defaults to the sink
+                        path followed by MANIFEST_FILENAME.
+    :param reader_threads: With a single worker, files go through a staged pipeline (see utils.pipeline_utils): this
+                           many threads read files ahead of the model, a thread runs the model on batches of files and
+                           a writer thread saves the outputs, so that parsing, inference and disk writes overlap.
+                           With 0, or with several workers, each file is read, labelled and written in turn.
+    :param read_queue_size: Number of files read, or being read, ahead of the model in the staged pipeline.
+    :param write_queue_size: Number of labelled files waiting for the writer in the staged pipeline.
+    :param max_tasks_per_worker: With several workers, number of tasks (files or parts) after which a worker process
+                                 is replaced by a fresh one (0 for never), bounding the growth of its memory.
+    :param max_worker_rss_mb: With several workers, resident memory in MB above which a worker process is replaced
+                              after its current task (0 for no limit). With any recycling limit and the fork start
+                              method, the model is loaded once in the parent and workers are forked with it.
+    :param log: Function receiving progress messages.
+    :return: Number of processed, skipped and failed files, and of processed files on which some rule exceeded its
+             timeout ('rule_timeouts', recorded as such in the manifest and processed again by the next run), plus the cache hits and misses of the run if a cache is used,
+             the busy time and utilization of each stage ('stages') with the staged pipeline, the tasks, busy time,
+             utilization and peak RSS of each worker process ('workers') with several workers, and the recycled
+             workers ('recycles') with a recycling limit.
+    """
+    entities = list(entities)
+    if ner_store_dir and (cache_path or paragraph_dedup):
+        raise ValueError("The NER store cannot be combined with the result cache or paragraph deduplication.")
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    elif not output_sink:
+        raise ValueError("An output directory or an output sink is required.")
+    manifest_path = manifest_path or (os.path.join(output_dir, MANIFEST_FILENAME) if output_dir else output_sink + MANIFEST_FILENAME)
+    settings = json.dumps({"model": model_path, "entities": sorted(entities), "per_matching": per_matching,
+                           "personal_data": personal_data, "output_format": output_format,
+                           "paragraph_dedup": paragraph_dedup, "ner_store": ner_store_dir,
+                           "patient_registry": load_patient_registry(patient_registry).checksum if patient_registry else None,
+                           "output_sink": output_sink}, sort_keys=True)
+    init_args = (model_path, entities, per_matching, personal_data, batch_size, output_format, cache_path, cache_max_mb,
+                 paragraph_dedup, pdf_workers, patient_registry, bool(output_sink), get_profiler() is not None)
+    summary = {"processed": 0, "skipped": 0, "failed": 0, "rule_timeouts": 0}
+    if cache_path:
+        with ResultCache(cache_path, cache_max_mb) as cache:
+            cache_totals = cache.totals()
+
+    sink = open_sink(output_sink) if output_sink else None
+    recycling = max_tasks_per_worker > 0 or max_worker_rss_mb > 0
+    if workers > 1 and recycling and multiprocessing.get_start_method() == "fork":
+        load_worker_model(model_path)  # forked replacement workers inherit it
+    pool = WorkerPool(workers, init_worker, init_args, max_tasks_per_worker, max_worker_rss_mb) if workers > 1 else None
+    pipeline = ctx = None
+    scheduler = LargestFirstScheduler(pool, 2 * workers) if pool is not None else None
+    if pool is None:
+        ctx = create_context(*init_args, in_worker=False)
+        if reader_threads > 0:
+            stages = FileStages(ctx)
+            pipeline = StagedPipeline(stages.read, stages.label, stages.write, reader_threads, read_queue_size,
+                                      write_queue_size, max_batch=batch_size)
+    max_in_flight = pipeline.capacity if pipeline is not None else 1
+
+    def submit(*job) -> Future:
+        if pipeline is not None:
+            return pipeline.submit(job)
+        return _run_inline(anonymize_file, ctx, *job)
+
+    def schedule(input_path: str, rel_path: str, file_output_dir: str, store_path: str | None) -> None:
+        cost = estimate_cost(input_path)
+        try:
+            parts = plan_parts(input_path, cost) if store_path is None else None
+        except Exception:  # e.g. an unreadable PDF, whose error is then reported by its worker
+            parts = None
+
+        def done(result: Callable[[], tuple]) -> None:
+            record(rel_path, result)
+
+        if parts is None:
+            scheduler.add(cost, done, _file_task, input_path, file_output_dir, store_path)
+            return
+        document = _SplitDocument(input_path, file_output_dir, len(parts), output_format, sink, done)
+        for i, (part_cost, bounds) in enumerate(parts):
+            scheduler.add(part_cost, functools.partial(document.set_part, i), _part_task, input_path, bounds)
+
+    def record(rel_path: str, result: Callable[[], tuple]) -> None:
+        try:
+            out_path, profile, entries, rule_timeouts = result()
+            if profile is not None and get_profiler() is not None:
+                get_profiler().merge(profile)
+            for name, data in entries or ():
+                sink.write(name, data)
+            summary["processed"] += 1
+            if rule_timeouts:
+                manifest.set_status(rel_path, STATUS_RULE_TIMEOUT, output=out_path,
+                                    error=f"Rules exceeded their timeout: {', '.join(rule_timeouts)}")
+                summary["rule_timeouts"] += 1
+                log(f"Anonymized '{rel_path}' -> '{out_path}', but rules {', '.join(rule_timeouts)} exceeded their "
+                    f"timeout: only their matches found so far are masked, and the file will be processed again")
+                return
+            manifest.set_status(rel_path, STATUS_DONE, output=out_path)
+            log(f"Anonymized '{rel_path}' -> '{out_path}'")
+        except Exception as e:
+            manifest.set_status(rel_path, STATUS_FAILED, error=str(e))
+            summary["failed"] += 1
+            log(f"Failed '{rel_path}': {e}")
+
+    def collect(futures: Iterable[Future]):
+        for future in futures:
+            record(pending.pop(future), future.result)
+
+    pending: dict[Future, str] = {}
+    try:
+        with Manifest(manifest_path) as manifest:
+            excluded = [path for path in (output_dir, ner_store_dir, output_sink) if path]
+            for entry in iter_input_files(input_dir, recursive, exclude=excluded):
+                rel_path = os.path.relpath(entry.path, input_dir)
+                stat = entry.stat()
+                previous = manifest.get(rel_path)
+                is_done = previous is not None and previous["status"] == STATUS_DONE and previous["settings"] == settings
+
+                if is_done and (previous["size"], previous["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                    summary["skipped"] += 1
+                    continue
+
+                content_hash = file_content_hash(entry.path)
+                if is_done and previous["hash"] == content_hash:  # touched but unchanged
+                    manifest.record(rel_path, stat.st_size, stat.st_mtime_ns, content_hash, settings,
+                                    STATUS_DONE, output=previous["output"])
+                    summary["skipped"] += 1
+                    continue
+
+                manifest.record(rel_path, stat.st_size, stat.st_mtime_ns, content_hash, settings)
+                file_output_dir = os.path.dirname(rel_path) if sink is not None else os.path.join(output_dir, os.path.dirname(rel_path))
+                store_path = ner_store_path(ner_store_dir, rel_path) if ner_store_dir else None
+                if scheduler is not None:
+                    schedule(entry.path, rel_path, file_output_dir, store_path)
+                    scheduler.dispatch()
+                    continue
+                pending[submit(entry.path, file_output_dir, store_path)] = rel_path
+
+                # Bound the number of in-flight files so that the walk does not run ahead of the workers
+                if len(pending) >= max_in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+            collect(list(pending))
+            if scheduler is not None:
+                scheduler.drain()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+            summary["workers"] = pool.report()
+            if recycling:
+                summary["recycles"] = pool.recycles
+        if pipeline is not None:
+            pipeline.close()
+            summary["stages"] = pipeline.report()
+        if ctx is not None:
+            ctx.close()
+        if sink is not None:
+            sink.close()
+
+    if cache_path:
+        with ResultCache(cache_path, cache_max_mb) as cache:
+            summary.update({f"cache_{name}": value - cache_totals[name] for name, value in cache.totals().items()})
+    return summary
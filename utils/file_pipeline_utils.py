@@ -0,0 +1,116 @@
+import os
+
+from config import PDF_PAGE_SEPARATOR, PIPELINE_STREAM_MIN_BYTES
+from utils.anonymization_utils import read_file
+from utils.reader_utils import iter_pdf_pages, iter_docx_paragraphs, iter_chunks, iter_text_chunks
+from utils.json_utils import is_multi_record_json
+from utils.compression_utils import strip_compression_suffix, is_archive
+from utils.sink_utils import MemorySink
+from utils.batch_utils import label_spans, add_rule_timeouts
+from utils.worker_utils import WorkerContext, process_file_timeouts, label_stored, save_results, save_chunks
+
+FileJob = tuple[str, str, str | None]  # input path, output directory and NER store path of a file
+
+
+class FileStages:
+    """
+    Reader, model and writer stages of the staged pipeline of directory mode (see utils.pipeline_utils.StagedPipeline),
+    processing file jobs with the model and options of the given worker context. Every stage returns the same result
+    as utils.worker_utils.anonymize_file once the file is written.
+    """
+
+    def __init__(self, ctx: WorkerContext):
+        self.ctx = ctx
+
+    def read(self, job: FileJob) -> tuple[list[str], str | None, dict[str, str] | None] | None:
+        """
+        Reads a whole input file as (texts, separator, personal data), or returns None for the files that the model
+        stage streams instead (large files, archives and multi-patient exports), so that their size does not bound
+        memory. PDF, DOCX and .txt files are read in the same chunks as when streamed, joined by the separator in the
+        output, so that both paths give the same output; other files are read by read_file, with a None separator.
+        """
+        input_path, _, store_path = job
+        name = strip_compression_suffix(input_path).lower()
+        if is_archive(input_path) or os.path.getsize(input_path) > PIPELINE_STREAM_MIN_BYTES \
+                or (name.endswith((".json", ".jsonl")) and is_multi_record_json(input_path)):
+            return None
+        if store_path is None and name.endswith(".pdf"):
+            return list(iter_pdf_pages(input_path)), PDF_PAGE_SEPARATOR, None
+        if store_path is None and name.endswith(".docx"):
+            return list(iter_chunks(iter_docx_paragraphs(input_path), "\n")), "\n", None
+        if store_path is None and name.endswith(".txt"):
+            return list(iter_text_chunks(input_path)), "", None
+        texts, file_personal_data = read_file(input_path)
+        return texts, None, file_personal_data
+
+    def label(self, batch: list[tuple[FileJob, tuple | None]]) -> list[tuple | Exception]:
+        """
+        Labels the texts of all the read files of a batch together, so that short notes of different files share the
+        same model batches. Streamed files are processed (and written) one by one, and files stored for re-applying
+        rules save their NER output. Since those have side effects, errors are returned as the result of their own
+        file instead of being raised, and if the shared labelling fails, only the files labelled together are
+        labelled again one by one, so that no file is written twice.
+        """
+        ctx = self.ctx
+        results, shared = [None] * len(batch), []
+        for i, ((input_path, output_dir, store_path), loaded) in enumerate(batch):
+            try:
+                if loaded is None:
+                    out_path, rule_timeouts = process_file_timeouts(ctx, input_path, output_dir, store_path)
+                    results[i] = ("written", out_path, ctx.drain(), rule_timeouts)
+                elif store_path is not None:
+                    texts, _, file_personal_data = loaded
+                    ctx.rule_timeouts = []
+                    results[i] = ("labelled", loaded, label_stored(ctx, texts, file_personal_data, store_path),
+                                  ctx.rule_timeouts)
+                else:
+                    shared.append(i)
+            except Exception as e:
+                ctx.drain()  # drops the partial outputs of the failed file
+                results[i] = e
+            finally:
+                ctx.rule_timeouts = []
+
+        try:
+            self._label_loaded(batch, shared, results)
+        except Exception as e:
+            if len(shared) == 1:
+                results[shared[0]] = e
+            else:
+                for i in shared:
+                    try:
+                        self._label_loaded(batch, [i], results)
+                    except Exception as e:
+                        results[i] = e
+        return results
+
+    def _label_loaded(self, batch: list[tuple[FileJob, tuple]], indexes: list[int], results: list) -> None:
+        """Labels the read texts of the files of a batch at the given indexes together, setting their results."""
+        ctx = self.ctx
+        records, owners = [], []
+        for i in indexes:
+            texts, _, file_personal_data = batch[i][1]
+            records.extend((text, file_personal_data or ctx.personal_data) for text in texts)
+            owners.extend([i] * len(texts))
+        labelled = {i: ("labelled", batch[i][1], [], []) for i in indexes}
+        for i, (spans, timeouts) in zip(owners, label_spans(ctx.nlp, records, ctx.entities, ctx.per_matching,
+                                                            ctx.batch_size, ctx.cache, ctx.memo)):
+            labelled[i][2].append(spans)
+            add_rule_timeouts(labelled[i][3], timeouts)
+        for i, result in labelled.items():
+            results[i] = result
+
+    def write(self, job: FileJob, result: tuple) -> tuple[str, None, list | None, list[str]]:
+        """Saves the labelled texts of a file, in a sink of its own since it runs alongside the model stage."""
+        kind, *payload = result
+        if kind == "written":
+            return payload[0], None, payload[1], payload[2]
+        input_path, output_dir, _ = job
+        (texts, separator, _), spans_per_text, rule_timeouts = payload
+        sink = MemorySink() if self.ctx.sink is not None else None
+        name = strip_compression_suffix(input_path)
+        if separator is None:
+            out_path = save_results(texts, spans_per_text, output_dir, name, self.ctx.output_format, sink)
+        else:
+            out_path = save_chunks(zip(texts, spans_per_text), separator, output_dir, name, self.ctx.output_format, sink)
+        return out_path, None, sink.drain() if sink is not None else None, rule_timeouts
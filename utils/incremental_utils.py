@@ -0,0 +1,192 @@
+import json
+import hashlib
+import sqlite3
+import time
+
+from spacy import Language
+
+from config import DEFAULT_BATCH_SIZE, DEFAULT_INCREMENTAL_MARGIN
+from rules.rules import get_rule_timeouts, rules_checksum
+from utils.anonymization_utils import paragraph_offsets
+from utils.batch_utils import label_texts
+from utils.cache_utils import model_fingerprint, result_key
+from utils.span_utils import StandoffSpan, doc_to_spans
+from utils.profiling_utils import profile_count
+
+
+ParagraphHash = tuple[int, int, str]  # (start, end, hash of the text) of a paragraph
+
+
+def paragraph_hashes(text: str) -> list[ParagraphHash]:
+    """Returns the offsets of the paragraphs of a text (see paragraph_offsets) together with a hash of their text."""
+    return [(start, end, hashlib.blake2b(text[start:end].encode("utf-8"), digest_size=16).hexdigest())
+            for start, end in paragraph_offsets(text)]
+
+
+def changed_region(old_text: str, new_text: str, margin: int = DEFAULT_INCREMENTAL_MARGIN) -> tuple[int, int, int]:
+    """
+    Compares two versions of a text paragraph by paragraph and returns the (start, end) character range of the new
+    text to label again, i.e. the paragraphs between the unchanged leading and trailing ones, extended by margin
+    unchanged paragraphs on each side to give the model some context, together with the end of the kept prefix.
+    Spans of the old text ending before the kept prefix end are still valid, and so are those starting at or after
+    the end of the range once shifted by the length difference of the two texts. Paragraphs are compared together with
+    their position, so that unchanged paragraphs keep the same offsets.
+    Several separate edits result in a single range spanning all of them. For an appended entry, the range is the new
+    entry plus the margin.
+
+    :return: (prefix_end, start, end), with start == end if nothing must be labelled again.
+    """
+    return _changed_region(len(old_text), paragraph_hashes(old_text), new_text, margin)
+
+
+def _changed_region(old_length: int, old_paragraphs: list[ParagraphHash], new_text: str,
+                    margin: int) -> tuple[int, int, int]:
+    """changed_region, given only the length and the paragraph hashes of the old text."""
+    new_paragraphs, new_length = paragraph_hashes(new_text), len(new_text)
+    shortest = min(len(old_paragraphs), len(new_paragraphs))
+
+    prefix = 0
+    while prefix < shortest and tuple(old_paragraphs[prefix]) == new_paragraphs[prefix]:
+        prefix += 1
+
+    suffix = 0
+    while suffix < shortest - prefix:
+        (old_start, old_end, old_hash), (new_start, new_end, new_hash) = old_paragraphs[-suffix - 1], new_paragraphs[-suffix - 1]
+        if (old_length - old_start, old_length - old_end, old_hash) != (new_length - new_start, new_length - new_end, new_hash):
+            break
+        suffix += 1
+
+    if prefix + suffix >= max(len(old_paragraphs), len(new_paragraphs)):  # no paragraph changed, only separators
+        prefix_end = new_paragraphs[prefix - 1][1] if prefix > 0 else 0
+        return prefix_end, prefix_end, prefix_end
+
+    first, last = max(0, prefix - margin), len(new_paragraphs) - max(0, suffix - margin)
+    prefix_end = new_paragraphs[first - 1][1] if first > 0 else 0
+    if first >= last:
+        return prefix_end, prefix_end, prefix_end
+    return prefix_end, new_paragraphs[first][0], new_paragraphs[last - 1][1]
+
+
+def update_spans(nlp: Language,
+                 text: str,
+                 old_text: str,
+                 old_spans: list[StandoffSpan],
+                 entities: list[str],
+                 per_matching: bool,
+                 personal_data: dict[str, str] = None,
+                 margin: int = DEFAULT_INCREMENTAL_MARGIN,
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> tuple[list[StandoffSpan], list[str]]:
+    """
+    Returns the spans of a new version of a text, given the previous version and its spans, running NER and rules
+    only on the changed paragraphs plus a margin (see changed_region) and keeping the spans of the unchanged ones.
+    The numbers of relabelled and reused characters are reported as profiling counters.
+
+    :return: The (start, end, label, source) spans of the new text, and the rules that timed out on the changed part.
+    """
+    return _update_spans(nlp, text, len(old_text), paragraph_hashes(old_text), old_spans, entities, per_matching,
+                         personal_data, margin, batch_size)
+
+
+def _update_spans(nlp: Language, text: str, old_length: int, old_paragraphs: list[ParagraphHash],
+                  old_spans: list[StandoffSpan], entities: list[str], per_matching: bool,
+                  personal_data: dict[str, str] | None, margin: int, batch_size: int) -> tuple[list[StandoffSpan], list[str]]:
+    """update_spans, given only the length and the paragraph hashes of the old text."""
+    prefix_end, start, end = _changed_region(old_length, old_paragraphs, text, margin)
+    shift = len(text) - old_length
+    spans = [span for span in old_spans if span[1] <= prefix_end]
+    timeouts = []
+    if start < end:
+        doc = next(label_texts(nlp, [(text[start:end], personal_data)], per_matching, batch_size))
+        spans += [(span_start + start, span_end + start, label, source)
+                  for span_start, span_end, label, source in doc_to_spans(doc, entities)]
+        timeouts = get_rule_timeouts(doc)
+    # The unchanged trailing paragraphs keep their distance from the end of the text
+    spans += [(span_start + shift, span_end + shift, label, source) for span_start, span_end, label, source in old_spans
+              if span_start >= prefix_end and span_start + shift >= end]
+
+    profile_count("incremental_chars_relabelled", end - start)
+    profile_count("incremental_chars_reused", len(text) - (end - start))
+    return spans, timeouts
+
+
+class VersionStore:
+    """
+    SQLite store of the last anonymized version of each document, holding its spans together with the length and the
+    paragraph hashes of its text (see paragraph_hashes) and the settings they were produced with, so that edited
+    documents (e.g. diaries with new entries appended) can be re-anonymized incrementally. The original texts are not
+    stored, but short paragraphs could still be guessed by hashing candidate texts, so the store must be protected
+    like the documents themselves.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("DROP TABLE IF EXISTS versions")  # written by earlier versions, with the original texts
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS document_versions (
+                doc_id TEXT PRIMARY KEY,
+                settings TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                paragraphs TEXT NOT NULL,
+                spans TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    def get(self, doc_id: str, settings: str) -> tuple[int, list[ParagraphHash], list[StandoffSpan]] | None:
+        """
+        Returns the stored text length, paragraph hashes and spans of a document if they were produced with the given
+        settings.
+        """
+        row = self.conn.execute("SELECT length, paragraphs, spans FROM document_versions WHERE doc_id = ? AND settings = ?",
+                                (doc_id, settings)).fetchone()
+        if row is None:
+            return None
+        return row[0], [tuple(paragraph) for paragraph in json.loads(row[1])], [tuple(span) for span in json.loads(row[2])]
+
+    def put(self, doc_id: str, settings: str, text: str, spans: list[StandoffSpan]) -> None:
+        """Stores the spans of a document version, with the length and paragraph hashes of its text."""
+        self.conn.execute("INSERT OR REPLACE INTO document_versions (doc_id, settings, length, paragraphs, spans, updated_at) "
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+                          (doc_id, settings, len(text), json.dumps(paragraph_hashes(text)),
+                           json.dumps([list(span) for span in spans], ensure_ascii=False), time.time()))
+        self.conn.commit()
+
+    def delete(self, doc_id: str) -> None:
+        self.conn.execute("DELETE FROM document_versions WHERE doc_id = ?", (doc_id,))
+        self.conn.commit()
+
+    def anonymize(self,
+                  nlp: Language,
+                  doc_id: str,
+                  text: str,
+                  entities: list[str],
+                  per_matching: bool,
+                  personal_data: dict[str, str] = None,
+                  margin: int = DEFAULT_INCREMENTAL_MARGIN,
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> list[StandoffSpan]:
+        """
+        Returns the spans of the current version of a document, relabelling only what changed since the stored
+        version, or the whole text if there is none with the same model, rules and options. The new version is stored
+        in place of the previous one, unless some rule timed out, in which case the next version is labelled in full.
+        """
+        settings = result_key("", model_fingerprint(nlp), rules_checksum(), per_matching, personal_data, entities)
+        old_length, old_paragraphs, old_spans = self.get(doc_id, settings) or (0, [], [])
+        spans, timeouts = _update_spans(nlp, text, old_length, old_paragraphs, old_spans, entities, per_matching,
+                                        personal_data, margin, batch_size)
+        if timeouts:
+            self.delete(doc_id)
+        else:
+            self.put(doc_id, settings, text, spans)
+        return spans
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
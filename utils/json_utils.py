@@ -1,6 +1,10 @@
+import io
 import json
 import re
 import os
+from typing import Iterator, TextIO
+
+from utils.compression_utils import open_compressed, strip_compression_suffix
 
 def to_spacy_format(examples: list[dict]):
     """
@@ -114,4 +118,134 @@ def save_json_file(file_path: str, data):
     :param data: Data to be saved.
     """
     with open(file_path, 'w', encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=2)
\ No newline at end of file
+        json.dump(data, file, ensure_ascii=False, indent=2)
+
+def iter_jsonl(file: TextIO) -> Iterator[dict]:
+    """
+    Lazily parses a JSON Lines stream, yielding one record per non-empty line.
+    :param file: Open text file object (e.g. sys.stdin).
+    :return: Iterator over the parsed records.
+    """
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON at line {line_number}: {e}") from e
+
+
+def write_jsonl_record(file: TextIO, record) -> None:
+    """
+    Writes a single record as one JSON Lines entry.
+    :param file: Open text file object.
+    :param record: JSON-serializable record.
+    """
+    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def iter_json_array(file: TextIO, chunk_size: int = 1 << 20, prefix: str = "") -> Iterator:
+    """
+    Incrementally parses a stream holding a top-level JSON array, yielding its elements one by one while reading
+    the stream in chunks, so that the memory used depends on the largest element rather than on the whole array.
+    :param file: Open text file object positioned at the start of the array.
+    :param chunk_size: Number of characters read at a time.
+    :param prefix: Characters already read from the stream (e.g. to detect the array), parsed before the rest.
+    :return: Iterator over the array elements.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = prefix, 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, position, eof
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer, position = buffer[position:] + chunk, 0
+        return not eof
+
+    def next_char() -> str:
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or not fill():
+                return buffer[position] if position < len(buffer) else ""
+
+    if next_char() != "[":
+        raise ValueError("JSON stream does not start with an array.")
+    position += 1
+    if next_char() == "]":
+        return
+
+    while True:
+        next_char()
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+                # A number may continue in the next chunk: the element is complete once its delimiter is buffered
+                if (end < len(buffer) and (buffer[end] in ",]" or buffer[end].isspace())) or eof or not fill():
+                    break
+            except json.JSONDecodeError as e:
+                if not fill():  # the element is incomplete only if more data can be read
+                    raise ValueError(f"Invalid JSON array element: {e}") from e
+        position = end
+        yield element
+
+        separator = next_char()
+        position += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or ']' between JSON array elements, found {separator!r}.")
+
+
+def _first_char(file: TextIO) -> str:
+    """Reads a stream up to its first non-whitespace character, which is returned ('' for an empty stream)."""
+    while (char := file.read(1)) and char.isspace():
+        pass
+    return char
+
+
+def _open_json(file_path: str) -> TextIO:
+    """Opens a (possibly compressed) JSON or JSON Lines file as text, skipping the BOM if any."""
+    return io.TextIOWrapper(open_compressed(file_path, "rb"), encoding="utf-8-sig")
+
+
+def is_multi_record_json(file_path: str) -> bool:
+    """
+    Returns whether a .json or .jsonl file, possibly compressed (e.g. .jsonl.gz), holds a sequence of records
+    (a JSON array or JSON Lines) rather than one object.
+    """
+    if strip_compression_suffix(file_path).lower().endswith(".jsonl"):
+        return True
+    with _open_json(file_path) as f:
+        return _first_char(f) == "["
+
+
+def iter_json_stream_records(file: TextIO, name: str) -> Iterator[dict]:
+    """
+    Lazily yields the records of an open JSON Lines stream, JSON array or single JSON object, reading it only once
+    (the stream does not need to be seekable, e.g. a decompressed archive member).
+    :param file: Open text file object.
+    :param name: Name of the file, whose .jsonl extension tells JSON Lines apart.
+    :return: Iterator over the parsed records.
+    """
+    if strip_compression_suffix(name).lower().endswith(".jsonl"):
+        yield from iter_jsonl(file)
+        return
+    first = _first_char(file)
+    if first == "[":
+        yield from iter_json_array(file, prefix=first)
+    else:
+        yield json.loads(first + file.read())
+
+
+def iter_json_records(file_path: str) -> Iterator[dict]:
+    """
+    Lazily yields the records of a JSON Lines file, of a JSON array or of a single JSON object file, decompressing
+    gzip, bz2, xz or zstd files on the fly.
+    :param file_path: Path to the .json or .jsonl file.
+    :return: Iterator over the parsed records.
+    """
+    with _open_json(file_path) as f:
+        yield from iter_json_stream_records(f, file_path)
@@ -0,0 +1,73 @@
+import sqlite3
+import time
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_RULE_TIMEOUT = "rule_timeout"  # output written, but some rule exceeded its timeout: processed again by the next run
+
+
+class Manifest:
+    """
+    SQLite record of the files processed by a batch run, used to resume interrupted runs and to skip unchanged files.
+    Each row stores the input path, its size, modification time, content hash, the settings used to process it,
+    its status and the produced output path (or the error message in case of failure, or the rules that exceeded
+    their timeout).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                status TEXT NOT NULL,
+                output TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    def get(self, path: str) -> dict | None:
+        """Returns the manifest entry of the given path as a dictionary, or None if it was never recorded."""
+        cursor = self.conn.execute(
+            "SELECT path, size, mtime_ns, hash, settings, status, output, error FROM files WHERE path = ?", (path,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(("path", "size", "mtime_ns", "hash", "settings", "status", "output", "error"), row))
+
+    def record(self, path: str, size: int, mtime_ns: int, content_hash: str, settings: str,
+               status: str = STATUS_PENDING, output: str = None, error: str = None) -> None:
+        """Inserts or replaces the entry of the given path."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, hash, settings, status, output, error, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, size, mtime_ns, content_hash, settings, status, output, error, time.time()))
+        self.conn.commit()
+
+    def set_status(self, path: str, status: str, output: str = None, error: str = None) -> None:
+        """Updates the status of an already recorded path."""
+        self.conn.execute(
+            "UPDATE files SET status = ?, output = ?, error = ?, updated_at = ? WHERE path = ?",
+            (status, output, error, time.time(), path))
+        self.conn.commit()
+
+    def counts(self) -> dict[str, int]:
+        """Returns the number of recorded files per status."""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,54 @@
+import os
+from typing import Iterator
+
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
+
+from utils.profiling_utils import profile_stage
+
+NER_STORE_SUFFIX = ".spacy"
+PERSONAL_DATA_KEY = "personal_data"  # key of the personal data of a document in its user_data
+
+
+def new_ner_docbin() -> DocBin:
+    """Returns an empty DocBin keeping tokens, NER entities and user data, i.e. the personal data of each document."""
+    return DocBin(attrs=["ORTH", "SPACY", "ENT_IOB", "ENT_TYPE"], store_user_data=True)
+
+
+def add_ner_doc(docs: DocBin, doc: Doc, personal_data: dict[str, str] | None) -> None:
+    """
+    Adds a document as returned by the NER model, before rules are applied, together with its personal data.
+    The DocBin copies the entities immediately, so the document can be labelled by the rules afterwards.
+    """
+    doc.user_data[PERSONAL_DATA_KEY] = personal_data
+    docs.add(doc)
+
+
+def ner_store_path(store_dir: str, rel_path: str) -> str:
+    """Returns the path where the NER output of the input file with the given relative path is stored."""
+    return os.path.join(store_dir, rel_path + NER_STORE_SUFFIX)
+
+
+def save_ner_docs(docs: DocBin, path: str) -> str:
+    """Writes the stored documents of one input file, creating parent directories as needed."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with profile_stage("write"):
+        docs.to_disk(path)
+    return path
+
+
+def load_ner_docs(path: str, vocab: Vocab) -> list[tuple[Doc, dict[str, str] | None]]:
+    """Loads the stored (doc, personal_data) pairs of one input file, with the entities predicted by the model."""
+    with profile_stage("load_ner_docs") as stage:
+        docs = list(DocBin().from_disk(path).get_docs(vocab))
+        stage.chars = sum(len(doc.text) for doc in docs)
+    return [(doc, doc.user_data.pop(PERSONAL_DATA_KEY, None)) for doc in docs]
+
+
+def iter_ner_store(store_dir: str) -> Iterator[str]:
+    """Yields the paths, relative to the store directory, of the input files whose NER output is stored, in sorted order."""
+    for root, dirs, files in os.walk(store_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(NER_STORE_SUFFIX):
+                yield os.path.relpath(os.path.join(root, name), store_dir)[:-len(NER_STORE_SUFFIX)]
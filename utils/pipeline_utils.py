@@ -0,0 +1,157 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class StageStats:
+    """Busy time and processed items of a pipeline stage run by one or more threads."""
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0  # waiting for room in the queue of the next stage
+        self._lock = threading.Lock()
+
+    def add(self, busy_seconds: float, items: int = 1) -> None:
+        with self._lock:
+            self.busy_seconds += busy_seconds
+            self.items += items
+
+    def report(self, wall_seconds: float) -> dict:
+        """Returns the measures of the stage, with its utilization: the share of the wall time its threads were busy."""
+        capacity = wall_seconds * self.threads
+        return {"threads": self.threads, "items": self.items, "busy_seconds": round(self.busy_seconds, 3),
+                "blocked_seconds": round(self.blocked_seconds, 3),
+                "utilization": round(self.busy_seconds / capacity, 3) if capacity else None}
+
+
+class StagedPipeline:
+    """
+    Producer/consumer pipeline of three stages connected by bounded queues: a pool of reader threads loads the
+    submitted items, a single processing thread (the only one using the model) handles them in batches of up to
+    max_batch items, and a writer thread saves the results. When a stage falls behind, the bounded queues block the
+    previous ones (and submit), so items never pile up in memory.
+    Each submitted item gets a Future completed with the value returned by write, or with the error of any stage.
+
+    :param read: Function loading an item, run by the reader threads.
+    :param process: Function receiving a list of (item, loaded) pairs and returning one result per pair, or the
+                    exception of a pair that failed on its own. If it raises, the batch is processed again one item
+                    at a time, so a process with side effects must return the errors of its items instead.
+    :param write: Function receiving an item and its result, whose return value completes the Future of the item.
+    :param reader_threads: Number of reader threads.
+    :param read_queue_size: Number of submitted items waiting for the processing stage (read or being read).
+    :param write_queue_size: Number of processed items waiting for the writer.
+    :param max_batch: Maximum number of items handed to process at once.
+    """
+
+    def __init__(self, read: Callable[[Any], Any], process: Callable[[list[tuple[Any, Any]]], list],
+                 write: Callable[[Any, Any], Any], reader_threads: int, read_queue_size: int, write_queue_size: int,
+                 max_batch: int = 1):
+        self.read, self.process, self.write = read, process, write
+        self.max_batch = max(1, max_batch)
+        self.capacity = read_queue_size + write_queue_size + self.max_batch
+        self.stats = {"read": StageStats(reader_threads), "process": StageStats(1), "write": StageStats(1)}
+        self.started = time.perf_counter()
+        self._readers = ThreadPoolExecutor(reader_threads, thread_name_prefix="pipeline-reader")
+        self._read_queue = queue.Queue(maxsize=read_queue_size)
+        self._write_queue = queue.Queue(maxsize=write_queue_size)
+        self._threads = [threading.Thread(target=self._run_process, name="pipeline-process", daemon=True),
+                         threading.Thread(target=self._run_write, name="pipeline-writer", daemon=True)]
+        self._closed = False
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, item) -> Future:
+        """Queues an item for reading, blocking while the read queue is full, and returns its Future."""
+        future = Future()
+        read_future = self._readers.submit(self._read, item)
+        start = time.perf_counter()
+        self._read_queue.put((item, read_future, future))
+        self.stats["read"].blocked_seconds += time.perf_counter() - start
+        return future
+
+    def close(self) -> None:
+        """Waits for the submitted items to be written and stops the stages."""
+        if self._closed:
+            return
+        self._closed = True
+        self._read_queue.put(None)
+        self._threads[0].join()
+        self._write_queue.put(None)
+        self._threads[1].join()
+        self._readers.shutdown()
+
+    def report(self) -> dict:
+        """Returns the measures of every stage since the pipeline started (see StageStats.report)."""
+        wall_seconds = time.perf_counter() - self.started
+        return {name: stats.report(wall_seconds) for name, stats in self.stats.items()}
+
+    def _read(self, item):
+        start = time.perf_counter()
+        try:
+            return self.read(item)
+        finally:
+            self.stats["read"].add(time.perf_counter() - start)
+
+    def _run_process(self) -> None:
+        stopping = False
+        while not stopping:
+            entry = self._read_queue.get()
+            if entry is None:
+                break
+            entries = [entry]
+            while len(entries) < self.max_batch:  # batch the items already waiting, without waiting for more
+                try:
+                    entry = self._read_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                entries.append(entry)
+
+            loaded = []
+            for item, read_future, future in entries:
+                try:
+                    loaded.append((item, read_future.result(), future))
+                except Exception as e:
+                    future.set_exception(e)
+            for (item, _, future), result in zip(loaded, self._process_batch(loaded)):
+                start = time.perf_counter()
+                self._write_queue.put((item, result, future))
+                self.stats["process"].blocked_seconds += time.perf_counter() - start
+
+    def _process_batch(self, loaded: list[tuple]) -> list:
+        if not loaded:
+            return []
+        start = time.perf_counter()
+        try:
+            return self._try_process(loaded)
+        finally:
+            self.stats["process"].add(time.perf_counter() - start, len(loaded))
+
+    def _try_process(self, loaded: list[tuple]) -> list:
+        """Processes a batch, falling back to one item at a time if it fails, so that an error only fails its own item."""
+        try:
+            return self.process([(item, data) for item, data, _ in loaded])
+        except Exception as e:
+            if len(loaded) == 1:
+                return [e]
+            return [result for entry in loaded for result in self._try_process([entry])]
+
+    def _run_write(self) -> None:
+        while (entry := self._write_queue.get()) is not None:
+            item, result, future = entry
+            if isinstance(result, Exception):
+                future.set_exception(result)
+                continue
+            start = time.perf_counter()
+            try:
+                future.set_result(self.write(item, result))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.stats["write"].add(time.perf_counter() - start)
@@ -0,0 +1,141 @@
+import os
+import time
+import functools
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable
+
+from utils.profiling_utils import rss_mb
+
+
+def _measured_task(fn: Callable, *args) -> tuple[int, float, float | None, float | None, Any, Exception | None]:
+    """
+    Runs a task in a worker process, returning the worker pid, the time spent, the current and peak RSS of the worker
+    after the task, and the result or error of the task.
+    """
+    start = time.perf_counter()
+    try:
+        result, error = fn(*args), None
+    except Exception as e:
+        result, error = None, e
+    current, peak = rss_mb()
+    return os.getpid(), time.perf_counter() - start, current, peak, result, error
+
+
+class WorkerPool:
+    """
+    Pool of worker processes that can be replaced one at a time, for long batch runs whose workers grow in memory
+    (the spaCy string store and vocab keep the strings of every document, and huge documents leave large allocations
+    behind). Each worker runs in its own single-process executor and is recycled once it has run max_tasks tasks, or
+    when its resident memory exceeds max_rss_mb after a task. Replacements are started as soon as a worker is one task
+    away from its limit or above 90% of the memory ceiling, so that they are ready when it retires; with the fork
+    start method, they are forked from the parent, and start warm if the parent already holds the loaded model.
+    Submitted tasks wait in a single queue, from which the first idle worker takes the next one. Each task is timed
+    inside its worker, and the tasks, busy time and peak RSS of every worker are reported together with the recycle
+    events.
+
+    :param workers: Number of worker processes.
+    :param initializer: Function run by every worker process when it starts.
+    :param initargs: Arguments of the initializer.
+    :param max_tasks: Tasks after which a worker is recycled (0 for no limit).
+    :param max_rss_mb: Resident memory in MB above which a worker is recycled (0 for no limit).
+    """
+
+    def __init__(self, workers: int, initializer: Callable = None, initargs: tuple = (), max_tasks: int = 0,
+                 max_rss_mb: float = 0):
+        self.initializer, self.initargs = initializer, initargs
+        self.max_tasks, self.max_rss_mb = max_tasks, max_rss_mb
+        self.started = time.perf_counter()
+        self.workers: dict[int, dict] = {}
+        self.recycles: list[dict] = []
+        self._queue: deque[tuple[Callable, tuple, Future]] = deque()
+        self._lock = threading.RLock()
+        self._closed = False
+        self._retired: list[ProcessPoolExecutor] = []
+        self._slots = [self._start_worker() for _ in range(workers)]
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """Queues fn(*args), where fn and its arguments must be picklable, and returns the Future of its result."""
+        future = Future()
+        with self._lock:
+            self._queue.append((fn, args, future))
+            self._feed()
+        return future
+
+    def shutdown(self, cancel_futures: bool = False) -> None:
+        """Stops the workers, waiting for the running tasks; queued tasks are cancelled with cancel_futures."""
+        with self._lock:
+            self._closed = True
+            if cancel_futures:
+                while self._queue:
+                    self._queue.popleft()[2].cancel()
+            executors = [slot["executor"] for slot in self._slots] + \
+                        [slot["spare"]["executor"] for slot in self._slots if slot["spare"] is not None] + self._retired
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=cancel_futures)
+
+    def report(self) -> list[dict]:
+        """Returns the tasks run, busy time, utilization and peak RSS of every worker process, recycled ones included."""
+        wall_seconds = time.perf_counter() - self.started
+        with self._lock:
+            return [{"pid": pid, "tasks": stats["tasks"], "busy_seconds": round(stats["busy_seconds"], 3),
+                     "utilization": round(stats["busy_seconds"] / wall_seconds, 3) if wall_seconds else None,
+                     "peak_rss_mb": stats["peak_rss_mb"]}
+                    for pid, stats in sorted(self.workers.items())]
+
+    def _start_worker(self) -> dict:
+        executor = ProcessPoolExecutor(max_workers=1, initializer=self.initializer, initargs=self.initargs)
+        executor.submit(os.getpid)  # starts the process right away instead of at its first task
+        return {"executor": executor, "tasks": 0, "busy": False, "spare": None}
+
+    def _feed(self) -> None:
+        """Hands queued tasks to the idle workers. Called with the lock held."""
+        for slot in self._slots:
+            while self._queue and not slot["busy"]:
+                fn, args, future = self._queue.popleft()
+                if future.set_running_or_notify_cancel():
+                    slot["busy"] = True
+                    task = slot["executor"].submit(_measured_task, fn, *args)
+                    task.add_done_callback(functools.partial(self._done, slot, future))
+
+    def _done(self, slot: dict, future: Future, task: Future) -> None:
+        try:
+            pid, seconds, current_rss, peak_rss, result, error = task.result()
+        except Exception as e:  # the worker died (e.g. killed for lack of memory)
+            pid, seconds, current_rss, peak_rss, result, error = None, 0.0, None, None, None, e
+
+        with self._lock:
+            slot["busy"] = False
+            reason = "crashed" if pid is None else None
+            if pid is not None:
+                stats = self.workers.setdefault(pid, {"tasks": 0, "busy_seconds": 0.0, "peak_rss_mb": None})
+                stats["tasks"] += 1
+                stats["busy_seconds"] += seconds
+                stats["peak_rss_mb"] = max(filter(None, (stats["peak_rss_mb"], peak_rss)), default=None)
+                slot["tasks"] += 1
+                if self.max_tasks and slot["tasks"] >= self.max_tasks:
+                    reason = "tasks"
+                elif self.max_rss_mb and current_rss is not None and current_rss >= self.max_rss_mb:
+                    reason = "rss"
+                elif slot["spare"] is None and not self._closed and \
+                        ((self.max_tasks and slot["tasks"] >= self.max_tasks - 1)
+                         or (self.max_rss_mb and current_rss is not None and current_rss >= 0.9 * self.max_rss_mb)):
+                    slot["spare"] = self._start_worker()
+            if reason is not None and not self._closed:
+                self._recycle(slot, pid, reason, current_rss)
+            self._feed()
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _recycle(self, slot: dict, pid: int | None, reason: str, current_rss: float | None) -> None:
+        """Replaces the worker of a slot with its spare, or a new worker. Called with the lock held."""
+        self.recycles.append({"pid": pid, "reason": reason, "tasks": slot["tasks"], "rss_mb": current_rss,
+                              "at_seconds": round(time.perf_counter() - self.started, 3)})
+        replacement = slot["spare"] or self._start_worker()
+        slot["executor"].shutdown(wait=False)
+        self._retired.append(slot["executor"])
+        slot.update(executor=replacement["executor"], tasks=0, spare=None)
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Iterator
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class StageRecord:
+    """Handle of a running stage, allowing the profiled code to report the characters it processed."""
+    __slots__ = ("chars",)
+
+    def __init__(self, chars: int = 0):
+        self.chars = chars
+
+
+class Profiler:
+    """
+    Records wall time, call count and processed characters of nested pipeline stages, together with free counters.
+    Stages are identified by their path in the stage hierarchy (e.g. ('apply_rules', 'phone_re')), tracked separately
+    for each thread.
+    """
+
+    def __init__(self):
+        self.stats: dict[tuple[str, ...], dict[str, float]] = {}
+        self.counters: dict[str, int] = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> list[str]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name: str, chars: int = 0) -> Iterator[StageRecord]:
+        """Times the enclosed block as a sub-stage of the currently running one."""
+        stack = self._stack()
+        stack.append(name)
+        record = StageRecord(chars)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add(tuple(stack), time.perf_counter() - start, record.chars)
+            stack.pop()
+
+    def add(self, path: tuple[str, ...], seconds: float, chars: int = 0, calls: int = 1) -> None:
+        """Adds a measure to the stage with the given path."""
+        with self._lock:
+            stats = self.stats.setdefault(path, {"calls": 0, "seconds": 0.0, "chars": 0})
+            stats["calls"] += calls
+            stats["seconds"] += seconds
+            stats["chars"] += chars
+
+    def count(self, name: str, value: int = 1) -> None:
+        """Increments a free counter (e.g. cache hits)."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """Returns the recorded measures in a picklable form, optionally clearing them."""
+        with self._lock:
+            snapshot = {"stats": {path: dict(stats) for path, stats in self.stats.items()}, "counters": dict(self.counters)}
+            if reset:
+                self.stats.clear()
+                self.counters.clear()
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        """Adds the measures of a snapshot taken by another profiler (e.g. in a worker process)."""
+        for path, stats in snapshot["stats"].items():
+            self.add(path, stats["seconds"], stats["chars"], stats["calls"])
+        for name, value in snapshot["counters"].items():
+            self.count(name, value)
+
+    def hit_rates(self) -> dict[str, float]:
+        """
+        Returns the hit rate of every pair of '<name>_hit' and '<name>_miss' counters, e.g. the share of texts served
+        by the result cache or of paragraphs reused by deduplication.
+        """
+        rates = {}
+        for name, hits in self.counters.items():
+            if name.endswith("_hit"):
+                lookups = hits + self.counters.get(name[:-len("_hit")] + "_miss", 0)
+                rates[name[:-len("_hit")]] = round(hits / lookups, 4) if lookups else None
+        return rates
+
+    def report(self) -> dict:
+        """Returns a JSON-serializable report with the measures of every stage, sorted by stage path."""
+        stages = []
+        for path, stats in sorted(self.stats.items()):
+            seconds = stats["seconds"]
+            stages.append({
+                "stage": ";".join(path),
+                "calls": stats["calls"],
+                "seconds": round(seconds, 6),
+                "chars": stats["chars"],
+                "chars_per_second": round(stats["chars"] / seconds, 1) if seconds and stats["chars"] else None,
+            })
+        return {"wall_seconds": round(time.perf_counter() - self.started, 6), "stages": stages,
+                "counters": dict(self.counters), "hit_rates": self.hit_rates()}
+
+    def collapsed_stacks(self) -> list[str]:
+        """
+        Returns the measures in the collapsed-stack format read by flame graph tools ('a;b;c <value>' per line),
+        using the self time of each stage in microseconds.
+        """
+        self_seconds = {path: stats["seconds"] for path, stats in self.stats.items()}
+        for path, stats in self.stats.items():
+            if len(path) > 1 and path[:-1] in self_seconds:
+                self_seconds[path[:-1]] -= stats["seconds"]
+        return [f"{';'.join(path)} {max(0, round(seconds * 1e6))}" for path, seconds in sorted(self_seconds.items())]
+
+    def save(self, path_prefix: str) -> tuple[str, str]:
+        """Writes the report to '<prefix>.json' and the collapsed stacks to '<prefix>.folded', returning both paths."""
+        json_path, folded_path = f"{path_prefix}.json", f"{path_prefix}.folded"
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(folded_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.collapsed_stacks()) + "\n")
+        return json_path, folded_path
+
+
+_active_profiler: Profiler | None = None
+
+
+def get_profiler() -> Profiler | None:
+    """Returns the active profiler, if any."""
+    return _active_profiler
+
+
+def set_profiler(profiler: Profiler | None) -> None:
+    """Activates the given profiler for the whole process (None disables profiling)."""
+    global _active_profiler
+    _active_profiler = profiler
+
+
+@contextmanager
+def profiling(profiler: Profiler = None) -> Iterator[Profiler]:
+    """Activates a profiler for the enclosed block, e.g. `with profiling() as profiler: anonymize(text)`."""
+    previous = _active_profiler
+    profiler = profiler or Profiler()
+    set_profiler(profiler)
+    try:
+        yield profiler
+    finally:
+        set_profiler(previous)
+
+
+def profile_stage(name: str, chars: int = 0):
+    """Times the enclosed block as a stage of the active profiler, doing nothing when profiling is disabled."""
+    if _active_profiler is None:
+        return nullcontext(StageRecord(chars))
+    return _active_profiler.stage(name, chars)
+
+
+def profile_count(name: str, value: int = 1) -> None:
+    """Increments a counter of the active profiler, if any."""
+    if _active_profiler is not None:
+        _active_profiler.count(name, value)
+
+
+def rss_mb() -> tuple[float | None, float | None]:
+    """Returns the current and the peak resident set size of the current process in MB, or None where not available."""
+    peak = None
+    if resource is not None:
+        peak = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    try:
+        with open("/proc/self/statm") as f:
+            current = round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):  # no procfs (e.g. macOS): the peak is the closest bound
+        current = peak
+    return current, peak
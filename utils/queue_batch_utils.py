@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Callable, Iterable, Iterator
+
+from config import (DEFAULT_BATCH_SIZE, DEFAULT_NER_MODEL, DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, DEFAULT_WORKERS,
+                    DEFAULT_OUTPUT_FORMAT, DEFAULT_CACHE_MAX_MB, DEFAULT_PDF_WORKERS, DEFAULT_LEASE_SECONDS,
+                    QUEUE_PROGRESS_SECONDS, QUEUE_POLL_SECONDS)
+from utils.anonymization_utils import iter_input_files
+from utils.profiling_utils import get_profiler
+from utils.queue_utils import JobQueue, STATUS_LEASED
+from utils.worker_utils import WorkerContext, create_context, init_worker, worker_context, process_file_timeouts
+
+
+@contextmanager
+def _renewing_lease(queue_path: str, rel_path: str, owner: str, lease_seconds: float) -> Iterator[None]:
+    """Renews the lease of a claimed file every third of lease_seconds from a background thread, until the block ends."""
+    stop = threading.Event()
+
+    def renew():
+        if stop.wait(lease_seconds / 3):
+            return
+        with JobQueue(queue_path) as queue:
+            while True:
+                try:
+                    if not queue.renew(rel_path, owner, lease_seconds):
+                        return
+                except sqlite3.OperationalError:  # queue busy for longer than its timeout, retried at the next round
+                    pass
+                if stop.wait(lease_seconds / 3):
+                    return
+
+    thread = threading.Thread(target=renew, name="lease-renewal", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def _commit_outputs(entries: list[tuple[str, bytes]], output_dir: str, owner: str) -> None:
+    """
+    Writes the output entries of a file under the output directory, each to a temporary file renamed over its final
+    path, so that other nodes never see partially written outputs.
+    """
+    for name, data in entries:
+        path = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.{owner.replace(':', '_')}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+def work_queue(ctx: WorkerContext, queue_path: str, input_dir: str, output_dir: str, lease_seconds: float,
+               log: Callable[[str], None] = None) -> dict:
+    """
+    Claims files from a shared queue and anonymizes them with the given worker context until none is pending or
+    leased by other workers. Outputs are collected in the in-memory sink of the context, committed under the output directory (see _commit_outputs) and only then is the
+    file marked as done, so a worker dying at any point leaves the file to be claimed again once its lease expires.
+    A worker that lost its lease meanwhile still writes the same outputs, but leaves the status to the new owner.
+    Returns the processed, failed and lost files of the worker, the processed ones on which some rule timed out, and
+    its profiling measures, if profiling is enabled.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    summary = {"processed": 0, "failed": 0, "lost": 0, "rule_timeouts": 0}
+    with JobQueue(queue_path) as queue:
+        while True:
+            rel_path = queue.claim(owner, lease_seconds)
+            if rel_path is None:
+                if not queue.counts().get(STATUS_LEASED):
+                    break
+                time.sleep(QUEUE_POLL_SECONDS)  # files leased by other workers may still expire and need a new owner
+                continue
+            with _renewing_lease(queue_path, rel_path, owner, lease_seconds):
+                try:
+                    out_path, rule_timeouts = process_file_timeouts(ctx, os.path.join(input_dir, rel_path),
+                                                                    os.path.dirname(rel_path), None)
+                    out_path = os.path.join(output_dir, out_path)
+                    _commit_outputs(ctx.drain(), output_dir, owner)
+                    error = f"Rules exceeded their timeout: {', '.join(rule_timeouts)}" if rule_timeouts else None
+                    owned, status = queue.complete(rel_path, owner, out_path, error), "processed"
+                    message = f"Anonymized '{rel_path}' -> '{out_path}'" + (f" ({error})" if error else "")
+                    summary["rule_timeouts"] += bool(rule_timeouts and owned)
+                except Exception as e:
+                    ctx.drain()
+                    owned, status = queue.fail(rel_path, owner, str(e)), "failed"
+                    message = f"Failed '{rel_path}': {e}"
+            summary[status if owned else "lost"] += 1
+            if log is not None:
+                log(message if owned else f"Lost the lease of '{rel_path}', now processed by another worker")
+    if (profile := ctx.profile_snapshot()) is not None:
+        summary["profile"] = profile
+    return summary
+
+def _queue_task(*job) -> dict:
+    """Task of a worker process working through the queue with the context of the process (see work_queue)."""
+    return work_queue(worker_context(), *job)
+
+def anonymize_queue(queue_path: str,
+                    input_dir: str = None,
+                    output_dir: str = None,
+                    model_path: str = DEFAULT_NER_MODEL,
+                    entities: Iterable[str] = DEFAULT_ENTITIES,
+                    per_matching: bool = DEFAULT_EXTRA_PER_MATCHING,
+                    personal_data: dict[str, str] = None,
+                    recursive: bool = False,
+                    workers: int = DEFAULT_WORKERS,
+                    batch_size: int = DEFAULT_BATCH_SIZE,
+                    output_format: str = DEFAULT_OUTPUT_FORMAT,
+                    cache_path: str = None,
+                    cache_max_mb: float = DEFAULT_CACHE_MAX_MB,
+                    paragraph_dedup: bool = False,
+                    pdf_workers: int = DEFAULT_PDF_WORKERS,
+                    patient_registry: str = None,
+                    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                    log: Callable[[str], None] = print) -> dict:
+    """
+    Distributed batch mode: anonymizes the files of a SQLite work queue (see utils.queue_utils.JobQueue) shared by any
+    number of nodes over a shared filesystem. With an input directory, its supported files are added to the queue
+    (files already queued are added again only if they changed) together with the settings of the run; nodes started
+    with the queue alone then join the run with the same settings, so that input and output directories, model and
+    registry must be reachable at the same paths on every node. Each of the local worker processes claims files, the
+    largest first, until none is pending or leased. Leases of dead workers expire after lease_seconds and their files
+    are claimed again by the others.
+
+    :param queue_path: Path of the queue database, on the shared filesystem.
+    :param input_dir: Directory whose files are added to the queue, creating it if needed.
+    :param output_dir: Directory where anonymized files are written, mirroring the input tree. Required with input_dir.
+    :param workers: Number of local worker processes. With 1, files are processed in the current process.
+    :param cache_path: Path of an optional result cache local to the node.
+    :param lease_seconds: Time after which the file claimed by a worker that stopped renewing its lease is claimed again.
+    :param log: Function receiving progress messages.
+    :return: Number of files processed and failed by the local workers, files whose lease they lost, processed files on
+             which some rule exceeded its timeout ('rule_timeouts', whose rules are stored as the error of the job),
+             and the number of files per status in the whole queue ('queue').
+    """
+    with JobQueue(queue_path) as queue:
+        if input_dir is not None:
+            if not output_dir:
+                raise ValueError("An output directory is required to add files to the queue.")
+            settings = {"input_dir": os.path.abspath(input_dir), "output_dir": os.path.abspath(output_dir),
+                        "model": model_path, "entities": sorted(entities), "per_matching": per_matching,
+                        "personal_data": personal_data, "output_format": output_format,
+                        "paragraph_dedup": paragraph_dedup, "patient_registry": patient_registry}
+            previous = queue.settings()
+            if previous is not None and previous != json.loads(json.dumps(settings)):
+                raise ValueError(f"Queue '{queue_path}' was created with different settings: use a new queue file.")
+            queue.set_settings(settings)
+            files = [(os.path.relpath(entry.path, input_dir), entry.stat().st_size, entry.stat().st_mtime_ns)
+                     for entry in iter_input_files(input_dir, recursive, exclude=[output_dir])]
+            log(f"Queued {queue.enqueue(files)} of {len(files)} files in '{queue_path}'.")
+        settings = queue.settings()
+    if settings is None:
+        raise ValueError(f"Queue '{queue_path}' has no files: create it by passing an input directory.")
+
+    os.makedirs(settings["output_dir"], exist_ok=True)
+    init_args = (settings["model"], settings["entities"], settings["per_matching"], settings["personal_data"], batch_size,
+                 settings["output_format"], cache_path, cache_max_mb, settings["paragraph_dedup"], pdf_workers,
+                 settings["patient_registry"], True, get_profiler() is not None)
+    job = (queue_path, settings["input_dir"], settings["output_dir"], lease_seconds)
+    results = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args) as executor, \
+                JobQueue(queue_path) as queue:
+            pending = {executor.submit(_queue_task, *job) for _ in range(workers)}
+            while pending:
+                done, pending = wait(pending, timeout=QUEUE_PROGRESS_SECONDS)
+                for future in done:
+                    try:
+                        results.append(future.result())
+                    except Exception as e:  # e.g. a killed worker, whose file is claimed again once its lease expires
+                        log(f"Worker failed: {e}")
+                counts = queue.counts()
+                log(f"Queue: {', '.join(f'{count} {status}' for status, count in sorted(counts.items()))}")
+    else:
+        ctx = create_context(*init_args, in_worker=False)
+        try:
+            results.append(work_queue(ctx, *job, log))
+        finally:
+            ctx.close()
+
+    summary = {key: sum(result[key] for result in results) for key in ("processed", "failed", "lost", "rule_timeouts")}
+    for result in results:
+        if "profile" in result and get_profiler() is not None:
+            get_profiler().merge(result["profile"])
+    with JobQueue(queue_path) as queue:
+        summary["queue"] = queue.counts()
+    return summary
@@ -0,0 +1,138 @@
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator
+
+from config import QUEUE_MAX_ATTEMPTS
+from utils.manifest_utils import STATUS_PENDING, STATUS_DONE, STATUS_FAILED
+
+STATUS_LEASED = "leased"
+
+
+class JobQueue:
+    """
+    SQLite work queue shared by batch workers running on several nodes over a shared filesystem (e.g. NFS), without
+    a message broker. Each row is an input file, relative to the input directory of the queue settings. Workers claim
+    a file by taking a lease on it, renew the lease while they work and release it when the file is done or failed.
+    Leases of workers that died expire and their files are claimed again, up to max_attempts times, after which they
+    are marked as failed. Every change is a short IMMEDIATE transaction, serialized by the SQLite file lock; the
+    rollback journal is used instead of WAL, since WAL needs shared memory that network filesystems do not provide.
+    Lease expiry relies on the clocks of the nodes being synchronized (e.g. by NTP).
+    """
+
+    def __init__(self, path: str, timeout: float = 60.0, max_attempts: int = QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                output TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, size)")
+
+    def settings(self) -> dict | None:
+        """Returns the settings of the run the queue was created for, or None if none was stored yet."""
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'run'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_settings(self, settings: dict) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('run', ?)", (json.dumps(settings, sort_keys=True),))
+
+    def enqueue(self, files: list[tuple[str, int, int]]) -> int:
+        """
+        Adds (path, size, mtime_ns) files in a single transaction, returning how many were queued. Files already in the
+        queue are queued again only if their size or modification time changed.
+        """
+        queued, now = 0, time.time()
+        with self._transaction():
+            for path, size, mtime_ns in files:
+                row = self.conn.execute("SELECT size, mtime_ns FROM jobs WHERE path = ?", (path,)).fetchone()
+                if row == (size, mtime_ns):
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO jobs (path, size, mtime_ns, status, attempts, updated_at) VALUES (?, ?, ?, ?, 0, ?)",
+                    (path, size, mtime_ns, STATUS_PENDING, now))
+                queued += 1
+        return queued
+
+    def claim(self, owner: str, lease_seconds: float) -> str | None:
+        """
+        Leases the largest pending file to the given owner for lease_seconds and returns its path, or None if no file
+        is pending. Expired leases are released first, so that the files of dead workers are claimed again.
+        """
+        now = time.time()
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, error = 'Lease expired too many times', updated_at = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (STATUS_FAILED, now, STATUS_LEASED, now, self.max_attempts))
+            self.conn.execute("UPDATE jobs SET status = ?, owner = NULL, updated_at = ? WHERE status = ? AND lease_expires < ?",
+                              (STATUS_PENDING, now, STATUS_LEASED, now))
+            row = self.conn.execute("SELECT path FROM jobs WHERE status = ? ORDER BY size DESC LIMIT 1",
+                                    (STATUS_PENDING,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE path = ?",
+                (STATUS_LEASED, owner, now + lease_seconds, now, row[0]))
+        return row[0]
+
+    def renew(self, path: str, owner: str, lease_seconds: float) -> bool:
+        """Extends the lease of a file, returning False if the owner lost it (its lease expired and it was re-claimed)."""
+        return self._update_leased(path, owner, "lease_expires = ?", time.time() + lease_seconds)
+
+    def complete(self, path: str, owner: str, output: str, error: str = None) -> bool:
+        """
+        Marks a leased file as done, returning False if the owner lost its lease in the meantime. An error, e.g. the
+        rules that exceeded their timeout on the file, is kept together with the output.
+        """
+        return self._update_leased(path, owner, f"status = '{STATUS_DONE}', owner = NULL, output = ?, error = ?", (output, error))
+
+    def fail(self, path: str, owner: str, error: str) -> bool:
+        """Marks a leased file as failed, returning False if the owner lost its lease in the meantime."""
+        return self._update_leased(path, owner, f"status = '{STATUS_FAILED}', owner = NULL, error = ?", error)
+
+    def counts(self) -> dict[str, int]:
+        """Returns the number of files per status."""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def _update_leased(self, path: str, owner: str, assignments: str, values) -> bool:
+        values = values if isinstance(values, tuple) else (values,)
+        with self._transaction():
+            cursor = self.conn.execute(f"UPDATE jobs SET {assignments}, updated_at = ? WHERE path = ? AND owner = ? AND status = ?",
+                                       (*values, time.time(), path, owner, STATUS_LEASED))
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """IMMEDIATE transaction, taking the write lock up front so that concurrent claims cannot deadlock on an upgrade."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
@@ -0,0 +1,305 @@
+import io
+import os
+import re
+import mmap
+import queue
+import zipfile
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Iterable, Iterator
+
+from lxml import etree
+from PyPDF2 import PdfReader
+
+from config import PDF_PAGE_SEPARATOR, PDF_PAGES_PER_TASK, DOCX_CHUNK_CHARS, TXT_CHUNK_BYTES, PREFETCH_ITEMS
+from utils.compression_utils import compression_of, open_compressed
+from utils.profiling_utils import profile_stage
+
+# ----------------------------
+#   TXT
+# ----------------------------
+def _chunk_end(mm: mmap.mmap, start: int, max_bytes: int) -> int:
+    """
+    Returns where the chunk starting at start should end: after the last blank line within max_bytes, otherwise after
+    the last line break or space, otherwise at the last UTF-8 character boundary (never between a CR and a LF).
+    """
+    limit = start + max_bytes
+    if limit >= len(mm):
+        return len(mm)
+    for separator in (b"\n\n", b"\n\r\n", b"\n", b" "):
+        position = mm.rfind(separator, start, limit)
+        if position > start:
+            return position + len(separator)
+    end = limit
+    while end > start + 1 and (mm[end] & 0xC0 == 0x80 or mm[end - 1:end + 1] == b"\r\n"):
+        end -= 1
+    return end
+
+def iter_text_chunks(file_path: str, max_bytes: int = TXT_CHUNK_BYTES, start: int = 0, end: int = None) -> Iterator[str]:
+    """
+    Lazily yields a UTF-8 text file in chunks of at most max_bytes bytes, split on paragraph boundaries whenever
+    possible. The file is memory-mapped and the pages of each chunk are released once it is decoded, so memory does
+    not depend on the file size. Line endings are normalized as in text mode, so the chunks concatenated give back
+    the text read by read_file. Compressed files (e.g. notes.txt.gz) are decompressed as a stream instead.
+    With start and end (chunk boundaries given by text_chunk_offsets), only the chunks of that byte range are yielded.
+    """
+    if compression_of(file_path):
+        with open_compressed(file_path, "rb") as f:
+            yield from iter_text_stream_chunks(f, max_bytes)
+        return
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            released = start - start % mmap.PAGESIZE
+            stop = len(mm) if end is None else end
+            while start < stop:
+                end = _chunk_end(mm, start, max_bytes)
+                with profile_stage("read_text_chunk", end - start):
+                    chunk = mm[start:end].decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+                    page_end = end - end % mmap.PAGESIZE
+                    if hasattr(mm, "madvise") and page_end > released:
+                        mm.madvise(mmap.MADV_DONTNEED, released, page_end - released)
+                        released = page_end
+                start = end
+                yield chunk
+
+def text_chunk_offsets(file_path: str, max_bytes: int = TXT_CHUNK_BYTES) -> Iterator[int]:
+    """Yields the end byte offset of every chunk iter_text_chunks yields for an uncompressed file, without decoding it."""
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < len(mm):
+                start = _chunk_end(mm, start, max_bytes)
+                yield start
+
+def _text_chunk_end(text: str, max_chars: int) -> int:
+    """Like _chunk_end, on decoded text: after the last blank line, line break or space within max_chars."""
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, max_chars)
+        if position > 0:
+            return position + len(separator)
+    return max_chars
+
+def iter_text_stream_chunks(stream: BinaryIO, max_chars: int = TXT_CHUNK_BYTES) -> Iterator[str]:
+    """
+    Lazily yields a UTF-8 binary stream that cannot be memory-mapped (a decompressed file or an archive member) in
+    chunks of at most max_chars characters, split on paragraph boundaries whenever possible, with line endings
+    normalized as in text mode. Only the chunk being cut is held in memory.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    buffer = ""
+    while True:
+        with profile_stage("read_text_chunk") as stage:
+            piece = text.read(max_chars)
+            stage.chars = len(piece)
+        if not piece:
+            break
+        buffer += piece
+        while len(buffer) >= max_chars:
+            end = _text_chunk_end(buffer, max_chars)
+            yield buffer[:end]
+            buffer = buffer[end:]
+    if buffer:
+        yield buffer
+
+# ----------------------------
+#   PDF
+# ----------------------------
+_pdf_worker_state = {}
+
+def _init_pdf_worker(file_path: str) -> None:
+    """Opens the PDF once per extraction process."""
+    _pdf_worker_state["reader"] = PdfReader(file_path)
+
+def _extract_pages(start: int, end: int) -> list[str]:
+    pages = _pdf_worker_state["reader"].pages
+    return [pages[i].extract_text() or "" for i in range(start, end)]
+
+def iter_pdf_pages(file: str | BinaryIO, workers: int = 1, pages_per_task: int = PDF_PAGES_PER_TASK,
+                   pages: range = None) -> Iterator[str]:
+    """
+    Lazily yields the text of each page of a PDF, in order. Pages are parsed only when requested, so the first pages
+    can be anonymized before the last ones are read.
+    With more than one worker, page ranges are extracted ahead by a pool of processes, each holding its own reader,
+    while the caller processes the pages already yielded. At most two ranges per worker are in flight at a time.
+
+    :param file: Path of the PDF file (compressed files are decompressed in memory), or a seekable binary stream.
+    :param workers: Number of extraction processes. With 1, or for streams and compressed files, pages are extracted
+        in the current process.
+    :param pages_per_task: Number of consecutive pages extracted by each task of the pool.
+    :param pages: Range of the page indexes to extract, all the pages by default.
+    """
+    if isinstance(file, str) and compression_of(file):
+        with open_compressed(file, "rb") as f:
+            file = io.BytesIO(f.read())  # PDF cross-references need random access
+    reader = PdfReader(file)
+    pages = range(len(reader.pages)) if pages is None else pages
+
+    if workers <= 1 or len(pages) <= pages_per_task or not isinstance(file, str):
+        for i in pages:
+            with profile_stage("extract_pdf_page") as stage:
+                text = reader.pages[i].extract_text() or ""
+                stage.chars = len(text)
+            yield text
+        return
+
+    ranges = iter([(start, min(start + pages_per_task, pages.stop)) for start in range(pages.start, pages.stop, pages_per_task)])
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_pdf_worker, initargs=(file,)) as executor:
+        pending = deque(executor.submit(_extract_pages, *page_range) for page_range in itertools.islice(ranges, 2 * workers))
+        while pending:
+            with profile_stage("wait_pdf_pages") as stage:
+                page_texts = pending.popleft().result()
+                stage.chars = sum(len(text) for text in page_texts)
+            for page_range in itertools.islice(ranges, 1):
+                pending.append(executor.submit(_extract_pages, *page_range))
+            yield from page_texts
+
+def read_pdf(file: str | BinaryIO, workers: int = 1) -> str:
+    """Returns the text of a whole PDF, with pages separated by PDF_PAGE_SEPARATOR (a form feed)."""
+    return PDF_PAGE_SEPARATOR.join(iter_pdf_pages(file, workers))
+
+# ----------------------------
+#   DOCX
+# ----------------------------
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+_RUN_CONTENT = {f"{_W}t": None, f"{_W}tab": "\t", f"{_W}ptab": "\t", f"{_W}cr": "\n", f"{_W}noBreakHyphen": "-"}
+_HEADER_PART = re.compile(r"word/header\d*\.xml")
+_FOOTER_PART = re.compile(r"word/footer\d*\.xml")
+
+def _is_run_child(element) -> bool:
+    parent = element.getparent()
+    return parent is not None and parent.tag == f"{_W}r"
+
+def _part_number(name: str) -> int:
+    """Returns the number of a header or footer part (e.g. 10 for word/header10.xml), 0 if it has none."""
+    digits = re.sub(r"\D", "", name)
+    return int(digits) if digits else 0
+
+def _iter_part_paragraphs(archive: zipfile.ZipFile, part: str) -> Iterator[str]:
+    """
+    Incrementally parses a WordprocessingML part, yielding the text of each paragraph (tables included) as soon as
+    it is closed, and freeing the parsed elements as it goes. Run contents are translated like python-docx does
+    (tabs, line breaks, non-breaking hyphens). Fallback copies of text boxes are skipped, since the same content is
+    also in the preferred version of the element.
+    """
+    paragraphs: list[list[str]] = []  # open paragraphs, the innermost last (text boxes can nest them)
+    fallback_depth = 0
+    with archive.open(part) as f:
+        for event, element in etree.iterparse(f, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                if tag == f"{_W}p" and not fallback_depth:
+                    paragraphs.append([])
+                elif tag == _MC_FALLBACK:
+                    fallback_depth += 1
+                continue
+
+            if tag == _MC_FALLBACK:
+                fallback_depth -= 1
+            elif fallback_depth:
+                pass
+            elif tag == f"{_W}p":
+                yield "".join(paragraphs.pop())
+            elif not paragraphs or not _is_run_child(element):
+                pass  # e.g. the tab stops of a paragraph (w:pPr/w:tabs/w:tab) are not text
+            elif tag in _RUN_CONTENT:
+                paragraphs[-1].append((element.text or "") if _RUN_CONTENT[tag] is None else _RUN_CONTENT[tag])
+            elif tag == f"{_W}br" and element.get(f"{_W}type", "textWrapping") == "textWrapping":
+                paragraphs[-1].append("\n")
+
+            if not paragraphs and not fallback_depth:
+                # Nothing open refers to the parsed elements anymore
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+def iter_docx_paragraphs(file: str | BinaryIO) -> Iterator[str]:
+    """
+    Lazily yields the paragraphs of a DOCX file by streaming its XML parts from the archive: the headers first,
+    then the body in document order, including the paragraphs of tables, and finally the footers.
+    Compressed files are decompressed in memory, since the zip directory is at the end of the file.
+    """
+    if isinstance(file, str) and compression_of(file):
+        with open_compressed(file, "rb") as f:
+            file = io.BytesIO(f.read())
+    with zipfile.ZipFile(file) as archive:
+        names = archive.namelist()
+        parts = sorted((name for name in names if _HEADER_PART.fullmatch(name)), key=_part_number) + ["word/document.xml"] \
+                + sorted((name for name in names if _FOOTER_PART.fullmatch(name)), key=_part_number)
+        for part in parts:
+            yield from _iter_part_paragraphs(archive, part)
+
+def read_docx(file: str | BinaryIO) -> str:
+    """Returns the text of a whole DOCX file, with paragraphs separated by newlines."""
+    return "\n".join(iter_docx_paragraphs(file))
+
+def iter_chunks(pieces: Iterable[str], separator: str = "\n", max_chars: int = DOCX_CHUNK_CHARS) -> Iterator[str]:
+    """
+    Joins consecutive pieces of text (e.g. paragraphs) with the separator into chunks of about max_chars characters,
+    so that a long document can be labelled chunk by chunk with some context around each piece. Joining the chunks
+    with the same separator gives back the joined pieces.
+    """
+    chunk, length = [], 0
+    for piece in pieces:
+        if chunk and length + len(piece) > max_chars:
+            yield separator.join(chunk)
+            chunk, length = [], 0
+        chunk.append(piece)
+        length += len(piece) + len(separator)
+    if chunk:
+        yield separator.join(chunk)
+
+# ----------------------------
+#   PREFETCH
+# ----------------------------
+_PREFETCH_DONE = object()
+
+def iter_prefetched(items: Iterable, max_items: int = PREFETCH_ITEMS) -> Iterator:
+    """
+    Iterates over items in a background reader thread, at most max_items ahead of the caller, so that reading and
+    decompressing the input (which releases the GIL) overlap with the model. Errors of the reader are raised to the
+    caller when reached; if the caller stops early, the reader is stopped and the items closed.
+    """
+    buffer = queue.Queue(maxsize=max_items)
+    stop = threading.Event()
+
+    def put(entry) -> None:
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read() -> None:
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                put((item, None))
+            put((_PREFETCH_DONE, None))
+        except BaseException as e:
+            put((_PREFETCH_DONE, e))
+
+    thread = threading.Thread(target=read, name="input-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            with profile_stage("wait_input"):
+                item, error = buffer.get()
+            if item is _PREFETCH_DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+        if hasattr(items, "close"):
+            items.close()
@@ -0,0 +1,56 @@
+import os
+from typing import Callable, Iterable
+
+import spacy
+
+from config import DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, DEFAULT_OUTPUT_FORMAT
+from rules.rules import apply_rules, get_rule_timeouts
+from utils.compression_utils import strip_compression_suffix
+from utils.span_utils import doc_to_spans
+from utils.ner_store_utils import ner_store_path, load_ner_docs, iter_ner_store
+from utils.batch_utils import add_rule_timeouts
+from utils.worker_utils import save_results
+
+
+def reapply_rules_directory(store_dir: str,
+                            output_dir: str,
+                            entities: Iterable[str] = DEFAULT_ENTITIES,
+                            per_matching: bool = DEFAULT_EXTRA_PER_MATCHING,
+                            personal_data: dict[str, str] = None,
+                            output_format: str = DEFAULT_OUTPUT_FORMAT,
+                            log: Callable[[str], None] = print) -> dict[str, int]:
+    """
+    Re-anonymizes every file of a NER store written by anonymize_directory, running only the rules and the entity
+    merging on the stored model output, without loading the model. Used after updating dictionaries or rules.
+    Outputs are written to the output directory, mirroring the store tree, with the same names as in directory mode.
+
+    :param store_dir: Directory of the NER store.
+    :param output_dir: Directory where anonymized files are written.
+    :param personal_data: Personal data used for documents stored without their own.
+    :param output_format: One of 'text', 'standoff' or 'standoff-binary'.
+    :param log: Function receiving progress messages.
+    :return: Number of processed and failed files, and of processed files on which some rule exceeded its timeout.
+    """
+    entities = list(entities)
+    vocab = spacy.blank("it").vocab
+    summary = {"processed": 0, "failed": 0, "rule_timeouts": 0}
+
+    for rel_path in iter_ner_store(store_dir):
+        try:
+            docs = [apply_rules(doc, per_matching, doc_personal_data or personal_data)
+                    for doc, doc_personal_data in load_ner_docs(ner_store_path(store_dir, rel_path), vocab)]
+            out_path = save_results([doc.text for doc in docs], [doc_to_spans(doc, entities) for doc in docs],
+                                    os.path.join(output_dir, os.path.dirname(rel_path)), strip_compression_suffix(rel_path),
+                                    output_format)
+            summary["processed"] += 1
+            rule_timeouts = []
+            for doc in docs:
+                add_rule_timeouts(rule_timeouts, get_rule_timeouts(doc))
+            summary["rule_timeouts"] += bool(rule_timeouts)
+            log(f"Re-applied rules to '{rel_path}' -> '{out_path}'"
+                + (f" (rules {', '.join(rule_timeouts)} exceeded their timeout)" if rule_timeouts else ""))
+        except Exception as e:
+            summary["failed"] += 1
+            log(f"Failed '{rel_path}': {e}")
+
+    return summary
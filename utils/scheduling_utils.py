@@ -0,0 +1,106 @@
+import os
+import math
+import heapq
+import itertools
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from typing import Any, Callable
+
+from PyPDF2 import PdfReader
+
+from config import COST_PER_BYTE, COMPRESSED_COST_FACTOR, SCHEDULER_PART_CHARS, TXT_CHUNK_BYTES
+from utils.compression_utils import compression_of, strip_compression_suffix, is_archive
+from utils.reader_utils import text_chunk_offsets
+from utils.pool_utils import WorkerPool
+
+
+def estimate_cost(path: str) -> int:
+    """
+    Estimates the cost of anonymizing a file as its approximate number of characters of text, from its size and
+    type (see COST_PER_BYTE), without reading it. Compressed files and archives are scaled by COMPRESSED_COST_FACTOR.
+    """
+    size = os.path.getsize(path)
+    factor = 1.0 if is_archive(path) else COST_PER_BYTE.get(os.path.splitext(strip_compression_suffix(path))[1].lower(), 1.0)
+    if is_archive(path) or compression_of(path):
+        factor *= COMPRESSED_COST_FACTOR
+    return int(size * factor)
+
+
+def plan_parts(path: str, cost: int, part_chars: int = SCHEDULER_PART_CHARS,
+               chunk_bytes: int = TXT_CHUNK_BYTES) -> list[tuple[int, tuple[int, int]]] | None:
+    """
+    Splits a long document into parts of about part_chars estimated characters that can be labelled separately, as
+    (cost, bounds) pairs: byte ranges aligned on the chunks of iter_text_chunks for .txt files, page ranges for PDFs.
+    Since chunks and pages are labelled independently anyway, the parts joined give the same output as the whole
+    document. Returns None for documents that are not worth splitting (less than two parts) or cannot be split
+    (compressed files, archives and other types).
+    """
+    if cost < 2 * part_chars or compression_of(path) or is_archive(path):
+        return None
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".txt":
+        factor = COST_PER_BYTE[".txt"]
+        parts, start = [], 0
+        for end in text_chunk_offsets(path, chunk_bytes):
+            if (end - start) * factor >= part_chars:
+                parts.append((int((end - start) * factor), (start, end)))
+                start = end
+        if start < os.path.getsize(path):
+            parts.append((int((os.path.getsize(path) - start) * factor), (start, os.path.getsize(path))))
+    elif ext == ".pdf":
+        page_count = len(PdfReader(path).pages)
+        pages_per_part = math.ceil(page_count / min(page_count, math.ceil(cost / part_chars)))
+        parts = [(cost * (min(first + pages_per_part, page_count) - first) // page_count,
+                  (first, min(first + pages_per_part, page_count))) for first in range(0, page_count, pages_per_part)]
+    else:
+        return None
+    return parts if len(parts) > 1 else None
+
+
+class LargestFirstScheduler:
+    """
+    Dispatches tasks to a worker pool largest first, by estimated cost, so that long documents start early and short
+    ones fill the gaps at the end of the run, instead of a long document submitted last keeping a single worker busy
+    while the others are idle. Only max_in_flight tasks are handed to the pool at a time: the other tasks wait in a
+    priority queue, from which the next largest is taken as soon as a worker is free, so idle workers always pick up
+    pending work.
+
+    :param pool: Worker pool running the tasks (see utils.pool_utils.WorkerPool).
+    :param max_in_flight: Number of tasks handed to the pool at a time.
+    """
+
+    def __init__(self, pool: WorkerPool, max_in_flight: int):
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self._tasks: list[tuple] = []
+        self._order = itertools.count()
+        self._pending: dict[Future, Callable] = {}
+
+    def add(self, cost: int, callback: Callable[[Callable[[], Any]], None], fn: Callable, *args) -> None:
+        """
+        Queues fn(*args), where fn must be picklable. Once the task ends, callback receives a function returning its
+        result, or raising its error, in the current process.
+        """
+        heapq.heappush(self._tasks, (-cost, next(self._order), callback, fn, args))
+
+    def dispatch(self) -> None:
+        """
+        Hands the largest pending tasks to the pool while there is room for them and runs the callbacks of the tasks
+        completed so far, without waiting. Called while tasks are still being added (e.g. during the directory walk),
+        so that workers start right away; the tasks added in the meantime are then dispatched largest first.
+        """
+        while self._tasks and len(self._pending) < self.max_in_flight:
+            _, _, callback, fn, args = heapq.heappop(self._tasks)
+            self._pending[self.pool.submit(fn, *args)] = callback
+        if not self._pending:
+            return
+        done, _ = wait(self._pending, timeout=0, return_when=FIRST_COMPLETED)
+        for future in done:
+            self._pending.pop(future)(future.result)
+
+    def drain(self) -> None:
+        """Runs all the queued tasks, largest first, until none is left."""
+        while self._tasks or self._pending:
+            done, _ = wait(self._pending, return_when=FIRST_COMPLETED) if self._pending else ((), ())
+            for future in done:
+                self._pending.pop(future)(future.result)
+            self.dispatch()
@@ -0,0 +1,226 @@
+import io
+import os
+import json
+import time
+import queue
+import base64
+import sqlite3
+import tarfile
+import zipfile
+import threading
+
+from config import SINK_BATCH_ENTRIES, SINK_BATCH_BYTES, SINK_QUEUE_BATCHES
+from utils.compression_utils import open_compressed, compression_of, strip_compression_suffix
+from utils.profiling_utils import profile_count
+
+SINK_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst",
+                   ".jsonl", ".jsonl.gz", ".jsonl.bz2", ".jsonl.xz", ".jsonl.zst", ".sqlite", ".db")
+
+
+class OutputSink:
+    """
+    Destination collecting all the output files of a run (anonymized texts and span files) as named entries of a
+    single container, instead of one small file per text. Entries are buffered and handed in batches to a dedicated
+    writer thread, so that compression and disk writes overlap with the model. At most SINK_QUEUE_BATCHES batches
+    wait for the writer, which blocks the producer when the disk does not keep up. Errors of the writer thread are
+    raised by the next write or by close.
+    """
+
+    def __init__(self, path: str, batch_entries: int = SINK_BATCH_ENTRIES, batch_bytes: int = SINK_BATCH_BYTES):
+        self.path = path
+        self.batch_entries = batch_entries
+        self.batch_bytes = batch_bytes
+        self.entries = 0
+        self._pending: list[tuple[str, bytes]] = []
+        self._pending_bytes = 0
+        self._queue = queue.Queue(maxsize=SINK_QUEUE_BATCHES)
+        self._error: BaseException | None = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"sink-writer:{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def write(self, name: str, data: str | bytes) -> None:
+        """Adds an entry with the given name (a relative path, e.g. 'reports/note_anonymized.txt') and content."""
+        self._raise_error()
+        data = data.encode("utf-8") if isinstance(data, str) else data
+        self._pending.append((name.replace(os.sep, "/"), data))
+        self._pending_bytes += len(data)
+        self.entries += 1
+        if len(self._pending) >= self.batch_entries or self._pending_bytes >= self.batch_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hands the buffered entries to the writer thread."""
+        if self._pending:
+            self._queue.put(self._pending)
+            self._pending, self._pending_bytes = [], 0
+
+    def close(self) -> None:
+        """Writes the remaining entries, waits for the writer thread and finalizes the container."""
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _run(self) -> None:
+        try:
+            self._open()
+            while (batch := self._queue.get()) is not None:
+                start = time.perf_counter()
+                self._write_batch(batch)
+                profile_count("sink_write_ms", round((time.perf_counter() - start) * 1000))
+                profile_count("sink_entries", len(batch))
+        except BaseException as e:
+            self._error = e
+            while self._queue.get() is not None:  # unblock the producer until close
+                pass
+        finally:
+            try:
+                self._close()
+            except BaseException as e:
+                self._error = self._error or e
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"Writing to output sink '{self.path}' failed: {self._error}") from self._error
+
+    def _open(self) -> None:
+        raise NotImplementedError
+
+    def _write_batch(self, batch: list[tuple[str, bytes]]) -> None:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ZipSink(OutputSink):
+    """Deflate-compressed zip archive. An existing archive is appended to, so that resumed runs keep previous entries."""
+
+    def _open(self) -> None:
+        self.archive = zipfile.ZipFile(self.path, "a" if os.path.exists(self.path) else "w", zipfile.ZIP_DEFLATED)
+
+    def _write_batch(self, batch: list[tuple[str, bytes]]) -> None:
+        now = time.localtime()[:6]
+        for name, data in batch:
+            info = zipfile.ZipInfo(name, date_time=now)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+
+    def _close(self) -> None:
+        if hasattr(self, "archive"):
+            self.archive.close()
+
+
+class TarSink(OutputSink):
+    """
+    Tar archive, optionally compressed with gzip, bz2, xz or zstd, written as a stream. Tar streams cannot be
+    appended to, so the archive must not exist yet.
+    """
+
+    def _open(self) -> None:
+        self.file = open_compressed(self.path, "xb")
+        self.archive = tarfile.open(fileobj=self.file, mode="w|")
+
+    def _write_batch(self, batch: list[tuple[str, bytes]]) -> None:
+        now = time.time()
+        for name, data in batch:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(data), now
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def _close(self) -> None:
+        if hasattr(self, "archive"):
+            self.archive.close()
+        if hasattr(self, "file"):
+            self.file.close()
+
+
+class JsonlSink(OutputSink):
+    """
+    JSON Lines file of {"name", "content"} records, optionally compressed, appended to if it exists. Binary entries
+    (binary span files) are stored base64-encoded, with "encoding": "base64".
+    """
+
+    def _open(self) -> None:
+        self.file = open_compressed(self.path, "ab")
+
+    def _write_batch(self, batch: list[tuple[str, bytes]]) -> None:
+        lines = []
+        for name, data in batch:
+            try:
+                record = {"name": name, "content": data.decode("utf-8")}
+            except UnicodeDecodeError:
+                record = {"name": name, "content": base64.b64encode(data).decode("ascii"), "encoding": "base64"}
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.write("".join(lines).encode("utf-8"))
+
+    def _close(self) -> None:
+        if hasattr(self, "file"):
+            self.file.close()
+
+
+class SqliteSink(OutputSink):
+    """SQLite table outputs(name, content, written_at), one transaction per batch. Rewritten entries replace the old ones."""
+
+    def _open(self) -> None:
+        self.conn = sqlite3.connect(self.path)  # created by the writer thread, which is the only one using it
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outputs (name TEXT PRIMARY KEY, content BLOB NOT NULL, written_at REAL NOT NULL)")
+        self.conn.commit()
+
+    def _write_batch(self, batch: list[tuple[str, bytes]]) -> None:
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO outputs (name, content, written_at) VALUES (?, ?, ?)",
+                              [(name, data, now) for name, data in batch])
+        self.conn.commit()
+
+    def _close(self) -> None:
+        if hasattr(self, "conn"):
+            self.conn.close()
+
+
+class MemorySink:
+    """
+    Collects entries in memory, with the same write interface as OutputSink. Used by worker processes, whose entries
+    are sent back to the parent and written to the actual sink there.
+    """
+
+    def __init__(self):
+        self._entries: list[tuple[str, bytes]] = []
+
+    def write(self, name: str, data: str | bytes) -> None:
+        self._entries.append((name.replace(os.sep, "/"), data.encode("utf-8") if isinstance(data, str) else data))
+
+    def drain(self) -> list[tuple[str, bytes]]:
+        """Returns the entries collected since the previous call."""
+        entries, self._entries = self._entries, []
+        return entries
+
+
+def open_sink(path: str) -> OutputSink:
+    """Opens the sink matching the extension of the path (see SINK_EXTENSIONS), creating parent directories as needed."""
+    base = strip_compression_suffix(path).lower()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if base.endswith(".zip") and compression_of(path) is None:
+        return ZipSink(path)
+    if base.endswith(".tar"):
+        if os.path.exists(path):
+            raise ValueError(f"Tar archive '{path}' already exists and cannot be appended to: remove it, or use a zip, "
+                             f"JSONL or SQLite sink to resume runs.")
+        return TarSink(path)
+    if base.endswith(".jsonl"):
+        return JsonlSink(path)
+    if base.endswith((".sqlite", ".db")) and compression_of(path) is None:
+        return SqliteSink(path)
+    raise ValueError(f"Unsupported output sink '{path}': expected one of {', '.join(SINK_EXTENSIONS)}.")
@@ -0,0 +1,87 @@
+import json
+import struct
+from typing import BinaryIO, Iterable, Iterator, TextIO
+
+from spacy.tokens import Doc
+
+SOURCE_NER = "NER"
+
+# Binary standoff format: a magic header followed by a stream of frames. A string frame ('S') registers the next
+# label/source name in the string table, a document frame ('D') holds the spans of one document as fixed-size records.
+STANDOFF_MAGIC = b"SPN1"
+_STRING_FRAME = b"S"
+_DOC_FRAME = b"D"
+_STRING_HEADER = struct.Struct("<H")
+_DOC_HEADER = struct.Struct("<I")
+_SPAN_RECORD = struct.Struct("<IIHH")
+
+StandoffSpan = tuple[int, int, str, str]
+
+
+def doc_to_spans(doc: Doc, labels: Iterable[str] = None) -> list[StandoffSpan]:
+    """
+    Returns the (start, end, label, source) character offsets of the doc entities with the given labels (all if None).
+    The source is the name of the rule that produced the entity, 'personal_data' for personal data matches,
+    or 'NER' for entities predicted by the model.
+    """
+    labels = None if labels is None else set(labels)
+    return [(ent.start_char, ent.end_char, ent.label_, ent.id_ or SOURCE_NER) for ent in doc.ents
+            if labels is None or ent.label_ in labels]
+
+
+def write_spans_jsonl(file: TextIO, spans: list[StandoffSpan], **fields) -> None:
+    """Writes the spans of one document as a JSON Lines record, as compact [start, end, label, source] lists."""
+    record = dict(fields)
+    record["spans"] = [list(span) for span in spans]
+    file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def iter_spans_jsonl(file: TextIO) -> Iterator[list[StandoffSpan]]:
+    """Reads back the spans of each document written by write_spans_jsonl."""
+    for line in file:
+        if line.strip():
+            yield [tuple(span) for span in json.loads(line)["spans"]]
+
+
+class BinarySpanWriter:
+    """
+    Writes the spans of a stream of documents in a compact binary format: 12 bytes per span, with labels and sources
+    stored once in a string table that grows as new names are encountered.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.strings: dict[str, int] = {}
+        self.file.write(STANDOFF_MAGIC)
+
+    def _string_id(self, string: str) -> int:
+        if string not in self.strings:
+            encoded = string.encode("utf-8")
+            self.file.write(_STRING_FRAME + _STRING_HEADER.pack(len(encoded)) + encoded)
+            self.strings[string] = len(self.strings)
+        return self.strings[string]
+
+    def write(self, spans: list[StandoffSpan]) -> None:
+        """Writes the spans of one document."""
+        records = [_SPAN_RECORD.pack(start, end, self._string_id(label), self._string_id(source))
+                   for start, end, label, source in spans]
+        self.file.write(_DOC_FRAME + _DOC_HEADER.pack(len(records)) + b"".join(records))
+
+
+def iter_spans_binary(file: BinaryIO) -> Iterator[list[StandoffSpan]]:
+    """Reads back the spans of each document written by a BinarySpanWriter."""
+    if file.read(len(STANDOFF_MAGIC)) != STANDOFF_MAGIC:
+        raise ValueError("Not a binary standoff file.")
+
+    strings = []
+    while frame := file.read(1):
+        if frame == _STRING_FRAME:
+            (length,) = _STRING_HEADER.unpack(file.read(_STRING_HEADER.size))
+            strings.append(file.read(length).decode("utf-8"))
+        elif frame == _DOC_FRAME:
+            (count,) = _DOC_HEADER.unpack(file.read(_DOC_HEADER.size))
+            data = file.read(count * _SPAN_RECORD.size)
+            yield [(start, end, strings[label], strings[source])
+                   for start, end, label, source in _SPAN_RECORD.iter_unpack(data)]
+        else:
+            raise ValueError(f"Unknown frame type {frame!r} in binary standoff file.")
@@ -0,0 +1,166 @@
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable
+
+from spacy import Language
+
+from config import DEFAULT_ENTITIES, DEFAULT_EXTRA_PER_MATCHING, WARMUP_DOCUMENT_CHARS
+from utils.batch_utils import label_spans
+
+_SENTENCES = [
+    "Il paziente {name} {surname}, nato a {city} il {date}, si presenta al Ser.D. accompagnato dalla madre.",
+    "Riferisce uso di cocaina nelle ultime due settimane e consumo quotidiano di alcol, in riduzione rispetto al mese scorso.",
+    "Contattato il dott. {surname} del CSM di {city} al numero {phone} per concordare la presa in carico.",
+    "Esami tossicologici del {date}: positività per cannabinoidi, negativi oppiacei e benzodiazepine.",
+    "La sig.ra {name} comunica il nuovo indirizzo, via {surname} {number}, {city} ({prov}).",
+    "Codice fiscale {code}, tessera sanitaria in corso di rinnovo presso l'ASL di {city}.",
+    "Inviata relazione alla comunità terapeutica {surname} all'indirizzo {mail}.",
+    "Prossimo colloquio fissato per il {date} con l'educatrice {name}; proseguire la terapia con metadone 40 mg/die.",
+]
+_NAMES = ["Marco", "Giulia", "Luca", "Francesca", "Alessandro", "Chiara", "Matteo", "Sara"]
+_SURNAMES = ["Rossi", "Bianchi", "Esposito", "Romano", "Colombo", "Ricci", "Marino", "Greco"]
+_CITIES = [("Camerino", "MC"), ("Ancona", "AN"), ("Macerata", "MC"), ("Perugia", "PG"), ("Bologna", "BO")]
+
+
+def synthetic_document(chars: int, seed: int = 0) -> str:
+    """
+    Returns a synthetic clinical note of about the given length, in paragraphs of a few sentences, containing names,
+    places, dates, phone numbers, codes and e-mail addresses, so that it goes through the model and every rule.
+    """
+    rng = random.Random(seed)
+    paragraphs, length = [], 0
+    while length < chars:
+        sentences = []
+        for _ in range(rng.randint(2, 4)):
+            name, surname = rng.choice(_NAMES), rng.choice(_SURNAMES)
+            city, prov = rng.choice(_CITIES)
+            sentences.append(rng.choice(_SENTENCES).format(
+                name=name, surname=surname, city=city, prov=prov, number=rng.randint(1, 120),
+                date=f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(1960, 2025)}",
+                phone=f"3{rng.randint(20, 49)} {rng.randint(1000000, 9999999)}",
+                code=f"{surname[:3].upper()}{name[:3].upper()}{rng.randint(60, 99)}A{rng.randint(10, 68)}H{rng.randint(100, 999)}X",
+                mail=f"{name.lower()}.{surname.lower()}@example.it"))
+        paragraphs.append(" ".join(sentences))
+        length += len(paragraphs[-1]) + 2
+    return "\n\n".join(paragraphs)[:max(chars, 1)]
+
+
+class ModelWarmup:
+    """
+    Warm-up and latency metrics of a process serving the model (e.g. the GUI or a JSON Lines stream). The first
+    documents after spacy.load are much slower than the following ones (lazy initialization of the torch kernels,
+    growth of the allocators, first lookups in the tokenizer and vocab caches), so synthetic documents of each of
+    the given lengths are run twice through the full pipeline (model and rules) before the process is marked as
+    ready: the first pass is recorded as cold and the second one as warm. Documents served afterwards are recorded
+    as warm, and documents served before the warm-up completed as cold, so that the two latencies are never mixed.
+
+    :param nlp: Loaded spaCy pipeline.
+    :param entities: Entity labels to anonymize.
+    :param per_matching: Whether the synthetic documents also go through the dictionary matching of PER and PATIENT.
+    :param lengths: Lengths in characters of the synthetic documents.
+    """
+
+    def __init__(self, nlp: Language, entities: Iterable[str] = DEFAULT_ENTITIES,
+                 per_matching: bool = DEFAULT_EXTRA_PER_MATCHING, lengths: Iterable[int] = WARMUP_DOCUMENT_CHARS):
+        self.nlp, self.entities, self.per_matching = nlp, list(entities), per_matching
+        self.lengths = list(lengths)
+        self.ready = threading.Event()
+        self.error: Exception | None = None
+        self.warmup_seconds: float | None = None
+        self.warmup: list[dict] = []
+        self._latencies = {"cold": {"documents": 0, "chars": 0, "seconds": 0.0, "max_seconds": 0.0},
+                           "warm": {"documents": 0, "chars": 0, "seconds": 0.0, "max_seconds": 0.0}}
+        self._lock = threading.Lock()
+
+    def run(self) -> "ModelWarmup":
+        """Runs the warm-up and marks the process as ready, even if the warm-up failed (see error)."""
+        start = time.perf_counter()
+        try:
+            documents = [synthetic_document(chars, seed) for seed, chars in enumerate(self.lengths)]
+            cold = [self._label(text, "cold") for text in documents]
+            warm = [self._label(text, "warm") for text in documents]
+            self.warmup = [{"chars": len(text), "cold_seconds": round(cold_seconds, 4), "warm_seconds": round(warm_seconds, 4)}
+                           for text, cold_seconds, warm_seconds in zip(documents, cold, warm)]
+        except Exception as e:
+            self.error = e
+        self.warmup_seconds = time.perf_counter() - start
+        self.ready.set()
+        return self
+
+    def start(self) -> "ModelWarmup":
+        """Runs the warm-up in a background thread, returning immediately."""
+        threading.Thread(target=self.run, name="model-warmup", daemon=True).start()
+        return self
+
+    def wait(self, timeout: float = None) -> bool:
+        """Waits for the warm-up to complete, returning whether the process is ready."""
+        return self.ready.wait(timeout)
+
+    def observe(self, chars: int, seconds: float) -> None:
+        """Records the latency of a served document (or batch of documents) as cold or warm."""
+        self._record("warm" if self.ready.is_set() else "cold", chars, seconds)
+
+    def chars_per_second(self) -> float | None:
+        """Returns the warm throughput of the model measured so far, or None before the first warm document."""
+        with self._lock:
+            warm = self._latencies["warm"]
+            return warm["chars"] / warm["seconds"] if warm["seconds"] else None
+
+    def metrics(self) -> dict:
+        """Returns a JSON-serializable report of the readiness, the warm-up and the cold and warm latencies."""
+        with self._lock:
+            latencies = {kind: {**stats, "seconds": round(stats["seconds"], 4), "max_seconds": round(stats["max_seconds"], 4),
+                                "mean_seconds": round(stats["seconds"] / stats["documents"], 4) if stats["documents"] else None}
+                         for kind, stats in self._latencies.items()}
+        return {"ready": self.ready.is_set(), "error": None if self.error is None else str(self.error),
+                "warmup_seconds": None if self.warmup_seconds is None else round(self.warmup_seconds, 3),
+                "warmup": self.warmup, "latencies": latencies}
+
+    def _label(self, text: str, kind: str) -> float:
+        start = time.perf_counter()
+        next(label_spans(self.nlp, [(text, None)], self.entities, self.per_matching))
+        seconds = time.perf_counter() - start
+        self._record(kind, len(text), seconds)
+        return seconds
+
+    def _record(self, kind: str, chars: int, seconds: float) -> None:
+        with self._lock:
+            stats = self._latencies[kind]
+            stats["documents"] += 1
+            stats["chars"] += chars
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+
+def serve_readiness(warmup: ModelWarmup, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves the readiness probe of a process in a background thread: GET /ready answers 200 once the warm-up completed
+    successfully and 503 before (or if it failed), GET /metrics answers the metrics of the warm-up as JSON.
+    Returns the server, to be stopped with shutdown().
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            metrics = warmup.metrics()
+            if self.path == "/ready":
+                status = 200 if metrics["ready"] and metrics["error"] is None else 503
+                body = {"ready": status == 200}
+            elif self.path == "/metrics":
+                status, body = 200, metrics
+            else:
+                status, body = 404, {"error": f"Unknown path '{self.path}', expected /ready or /metrics."}
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):  # keep probes out of stderr, where the CLI reports progress
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="readiness-probe", daemon=True).start()
+    return server
@@ -0,0 +1,263 @@
+import io
+import os
+from contextlib import contextmanager
+from typing import BinaryIO, Iterable, Iterator, TextIO
+
+import spacy
+from spacy import Language
+
+from config import (DEFAULT_BATCH_SIZE, DEFAULT_OUTPUT_FORMAT, DEFAULT_PDF_WORKERS, PDF_PAGE_SEPARATOR,
+                    ARCHIVE_PREFETCH_MEMBERS)
+from rules.rules import get_rule_timeouts
+from rules.patient_registry import load_patient_registry
+from utils.anonymization_utils import (read_file, save_many_texts, save_spans, anonymized_text_path, read_stream,
+                                       is_supported_input)
+from utils.reader_utils import iter_pdf_pages, iter_docx_paragraphs, iter_chunks, iter_text_chunks, iter_text_stream_chunks, \
+    iter_prefetched
+from utils.json_utils import is_multi_record_json, iter_json_records, iter_json_stream_records
+from utils.compression_utils import compression_of, strip_compression_suffix, is_archive, iter_archive_members, archive_base_name
+from utils.span_utils import StandoffSpan, doc_to_spans
+from utils.profiling_utils import Profiler, get_profiler, set_profiler, profile_count
+from utils.cache_utils import ResultCache, ParagraphMemo
+from utils.sink_utils import MemorySink
+from utils.ner_store_utils import new_ner_docbin, save_ner_docs
+from utils.batch_utils import (label_texts, extract_spans, label_chunks, add_rule_timeouts, write_anonymized_chunks,
+                               join_chunk_spans, anonymize_patients, redact_spans)
+
+
+class WorkerContext:
+    """
+    Model and options shared by all the files anonymized by a batch worker, i.e. a worker process or, with a single
+    worker, the calling process. The rules that exceed their timeout are collected in rule_timeouts while a file is
+    processed (see process_file_timeouts), and with an output sink, the outputs of the file are collected in memory
+    until they are drained.
+
+    :param cache: Optional result cache, owned by the context and closed with it.
+    :param memo: Optional paragraph memo (see utils.cache_utils.ParagraphMemo).
+    :param pdf_workers: Number of processes extracting the pages of each PDF ahead of the model.
+    :param sink: Optional in-memory sink collecting the outputs of the current file.
+    :param in_worker: Whether the context belongs to a worker process, whose profiling measures are sent back to the
+                      parent after each task.
+    """
+
+    def __init__(self, nlp: Language, entities: list[str], per_matching: bool, personal_data: dict[str, str] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE, output_format: str = DEFAULT_OUTPUT_FORMAT,
+                 cache: ResultCache = None, memo: ParagraphMemo = None, pdf_workers: int = DEFAULT_PDF_WORKERS,
+                 sink: MemorySink = None, in_worker: bool = False):
+        self.nlp, self.entities, self.per_matching, self.personal_data = nlp, entities, per_matching, personal_data
+        self.batch_size, self.output_format, self.pdf_workers = batch_size, output_format, pdf_workers
+        self.cache, self.memo, self.sink, self.in_worker = cache, memo, sink, in_worker
+        self.rule_timeouts: list[str] = []
+
+    def drain(self) -> list[tuple[str, bytes]] | None:
+        """Returns and forgets the outputs collected by the sink, or None without a sink."""
+        return self.sink.drain() if self.sink is not None else None
+
+    def profile_snapshot(self) -> dict | None:
+        """Returns and resets the profiling measures of a worker process, or None outside workers or without profiling."""
+        profiler = get_profiler()
+        return profiler.snapshot(reset=True) if profiler is not None and self.in_worker else None
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+
+
+_loaded_model: tuple[str, Language] | None = None
+_worker_context: WorkerContext | None = None
+
+
+def load_worker_model(model_path: str) -> Language:
+    """
+    Loads the model in the current process, or returns the one it already loaded, e.g. inherited through fork from
+    a parent that preloaded it, so that forked workers start warm.
+    """
+    global _loaded_model
+    if _loaded_model is None or _loaded_model[0] != model_path:
+        _loaded_model = (model_path, spacy.load(model_path))
+    return _loaded_model[1]
+
+def create_context(model_path: str, entities: list[str], per_matching: bool, personal_data: dict[str, str] | None,
+                   batch_size: int, output_format: str, cache_path: str | None, cache_max_mb: float,
+                   paragraph_dedup: bool, pdf_workers: int, patient_registry: str | None, output_sink: bool,
+                   profile: bool, in_worker: bool) -> WorkerContext:
+    """
+    Creates the context of a worker: loads the model once per process, together with the patient registry, if any.
+    Worker processes get their own profiler, whose measures are sent back to the parent after each task, their own
+    connection to the result cache and their own paragraph memo, if enabled. With an output sink, outputs are
+    collected in memory and sent back to the parent too, which writes them to the sink.
+    """
+    if in_worker:
+        set_profiler(Profiler() if profile else None)
+    if patient_registry:
+        load_patient_registry(patient_registry)
+    return WorkerContext(load_worker_model(model_path), entities, per_matching, personal_data, batch_size, output_format,
+                         ResultCache(cache_path, cache_max_mb) if cache_path else None,
+                         ParagraphMemo() if paragraph_dedup else None, pdf_workers,
+                         MemorySink() if output_sink else None, in_worker)
+
+def init_worker(*args) -> None:
+    """Initializer of worker processes: creates the context (see create_context) of the tasks sent to the process."""
+    global _worker_context
+    _worker_context = create_context(*args, in_worker=True)
+
+def worker_context() -> WorkerContext:
+    """Returns the context of the current worker process, which its tasks then pass on explicitly."""
+    return _worker_context
+
+
+def anonymize_file(ctx: WorkerContext, input_path: str, output_dir: str,
+                   store_path: str | None) -> tuple[str, dict | None, list | None, list[str]]:
+    """
+    Reads, anonymizes and saves a single file, returning the output path together with the profiling measures taken
+    in the worker process since the previous task, if profiling is enabled, the (name, content) entries of its outputs
+    if they go to an output sink, and the rules that exceeded their timeout on some of its texts.
+    """
+    out_path, rule_timeouts = process_file_timeouts(ctx, input_path, output_dir, store_path)
+    return out_path, ctx.profile_snapshot(), ctx.drain(), rule_timeouts
+
+def process_file_timeouts(ctx: WorkerContext, input_path: str, output_dir: str,
+                          store_path: str | None) -> tuple[str, list[str]]:
+    """Processes a single file (see process_file), returning its output path and the rules that timed out on it."""
+    ctx.rule_timeouts = []
+    try:
+        return process_file(ctx, input_path, output_dir, store_path), ctx.rule_timeouts
+    finally:
+        ctx.rule_timeouts = []
+
+def process_file(ctx: WorkerContext, input_path: str, output_dir: str, store_path: str | None) -> str:
+    """
+    Anonymizes one input file (possibly compressed) or archive into the output directory, storing its raw NER output
+    at store_path if given, and returns its output path.
+    """
+    if is_archive(input_path):
+        if store_path is not None:
+            raise ValueError("Archives cannot be stored for re-applying rules.")
+        return _anonymize_archive(ctx, input_path, output_dir)
+    if store_path is None:
+        return _process_document(ctx, strip_compression_suffix(input_path), input_path, output_dir)
+    if strip_compression_suffix(input_path).lower().endswith((".json", ".jsonl")) and is_multi_record_json(input_path):
+        raise ValueError("Multi-patient exports cannot be stored for re-applying rules.")
+
+    texts, file_personal_data = read_file(input_path)
+    spans_per_text = label_stored(ctx, texts, file_personal_data, store_path)
+    return save_results(texts, spans_per_text, output_dir, strip_compression_suffix(input_path), ctx.output_format,
+                        ctx.sink)
+
+def label_stored(ctx: WorkerContext, texts: list[str], file_personal_data: dict[str, str] | None,
+                 store_path: str) -> list[list[StandoffSpan]]:
+    """Labels the texts of one file, storing the raw NER output at store_path, and returns their spans."""
+    records = [(text, file_personal_data or ctx.personal_data) for text in texts]
+    ner_docs = new_ner_docbin()
+    spans_per_text = []
+    for doc in label_texts(ctx.nlp, records, ctx.per_matching, ctx.batch_size, ner_docs):
+        add_rule_timeouts(ctx.rule_timeouts, get_rule_timeouts(doc))
+        spans_per_text.append(doc_to_spans(doc, ctx.entities))
+    save_ner_docs(ner_docs, store_path)
+    return spans_per_text
+
+def _process_document(ctx: WorkerContext, name: str, source: str | io.BytesIO, output_dir: str) -> str:
+    """
+    Anonymizes one document, either a file, possibly compressed, or an archive member read in memory. Its name
+    (without compression suffix) gives its type and the names of its outputs. PDF, DOCX and .txt documents and
+    multi-patient exports are streamed; compressed files are read and decompressed ahead by a reader thread.
+    """
+    ext = os.path.splitext(name)[1].lower()
+    prefetch = iter_prefetched if isinstance(source, str) and compression_of(source) else iter
+    if ext == ".pdf":
+        pages = iter_pdf_pages(source, ctx.pdf_workers)
+        return _anonymize_stream(ctx, pages, PDF_PAGE_SEPARATOR, output_dir, name)
+    if ext == ".docx":
+        return _anonymize_stream(ctx, iter_chunks(iter_docx_paragraphs(source), "\n"), "\n", output_dir, name)
+    if ext == ".txt":
+        chunks = iter_text_chunks(source) if isinstance(source, str) else iter_text_stream_chunks(source)
+        return _anonymize_stream(ctx, prefetch(chunks), "", output_dir, name)
+    if ext == ".jsonl" or (ext == ".json" and (is_multi_record_json(source) if isinstance(source, str)
+                                               else source.getvalue().lstrip(b"\xef\xbb\xbf \t\r\n")[:1] == b"[")):
+        records = iter_json_records(source) if isinstance(source, str) \
+            else iter_json_stream_records(io.TextIOWrapper(source, encoding="utf-8-sig"), name)
+        return _anonymize_patients_file(ctx, prefetch(records), output_dir, name)
+
+    texts, file_personal_data = read_file(source) if isinstance(source, str) else read_stream(source, name)
+    spans_per_text = list(extract_spans(ctx.nlp, texts, ctx.entities, ctx.per_matching,
+                                        file_personal_data or ctx.personal_data, ctx.batch_size, ctx.cache, ctx.memo,
+                                        ctx.rule_timeouts))
+    return save_results(texts, spans_per_text, output_dir, name, ctx.output_format, ctx.sink)
+
+def _anonymize_archive(ctx: WorkerContext, input_path: str, output_dir: str) -> str:
+    """
+    Anonymizes every supported member of a zip or tar archive (optionally compressed) as a separate document, without
+    extracting it to disk: a reader thread reads and decompresses the next members while the current one goes through
+    the model. Outputs are written under a directory named after the archive (e.g. 'bundle' for bundle.tar.gz),
+    mirroring the member paths. Nested archives are skipped, and a failing member fails the whole archive.
+    """
+    archive_dir = os.path.join(output_dir, archive_base_name(input_path))
+    members = ((name, io.BytesIO(stream.read())) for name, stream in iter_archive_members(input_path)
+               if is_supported_input(name) and not is_archive(name))
+    for name, data in iter_prefetched(members, ARCHIVE_PREFETCH_MEMBERS):
+        parts = [part for part in strip_compression_suffix(name).split("/") if part not in ("", ".", "..")]
+        profile_count("archive_members")
+        _process_document(ctx, os.path.join(*parts), data, os.path.join(archive_dir, *parts[:-1]))
+    return archive_dir
+
+def _anonymize_patients_file(ctx: WorkerContext, patients: Iterable[dict], output_dir: str, name: str) -> str:
+    """
+    Anonymizes the records of a multi-patient JSON array or JSON Lines export one patient at a time into a JSON Lines
+    file named after the input (<name>_anonymized.jsonl, or <name>_spans.jsonl/.bin in standoff formats).
+    """
+    base_name = os.path.splitext(os.path.basename(name))[0]
+    suffix = {"text": "_anonymized.jsonl", "standoff": "_spans.jsonl", "standoff-binary": "_spans.bin"}[ctx.output_format]
+    out_path = os.path.join(output_dir, base_name + suffix)
+    with open_output(out_path, ctx.output_format == "standoff-binary", ctx.sink) as f:
+        anonymize_patients(patients, f, ctx.nlp, ctx.entities, ctx.per_matching, ctx.personal_data, ctx.batch_size,
+                           ctx.output_format, ctx.cache, ctx.memo, ctx.rule_timeouts)
+    return out_path
+
+def _anonymize_stream(ctx: WorkerContext, chunks: Iterator[str], separator: str, output_dir: str, input_path: str) -> str:
+    """
+    Anonymizes a document read lazily in chunks (e.g. the pages of a PDF or groups of DOCX paragraphs) and saves the
+    same output as for the whole document with chunks joined by the separator (see label_chunks).
+    """
+    labelled = label_chunks(ctx.nlp, chunks, ctx.entities, ctx.per_matching, ctx.personal_data, ctx.batch_size,
+                            ctx.cache, ctx.memo, ctx.rule_timeouts)
+    return save_chunks(labelled, separator, output_dir, input_path, ctx.output_format, ctx.sink)
+
+
+@contextmanager
+def open_output(out_path: str, binary: bool, sink: MemorySink = None) -> Iterator[TextIO | BinaryIO]:
+    """
+    Opens an output file of the current input file, or, with an output sink, an in-memory buffer added to the sink
+    as a single entry when closed (so streamed documents are held in memory until they are complete).
+    """
+    if sink is None:
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        with open(out_path, "wb") if binary else open(out_path, "w", encoding="utf-8") as f:
+            yield f
+    else:
+        buffer = io.BytesIO() if binary else io.StringIO()
+        yield buffer
+        sink.write(out_path, buffer.getvalue())
+
+def save_chunks(labelled: Iterable[tuple[str, list[StandoffSpan]]], separator: str, output_dir: str, input_path: str,
+                output_format: str, sink: MemorySink = None) -> str:
+    """Saves the labelled chunks of a document as they come, in the given output format, to a file or to the sink."""
+    if output_format == "text":
+        out_path = anonymized_text_path(output_dir, input_path)
+        with open_output(out_path, False, sink) as f:
+            write_anonymized_chunks(labelled, f, separator)
+        return out_path
+    if sink is None:
+        os.makedirs(output_dir, exist_ok=True)
+    return save_spans([join_chunk_spans(labelled, separator)], output_dir=output_dir, original_filename=input_path,
+                      binary=output_format == "standoff-binary", sink=sink)
+
+def save_results(texts: list[str], spans_per_text: list[list[StandoffSpan]], output_dir: str, original_filename: str,
+                 output_format: str, sink: MemorySink = None) -> str:
+    """Saves the anonymized texts, or their spans, of one input file in the given format, to files or to the sink."""
+    if sink is None:
+        os.makedirs(output_dir, exist_ok=True)
+    if output_format == "text":
+        anonymized = [redact_spans(text, spans) for text, spans in zip(texts, spans_per_text)]
+        return save_many_texts(anonymized, output_dir=output_dir, original_filename=original_filename, sink=sink)
+    return save_spans(spans_per_text, output_dir=output_dir, original_filename=original_filename,
+                      binary=output_format == "standoff-binary", sink=sink)